@@ -51,14 +51,15 @@ class AstroActor(AbstractActor):
             daytime = 'night'
             daytime_ext = 'night'
 
-        self.context.set_item_value('daytime', daytime)
-        self.context.set_item_value('daytime_ext', daytime_ext)
-        self.context.set_item_value('sun_alt', alt)
-        self.context.set_item_value('sun_az', location.solar_azimuth())
-
         sun = location.sun()
-        self.context.set_item_value('sunrise', sun['sunrise'])
-        self.context.set_item_value('sunset', sun['sunset'])
-        self.context.set_item_value('noon', sun['noon'])
 
-        self.context.set_item_value('moon_phase', location.moon_phase())
+        self.context.set_item_values({
+            'daytime': daytime,
+            'daytime_ext': daytime_ext,
+            'sun_alt': alt,
+            'sun_az': location.solar_azimuth(),
+            'sunrise': sun['sunrise'],
+            'sunset': sun['sunset'],
+            'noon': sun['noon'],
+            'moon_phase': location.moon_phase(),
+        })
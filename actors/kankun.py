@@ -78,9 +78,8 @@ class KankunActor(AbstractActor):
             except Exception as e:
                 LOG.exception('loop')
             if res:
-                for item in self.context.items:
-                    if item.input == 'kankun:%s' % self.name:
-                        self.context.set_item_value(item.name, res['state'])
+                for item in self.context.items.get_by_input('kankun:%s' % self.name):
+                    self.context.set_item_value(item.name, res['state'])
             await asyncio.sleep(10)
 
         LOG.info('kankun %s stopped', self.name)
@@ -146,7 +146,6 @@ class KodiActor(AbstractActor):
             except Exception as e:
                 LOG.exception('loop')
             if res:
-                self.context.set_item_value(self.get_item_name('state'), res['state'])
                 name = ''
 
                 item = res.get('item', {})
@@ -161,7 +160,8 @@ class KodiActor(AbstractActor):
                         item.get('episode'),
                         item.get('title'))
 
-                self.context.set_item_value(self.get_item_name('item'), name)
+                self.context.set_item_values({self.get_item_name('state'): res['state'],
+                                              self.get_item_name('item'): name})
 
             await asyncio.sleep(self.loop_time)
 
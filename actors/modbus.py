@@ -169,13 +169,9 @@ class ModbusActor(AbstractActor):
 
     async def process_message(self, msg, reg):
         n = int(msg.payload[0] / 2)
-        for i in range(n):
-            val = msg.payload[i * 2 + 1] * 256 + msg.payload[i * 2 + 2]
+        with self.context.batch():
+            for i in range(n):
+                val = msg.payload[i * 2 + 1] * 256 + msg.payload[i * 2 + 2]
 
-            for item in self.context.items:
-                if not item.input or item.input.get('channel') != self.name:
-                    continue
-
-                inp = item.input
-                if inp.get('fn') == msg.fn and inp.get('addr') == msg.addr and inp.get('reg') == reg + i:
+                for item in self.context.items.get_by_input(self.name, (msg.fn, msg.addr, reg + i)):
                     self.context.set_item_value(item.name, val)
@@ -9,35 +9,15 @@ from . import AbstractActor
 LOG = logging.getLogger('mahno.' + __name__)
 
 
-def match_topic(mask, topic):
-    mask_parts = mask.split('/')
-    topic_parts = topic.split('/')
-
-    if mask_parts[0] == '#':
-        return True
-
-    if len(topic_parts) < len(mask_parts):
-        return False
-
-    for m, t in zip(mask_parts, topic_parts):
-        if m == '+':
-            continue
-
-        if m == '#':
-            return True
-
-        if t != m:
-            return False
-
-    return True
-
-
 class MqttActor(AbstractActor):
     name = 'mqtt'
 
     def __init__(self):
         self.mqtt_client = None
         self.send_time = {}
+        # item name -> (payload, changed) waiting for out_sender, newer reading replaces older one
+        self._out = {}
+        self._out_event = asyncio.Event()
         self.connected = False
 
     def init(self, config, context):
@@ -72,6 +52,7 @@ class MqttActor(AbstractActor):
 
     def stop(self):
         self.running = False
+        self._out_event.set()
 
     async def connect(self):
         try:
@@ -100,36 +81,7 @@ class MqttActor(AbstractActor):
 
     def process_message(self, topic, value):
         LOG.debug('got topic %s, message %s', topic, value)
-
-        # common topic for item commands
-        if topic.startswith(self.config['mqtt'].get('in_topic')):
-            cmd = topic.split('/')[-1]
-
-            if value:
-                LOG.info('got command %s %s', cmd, value)
-                self.context.item_command(cmd, value)
-                return
-
-        # items input topic
-        for t in self.context.items:
-            if not t.input or t.input.get('channel') != self.name:
-                continue
-
-            if t['input'].get('topic') == topic:
-                self.context.set_item_value(t['name'], value)
-
-        # signals
-        for rule in self.context.rules:
-            if rule.trigger is None or 'mqtt' not in rule.trigger:
-                continue
-
-            for v in rule.trigger['mqtt']:
-                if match_topic(v['topic'], topic):
-                    if 'payload' in v and v['payload'] != value:
-                        continue
-                    LOG.info('running rule %s on signal %s, val %s', rule.__class__.__name__, topic, value)
-                    asyncio.ensure_future(rule.process_signal(topic, value), loop=self.context.loop)
-                    break
+        self.context.mqtt_message(self.name, topic, value)
 
     async def wait_connected(self):
         while not self.connected:
@@ -156,35 +108,59 @@ class MqttActor(AbstractActor):
                     await asyncio.sleep(0.1)
                     continue
 
-                await self.send_out(item, False)
+                self.send_out([(item, False)])
 
                 await asyncio.sleep(0.1)
 
-    async def send_out(self, item, changed):
+    def send_out(self, checks):
+        """
+        Batch oncheck callback: queue values of checked items for out_sender, no task per reading
+        """
         topic = self.config['mqtt'].get('out_topic')
 
         if not topic:
             return
 
-        t = self.send_time.get(item.name, 0)
-
-        if time.time() - t < self.config['mqtt'].get('min_send_time', 30) and not changed:
-            return
+        now = time.time()
+        min_send_time = self.config['mqtt'].get('min_send_time', 30)
 
-        self.send_time[item.name] = time.time()
+        for item, changed in checks:
+            if now - self.send_time.get(item.name, 0) < min_send_time and not changed:
+                continue
 
-        try:
+            self.send_time[item.name] = now
             val = str(item.value).encode('UTF-8') if item.value is not None else bytes()
+            prev = self._out.pop(item.name, None)
+            self._out[item.name] = (val, changed or (prev is not None and prev[1]))
+
+        if self._out:
+            self._out_event.set()
+
+    async def out_sender(self):
+        """
+        Publish values queued by send_out in order of queueing
+        """
+        topic = self.config['mqtt'].get('out_topic')
+
+        while self.running:
+            if not self._out:
+                self._out_event.clear()
+                await self._out_event.wait()
+                continue
 
             if not (await self.wait_connected()):
-                return
+                break
 
-            await self.mqtt_client.publish(topic.format(item.name), val, 0)
+            name = next(iter(self._out))
+            val, changed = self._out.pop(name)
 
-            if changed:
-                await self.mqtt_client.publish(topic.format(item.name), val, 1)
-        except:
-            LOG.exception('send out error: %s:%s', item.name, item.value)
+            try:
+                await self.mqtt_client.publish(topic.format(name), val, 0)
+
+                if changed:
+                    await self.mqtt_client.publish(topic.format(name), val, 1)
+            except:
+                LOG.exception('send out error: %s:%s', name, val)
 
     def format_simple_cmd(self, d, cmd):
         return dict(topic=d['topic'], payload=cmd, qos=d.get('qos', 0))
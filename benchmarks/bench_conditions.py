@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Condition evaluations per second: compiling condition on every check (as
+Rule.check_condition does) vs closure compiled once on rule load vs cached
+subtree with unchanged items and with one item changing on every check.
+
+    python -m benchmarks.bench_conditions
+"""
+
+import timeit
+
+from core.conditions import ConditionCache, compile_condition
+from core.items import Items, read_item
+
+CONDITION = {
+    'condition_type': 'and',
+    'conditions': [
+        {'condition_type': 'state', 'item_id': 'home_mode', 'state': 'night'},
+        {'condition_type': 'numeric_state', 'item_id': 'room_temp', 'above': 17, 'below': 25},
+        {'condition_type': 'time', 'between': ['22:00', '06:00']},
+        {'condition_type': 'or', 'conditions': [
+            {'condition_type': 'state', 'item_id': 'light_room', 'state': 'Off'},
+            {'condition_type': 'state', 'item_id': 'light_room', 'check': 'not', 'state': 'On'},
+        ]},
+    ]}
+
+
+def main():
+    items = Items()
+    items.add_item(read_item({'name': 'home_mode', 'type': 'text', 'default': 'night'}))
+    items.add_item(read_item({'name': 'room_temp', 'type': 'number', 'default': 20}))
+    items.add_item(read_item({'name': 'light_room', 'type': 'switch', 'default': 'Off'}))
+
+    n = 20000
+    t_each = timeit.timeit(lambda: compile_condition(CONDITION, items)(), number=n)
+    fn = compile_condition(CONDITION, items)
+    t_once = timeit.timeit(fn, number=n)
+    print('evaluations/s: compile every time %.0f, precompiled %.0f' % (n / t_each, n / t_once))
+
+    fn = compile_condition(CONDITION, items, ConditionCache())
+    t_hit = timeit.timeit(fn, number=n)
+    temp = items.get_item('room_temp')
+    t_miss = timeit.timeit(lambda: (temp.set_value(20 + fn.misses % 2), fn()), number=n)
+    print('evaluations/s: cached %.0f, cached with changing item %.0f (hit rate %.2f)' %
+          (n / t_hit, n / t_miss, fn.hits / (fn.hits + fn.misses)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Item updates per second with typical callbacks (sync rule dispatch, async
+websocket push, mqtt send out): old task-per-callback dispatch with async
+send_out per reading vs Context.run_cb dispatch layer with detached send_out
+(task per reading) and with send_out set up as in run.py, sync batch callback
+queueing values for one sender task.
+
+    python -m benchmarks.bench_dispatch
+"""
+
+import asyncio
+import functools
+import time
+
+from core.context import Context, CB_ONCHANGE, CB_ONCHECK
+from core.items import read_item
+
+N = 20000
+ITEMS = 100
+
+
+class LegacyContext(Context):
+    def run_batch_cb(self, name, args_list):
+        for cb in self.callbacks.get(name, ()):
+            for args in ([args_list] if cb.batch else args_list):
+                if cb.is_async:
+                    asyncio.ensure_future(cb.fn(*args), loop=self.loop)
+                else:
+                    self.loop.call_soon(functools.partial(cb.fn, *args))
+
+
+def run(cls, mode):
+    loop = asyncio.new_event_loop()
+    context = cls()
+    context.loop = loop
+    counter = [0]
+    out = {}
+    out_event = asyncio.Event()
+
+    def on_change(changes):
+        counter[0] += len(changes)
+
+    async def on_check(checks):
+        counter[0] += 1
+
+    async def send_out_legacy(item, changed):
+        counter[0] += 1
+
+    def send_out(checks):
+        for item, changed in checks:
+            out[item.name] = (item.value, changed)
+            counter[0] += 1
+        out_event.set()
+
+    async def out_sender():
+        while True:
+            if not out:
+                out_event.clear()
+                await out_event.wait()
+                continue
+            out.pop(next(iter(out)))
+            await asyncio.sleep(0)
+
+    context.add_cb(CB_ONCHANGE, on_change, batch=True)
+    context.add_cb(CB_ONCHECK, on_check, batch=True, priority=10)
+
+    if mode == 'legacy':
+        context.add_cb(CB_ONCHECK, send_out_legacy, priority=20)
+    elif mode == 'detached':
+        context.add_cb(CB_ONCHECK, send_out_legacy, detached=True)
+    else:
+        context.add_cb(CB_ONCHECK, send_out, batch=True)
+
+    for i in range(ITEMS):
+        context.items.add_item(read_item({'name': 'item_%d' % i, 'type': 'number'}))
+
+    async def feed():
+        sender = asyncio.ensure_future(out_sender())
+        for n in range(N):
+            context.set_item_value('item_%d' % (n % ITEMS), n)
+            if n % 10 == 0:
+                await asyncio.sleep(0)
+        while counter[0] < N * 3 or out:
+            await asyncio.sleep(0)
+        sender.cancel()
+
+    start = time.perf_counter()
+    loop.run_until_complete(feed())
+    t = time.perf_counter() - start
+    loop.close()
+    return N / t
+
+
+def main():
+    old = run(LegacyContext, 'legacy')
+    detached = run(Context, 'detached')
+    new = run(Context, 'queued')
+    print('updates/s: task per callback %.0f, dispatch layer with detached send_out %.0f, '
+          'with queued send_out %.0f (x%.1f)' % (old, detached, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Rule action values per second: cached jinja template (value_template) vs
+compiled expression (value_expr) for typical trivial value templates.
+
+    python -m benchmarks.bench_expr
+"""
+
+import timeit
+
+from core.expr import Expressions
+from core.history import template_helpers
+from core.items import Items, read_item
+from core.templates import Templates
+
+CASES = [
+    ('{{ value|float * 1.8 + 32 }}', 'value|float * 1.8 + 32'),
+    ('{{ \'On\' if value == \'Off\' else \'Off\' }}', '\'On\' if value == \'Off\' else \'Off\''),
+    ('{{ value }}', 'value'),
+]
+
+
+def main():
+    items = Items()
+    items.add_item(read_item({'name': 'room_temp', 'type': 'number', 'default': 20}))
+    templates = Templates(template_helpers(items))
+    expressions = Expressions(items, template_helpers(items))
+    d = dict(type='item_change', name='room_temp', value='Off', old_value='On', depth=0,
+             triggered='item room_temp On -> Off')
+
+    n = 20000
+    for template, expr in CASES:
+        env = dict(d, value='21.5') if 'float' in expr else d
+        assert templates.render(template, env) == str(expressions.evaluate(expr, env))
+        t_jinja = timeit.timeit(lambda: templates.render(template, env), number=n)
+        t_expr = timeit.timeit(lambda: expressions.evaluate(expr, env), number=n)
+        print('%-40s jinja %8.0f/s, expr %9.0f/s, x%.1f' % (expr, n / t_jinja, n / t_expr, t_jinja / t_expr))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Memory used by 10k items: old dict-based items holding the whole yaml config
+vs slotted items with extracted fields.
+
+    python -m benchmarks.bench_item_memory
+"""
+
+import gc
+import time
+import tracemalloc
+
+from core.items import read_item
+
+N = 10000
+
+
+class LegacyItem(object):
+    input = None
+    output = None
+    ttl = 0
+    ui = False
+    tags = []
+    config = {}
+
+    def __init__(self, name):
+        self.name = name
+        self._value = None
+        self.checked = 0
+        self.changed = 0
+
+
+def read_legacy_item(d):
+    item = LegacyItem(d['name'])
+    item.config = d
+    item.input = d.get('input')
+    item.output = d.get('output')
+    item.ttl = d.get('ttl', 0)
+    item.ui = bool(d.get('ui', False))
+    item.tags = d.get('tags', [])
+    item._value = float(d.get('default', 0))
+    item.checked = item.changed = time.time()
+    return item
+
+
+def item_config(i):
+    return {'name': 'item_%05d' % i,
+            'type': 'number',
+            'h_name': 'Item number %d' % i,
+            'input': {'channel': 'mqtt', 'topic': 'sensors/%d/temp' % i},
+            'format': '{:.1f} °C',
+            'ttl': 180,
+            'tags': ['temperature', 'room_%d' % (i % 20)],
+            'default': i}
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    res = [fn(item_config(i)) for i in range(N)]
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del res
+    return size
+
+
+def main():
+    old = measure(read_legacy_item)
+    new = measure(read_item)
+    print('%d items: legacy %.1f KiB, slotted %.1f KiB (%.0f%%)' % (N, old / 1024, new / 1024, 100.0 * new / old))
+
+
+if __name__ == '__main__':
+    main()
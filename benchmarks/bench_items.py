@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Item lookup cost for different registry sizes.
+
+    python -m benchmarks.bench_items
+"""
+
+import random
+import timeit
+
+from core.items import Items, read_item
+
+
+def make_items(n):
+    items = Items()
+    for i in range(n):
+        items.add_item(read_item({'name': 'item_%05d' % i, 'type': 'number', 'tags': ['tag_%d' % (i % 10)],
+                                  'input': {'channel': 'mqtt', 'topic': 'sensors/%d' % i}}))
+    return items
+
+
+def main():
+    print('%8s %14s %14s %14s' % ('items', 'get_item, us', 'by_input, us', 'set_value, us'))
+    for n in (100, 1000, 10000):
+        items = make_items(n)
+        names = ['item_%05d' % random.randrange(n) for _ in range(1000)]
+        topics = ['sensors/%d' % random.randrange(n) for _ in range(1000)]
+
+        t_get = timeit.timeit(lambda: [items.get_item(x) for x in names], number=100) / 100
+        t_input = timeit.timeit(lambda: [items.get_by_input('mqtt', x) for x in topics], number=100) / 100
+        t_set = timeit.timeit(lambda: [items.set_item_value(x, 1) for x in names], number=10) / 10
+
+        print('%8d %14.3f %14.3f %14.3f' % (n, t_get * 1000, t_input * 1000, t_set * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Cost of serializing all items for GET /items: plain to_dict + json.dumps
+vs cached json.
+
+Static fields are encoded once per item version, but checked, age and check_age
+are encoded on every call: age fields depend on current time and checked is
+updated without version change. Formatting of these floats dominates the cached
+path, so expect about 2x, not more.
+
+    python -m benchmarks.bench_serialize
+"""
+
+import json
+import timeit
+
+from core.items import Items, read_item
+
+N = 1000
+
+
+def main():
+    items = Items()
+    for i in range(N):
+        items.add_item(read_item({'name': 'item_%04d' % i, 'type': 'number', 'format': '{:.1f} °C',
+                                  'tags': ['temperature'], 'default': i}))
+
+    n = 20
+    t_dict = timeit.timeit(lambda: json.dumps(items.as_list()), number=n) / n
+    t_json = timeit.timeit(lambda: items.as_json(), number=n) / n
+    print('%d items: to_dict + dumps %.2f ms, cached json %.2f ms, %.1fx' % (N, t_dict * 1000, t_json * 1000,
+                                                                             t_dict / t_json))
+
+
+if __name__ == '__main__':
+    main()
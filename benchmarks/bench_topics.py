@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Routing cost of one mqtt message to item inputs and rule mqtt triggers: scan of
+all rule triggers with match_topic vs topic trie built on load.
+
+    python -m benchmarks.bench_topics
+"""
+
+import random
+import timeit
+
+from core.items import Items, read_item
+from core.topics import TopicTrie, match_topic
+from core.triggers import read_mqtt_trigger
+
+ROOMS = 20
+
+
+def make_masks(n):
+    res = []
+    for i in range(n):
+        room = 'room%d' % (i % ROOMS)
+        res.append(random.choice(['home/%s/sensor%d' % (room, i), 'home/%s/+/state' % room, 'home/+/pir%d' % i,
+                                  'home/%s/#' % room, 'devices/%d/+/set' % i]))
+    return res
+
+
+def make_topics(n):
+    return ['%s/%s/%s' % (random.choice(['home', 'devices']), 'room%d' % random.randrange(ROOMS),
+                          random.choice(['sensor%d' % random.randrange(n), 'pir%d' % random.randrange(n),
+                                         'light/state'])) for _ in range(1000)]
+
+
+def main():
+    print('%8s %14s %14s %8s' % ('rules', 'scan, us', 'trie, us', 'x'))
+    for n in (100, 500, 2000):
+        items = Items()
+        for i in range(n):
+            items.add_item(read_item({'name': 'item_%05d' % i, 'type': 'number',
+                                      'input': {'channel': 'mqtt', 'topic': 'home/room%d/sensor%d' % (i % ROOMS, i)}}))
+
+        # rule -> triggers, as rules keep them
+        rules = [[read_mqtt_trigger({'topic': m, 'payload': '1'} if i % 3 else m)] for i, m in enumerate(make_masks(n))]
+        trie = TopicTrie()
+        for seq, triggers in enumerate(rules):
+            for t in triggers:
+                trie.add(t.topic, (seq, triggers, t))
+
+        topics = make_topics(n)
+
+        def scan():
+            for topic in topics:
+                items.get_by_input('mqtt', topic)
+                for triggers in rules:
+                    for t in triggers:
+                        if match_topic(t.topic, topic) and t.matches_payload('1'):
+                            break
+
+        def match():
+            for topic in topics:
+                items.get_by_topic('mqtt', topic)
+                for _, _, t in sorted(trie.match(topic), key=lambda x: x[0]):
+                    t.matches_payload('1')
+
+        for topic in topics[:100]:
+            assert len([t for ts in rules for t in ts if match_topic(t.topic, topic)]) == len(trie.match(topic))
+
+        t_scan = timeit.timeit(scan, number=3) / 3 / len(topics)
+        t_trie = timeit.timeit(match, number=3) / 3 / len(topics)
+        print('%8d %14.2f %14.2f %8.1f' % (n, t_scan * 1e6, t_trie * 1e6, t_scan / t_trie))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# coding: UTF-8
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+DAY = 24 * 3600
+
+# table, bucket size in seconds
+ROLLUPS = (('rollup_1m', 60), ('rollup_1h', 3600))
+
+DEFAULT_RETENTION = {'raw': 7, '1m': 90, '1h': 3650}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (item TEXT NOT NULL, ts REAL NOT NULL, value REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS samples_item_ts ON samples (item, ts);
+CREATE TABLE IF NOT EXISTS rollup_1m (item TEXT NOT NULL, ts INTEGER NOT NULL, min REAL, max REAL, sum REAL,
+                                      count INTEGER, PRIMARY KEY (item, ts));
+CREATE TABLE IF NOT EXISTS rollup_1h (item TEXT NOT NULL, ts INTEGER NOT NULL, min REAL, max REAL, sum REAL,
+                                      count INTEGER, PRIMARY KEY (item, ts));
+'''
+
+_STOP = object()
+
+
+def connect(fn):
+    conn = sqlite3.connect(fn, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def read_retention(conf):
+    """
+    Return dict tag -> {'raw', '1m', '1h'} retention in seconds, 'default' key is used for items without tags
+    """
+    res = {}
+    default = dict(DEFAULT_RETENTION, **conf.get('default', {}))
+
+    for tag, v in conf.items():
+        res[tag] = {k: float(d) * DAY for k, d in dict(default, **v).items()}
+
+    res['default'] = {k: float(d) * DAY for k, d in default.items()}
+    return res
+
+
+class Archive(object):
+    """
+    Long term item history in sqlite. Samples are written by background thread in batched transactions,
+    1 minute and 1 hour rollups are updated in the same transaction.
+    """
+
+    def __init__(self, fn, flush_interval=5.0, retention=None, cleanup_interval=3600):
+        self.fn = fn
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        self.retention = read_retention(retention or {})
+        self.policies = {}
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def set_items(self, items):
+        """
+        Compute retention of every item from its tags, longest one wins
+        """
+        policies = {}
+
+        for item in items:
+            tags = [t for t in item.tags if t in self.retention] or ['default']
+            policies[item.name] = {k: max(self.retention[t][k] for t in tags) for k in DEFAULT_RETENTION}
+
+        self.policies = policies
+
+    def start(self):
+        conn = connect(self.fn)
+        conn.executescript(SCHEMA)
+        conn.close()
+        self._thread = threading.Thread(target=self._worker, name='archive', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def on_check(self, checks):
+        for item, _ in checks:
+            if item.value is None:
+                continue
+            v = item.to_number(item.value)
+            if v is not None:
+                self._queue.put((item.name, item.checked, v))
+
+    def _worker(self):
+        conn = connect(self.fn)
+        last_cleanup = 0
+
+        while True:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            stop = False
+
+            while True:
+                try:
+                    rec = self._queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if rec is _STOP:
+                    stop = True
+                    break
+                batch.append(rec)
+
+            try:
+                if batch:
+                    self._write(conn, batch)
+
+                if time.time() - last_cleanup > self.cleanup_interval:
+                    self._cleanup(conn)
+                    last_cleanup = time.time()
+            except:
+                LOG.exception('archive write error')
+
+            if stop:
+                conn.close()
+                return
+
+    def _write(self, conn, batch):
+        rollups = []
+
+        for table, step in ROLLUPS:
+            agg = {}
+            for name, ts, v in batch:
+                key = (name, int(ts // step * step))
+                a = agg.get(key)
+                if a is None:
+                    agg[key] = [v, v, v, 1]
+                else:
+                    a[0] = min(a[0], v)
+                    a[1] = max(a[1], v)
+                    a[2] += v
+                    a[3] += 1
+            rollups.append((table, [k + tuple(a) for k, a in agg.items()]))
+
+        with conn:
+            conn.executemany('INSERT INTO samples (item, ts, value) VALUES (?, ?, ?)', batch)
+            for table, rows in rollups:
+                conn.executemany('INSERT INTO {} (item, ts, min, max, sum, count) VALUES (?, ?, ?, ?, ?, ?) '
+                                 'ON CONFLICT (item, ts) DO UPDATE SET min = min(min, excluded.min), '
+                                 'max = max(max, excluded.max), sum = sum + excluded.sum, '
+                                 'count = count + excluded.count'.format(table), rows)
+
+        self.written += len(batch)
+
+    def _cleanup(self, conn):
+        now = time.time()
+        policies = dict(self.policies)
+
+        # items removed from config keep default retention, so their rows are purged eventually
+        for name, in conn.execute('SELECT item FROM samples UNION SELECT item FROM rollup_1m '
+                                  'UNION SELECT item FROM rollup_1h'):
+            if name not in policies:
+                policies[name] = self.retention['default']
+
+        with conn:
+            for name, policy in policies.items():
+                conn.execute('DELETE FROM samples WHERE item = ? AND ts < ?', (name, now - policy['raw']))
+                conn.execute('DELETE FROM rollup_1m WHERE item = ? AND ts < ?', (name, now - policy['1m']))
+                conn.execute('DELETE FROM rollup_1h WHERE item = ? AND ts < ?', (name, now - policy['1h']))
+
+        LOG.info('archive cleanup done')
+
+    def query(self, name, start, end, step=None):
+        """
+        Return list of [ts, min, max, avg, count] buckets. Blocking, run it in executor
+        """
+        if step is None:
+            step = max(1, (end - start) / 500)
+
+        conn = connect(self.fn)
+        try:
+            if step < 60:
+                sql = ('SELECT CAST(ts / :step AS INTEGER) * :step AS b, min(value), max(value), avg(value), '
+                       'count(*) FROM samples WHERE item = :item AND ts >= :start AND ts < :end GROUP BY b ORDER BY b')
+            else:
+                table = 'rollup_1m' if step < 3600 else 'rollup_1h'
+                sql = ('SELECT CAST(ts / :step AS INTEGER) * :step AS b, min(min), max(max), sum(sum) / sum(count), '
+                       'sum(count) FROM {} WHERE item = :item AND ts >= :start AND ts < :end '
+                       'GROUP BY b ORDER BY b'.format(table))
+
+            return [list(r) for r in conn.execute(sql, dict(step=step, item=name, start=start, end=end))]
+        finally:
+            conn.close()
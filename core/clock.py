@@ -0,0 +1,113 @@
+# coding: UTF-8
+
+"""
+Clock used by core for timestamps and timers. Real clock is used by default, virtual one is used by replay
+to run recorded events faster than real time.
+"""
+
+import heapq
+import time as _time
+from datetime import datetime
+
+
+class RealClock(object):
+    def time(self):
+        return _time.time()
+
+    def now(self):
+        return datetime.now()
+
+    def call_at(self, loop, ts, fn, *args):
+        """
+        Call fn at wall clock timestamp ts
+        """
+        return loop.call_at(loop.time() + max(0, ts - _time.time()), fn, *args)
+
+
+class VirtualTimer(object):
+    __slots__ = ('ts', 'fn', 'args', 'cancelled')
+
+    def __init__(self, ts, fn, args):
+        self.ts = ts
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock(object):
+    """
+    Clock driven by advance(). Timers are kept in own heap and are called in order of their time
+    """
+
+    def __init__(self, start=0.):
+        self.t = start
+        self._timers = []
+        self._seq = 0
+
+    def time(self):
+        return self.t
+
+    def now(self):
+        return datetime.fromtimestamp(self.t)
+
+    def call_at(self, loop, ts, fn, *args):
+        timer = VirtualTimer(max(ts, self.t), fn, args)
+        self._seq += 1
+        heapq.heappush(self._timers, (timer.ts, self._seq, timer))
+        return timer
+
+    def next_timer(self):
+        """
+        Time of the first active timer or None
+        """
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+
+        return self._timers[0][0] if self._timers else None
+
+    def pop_due(self, ts):
+        """
+        Move time to the first timer due before ts and return it, None if there is no such timer
+        """
+        nxt = self.next_timer()
+
+        if nxt is None or nxt > ts:
+            return None
+
+        _, _, timer = heapq.heappop(self._timers)
+        self.t = max(self.t, timer.ts)
+        return timer
+
+    def set(self, ts):
+        self.t = max(self.t, ts)
+
+
+_clock = RealClock()
+
+
+def set_clock(c):
+    global _clock
+    _clock = c
+
+
+def get_clock():
+    return _clock
+
+
+def time():
+    return _clock.time()
+
+
+def now():
+    return _clock.now()
+
+
+def call_at(loop, ts, fn, *args):
+    return _clock.call_at(loop, ts, fn, *args)
+
+
+def call_later(loop, delay, fn, *args):
+    return _clock.call_at(loop, _clock.time() + delay, fn, *args)
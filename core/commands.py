@@ -0,0 +1,125 @@
+# coding: UTF-8
+
+import asyncio
+import collections
+import logging
+import time
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+PRIO_INTERACTIVE = 0
+PRIO_RULE = 1
+PRIO_PERIODIC = 2
+
+PRIORITIES = (PRIO_INTERACTIVE, PRIO_RULE, PRIO_PERIODIC)
+
+DEFAULT_SIZE = 100
+# seconds, one slow actor command blocks the rest of actor queue at most this long
+DEFAULT_TIMEOUT = 10
+
+
+class CommandQueue(object):
+    """
+    Bounded command queue of one actor with priority lanes, commands are run one by one.
+    Command with the same key replaces pending one in any lane and takes the more important lane of
+    the two, so an older rule command can't override a newer user one. When queue is full oldest command
+    of the least important lane (not more important than new one) is dropped.
+    """
+
+    def __init__(self, name, maxsize=DEFAULT_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self.lanes = [collections.deque() for _ in PRIORITIES]
+        self.event = asyncio.Event()
+        self.enqueued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.timed_out = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def __len__(self):
+        return sum(len(x) for x in self.lanes)
+
+    def put(self, cmd, priority=PRIO_RULE, key=None):
+        """
+        Return false if command is dropped
+        """
+        lane = self.lanes[priority]
+        found = self._find(key) if key is not None else None
+
+        if found is not None:
+            p, entry = found
+            self.coalesced += 1
+
+            if p <= priority:
+                entry[1] = cmd
+                return True
+
+            # stale command waits in less important lane, new one goes to its own lane
+            self.lanes[p].remove(entry)
+            lane.append([key, cmd, entry[2]])
+            self.event.set()
+            return True
+
+        if len(self) >= self.maxsize and not self._drop(priority):
+            LOG.warning('queue %s is full, command %s dropped', self.name, cmd)
+            self.dropped += 1
+            return False
+
+        lane.append([key, cmd, time.time()])
+        self.enqueued += 1
+        self.event.set()
+        return True
+
+    def _find(self, key):
+        for p, lane in enumerate(self.lanes):
+            for entry in lane:
+                if entry[0] == key:
+                    return p, entry
+        return None
+
+    def _drop(self, priority):
+        for p in reversed(PRIORITIES):
+            if p < priority:
+                break
+
+            if self.lanes[p]:
+                _, cmd, _ = self.lanes[p].popleft()
+                LOG.warning('queue %s is full, command %s dropped', self.name, cmd)
+                self.dropped += 1
+                return True
+
+        return False
+
+    def get_nowait(self):
+        for lane in self.lanes:
+            if lane:
+                _, cmd, t = lane.popleft()
+                latency = time.time() - t
+                self.processed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                return cmd
+        return None
+
+    async def get(self):
+        while True:
+            if len(self):
+                return self.get_nowait()
+
+            self.event.clear()
+            await self.event.wait()
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    maxsize=self.maxsize,
+                    depth=[len(x) for x in self.lanes],
+                    enqueued=self.enqueued,
+                    processed=self.processed,
+                    dropped=self.dropped,
+                    coalesced=self.coalesced,
+                    timed_out=self.timed_out,
+                    avg_latency=self.total_latency / self.processed if self.processed else 0,
+                    max_latency=self.max_latency)
@@ -0,0 +1,352 @@
+# coding: UTF-8
+
+"""
+Rule conditions compiled to closures. Items are resolved and time bounds and numbers are parsed once,
+invalid condition raises ConditionError on compile. With ConditionCache `and`/`or` subtrees are shared
+by all rules having the same subtree and their results are reused until version of some used item or,
+for subtrees with time conditions, the minute changes.
+"""
+
+import json
+import logging
+import weakref
+
+from core import clock
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+
+class ConditionError(ValueError):
+    pass
+
+
+def _false():
+    return False
+
+
+def compile_condition(c, items, cache=None):
+    """
+    Return function without arguments returning bool, and/or subtrees are taken from cache if it is set
+    """
+    if not isinstance(c, dict) or 'condition_type' not in c:
+        raise ConditionError('no condition type in condition {}'.format(c))
+
+    ct = c['condition_type']
+    fn = COMPILERS.get(ct)
+
+    if fn is None:
+        raise ConditionError('invalid condition type \'{}\''.format(ct))
+
+    if cache is not None and ct in ('and', 'or'):
+        return cache.get(c, items, lambda: fn(c, items, cache))
+
+    return fn(c, items, cache)
+
+
+def _get_item(c, items):
+    if 'item_id' not in c:
+        raise ConditionError('no item_id in condition {}'.format(c))
+
+    item = items.get_item(c['item_id'])
+
+    if item is None:
+        LOG.warning('no item %s, condition is always false', c['item_id'])
+
+    return item
+
+
+def _compile_state(c, items, cache):
+    op = c.get('check', 'is')
+
+    if 'state' not in c:
+        raise ConditionError('no state in condition {}'.format(c))
+
+    state = c['state']
+
+    if op == 'in' and not isinstance(state, (list, tuple)):
+        raise ConditionError('state must be list for check \'in\'')
+
+    if op not in ('is', 'not', 'in'):
+        raise ConditionError('invalid check \'{}\''.format(op))
+
+    item = _get_item(c, items)
+
+    if item is None:
+        return _false
+
+    if op == 'is':
+        return lambda: item.value == state
+
+    if op == 'not':
+        return lambda: item.value != state
+
+    state = tuple(state)
+    return lambda: item.value in state
+
+
+def to_number(val):
+    if '.' in val:
+        return float(val)
+    elif ',' in val:
+        return float(val.replace(',', '.'))
+    else:
+        return int(val)
+
+
+def _compile_numeric(c, items, cache):
+    above = below = None
+
+    for k, v in c.items():
+        if k in ('item_id', 'condition_type'):
+            continue
+
+        try:
+            v = to_number(v) if isinstance(v, str) else float(v)
+        except (TypeError, ValueError):
+            raise ConditionError('invalid value \'{}\' of {} in numeric_state'.format(v, k))
+
+        if k == 'above':
+            above = v
+        elif k == 'below':
+            below = v
+        else:
+            raise ConditionError('invalid operator \'{}\' in numeric_state'.format(k))
+
+    item = _get_item(c, items)
+
+    if item is None:
+        return _false
+
+    def check():
+        val = item.value
+
+        if val is None:
+            return False
+
+        if isinstance(val, str):
+            try:
+                val = to_number(val)
+            except ValueError:
+                return False
+
+        return (above is None or val > above) and (below is None or val < below)
+
+    return check
+
+
+def parse_minutes(v):
+    try:
+        h, m = [int(x) for x in str(v).split(':', 1)]
+    except ValueError:
+        raise ConditionError('invalid time \'{}\''.format(v))
+
+    if not (0 <= h < 24 and 0 <= m < 60):
+        raise ConditionError('invalid time \'{}\''.format(v))
+
+    return h * 60 + m
+
+
+def time_checker(c):
+    """
+    Return function checking minute of day
+    """
+    checks = []
+
+    for k, v in c.items():
+        if k == 'condition_type':
+            continue
+
+        if k == 'after':
+            m1 = parse_minutes(v)
+            checks.append(lambda m, m1=m1: m >= m1)
+
+        elif k == 'before':
+            m1 = parse_minutes(v)
+            checks.append(lambda m, m1=m1: m <= m1)
+
+        elif k == 'between':
+            if not isinstance(v, (list, tuple)) or len(v) != 2:
+                raise ConditionError('between must be list of two times')
+
+            m1, m2 = parse_minutes(v[0]), parse_minutes(v[1])
+
+            if m1 <= m2:
+                checks.append(lambda m, m1=m1, m2=m2: m1 <= m <= m2)
+            else:
+                # over midnight
+                checks.append(lambda m, m1=m1, m2=m2: m >= m1 or m <= m2)
+
+        else:
+            raise ConditionError('invalid operator \'{}\' in time'.format(k))
+
+    def check(m):
+        for fn in checks:
+            if not fn(m):
+                return False
+        return True
+
+    return check
+
+
+def _compile_time(c, items, cache):
+    check = time_checker(c)
+
+    def fn():
+        t = clock.now()
+        return check(t.hour * 60 + t.minute)
+
+    return fn
+
+
+def _compile_children(c, items, cache):
+    if not isinstance(c.get('conditions'), (list, tuple)):
+        raise ConditionError('no conditions list in {}'.format(c['condition_type']))
+
+    return tuple(compile_condition(x, items, cache) for x in c['conditions'])
+
+
+def _compile_or(c, items, cache):
+    fns = _compile_children(c, items, cache)
+
+    def check():
+        for fn in fns:
+            if fn():
+                return True
+        return False
+
+    return check
+
+
+def _compile_and(c, items, cache):
+    fns = _compile_children(c, items, cache)
+
+    def check():
+        for fn in fns:
+            if not fn():
+                return False
+        return True
+
+    return check
+
+
+def condition_deps(c):
+    """
+    Return (item names, has time condition) of condition dict
+    """
+    names = set()
+    timed = False
+
+    if isinstance(c, dict):
+        if c.get('item_id') is not None:
+            names.add(c['item_id'])
+
+        timed = c.get('condition_type') == 'time'
+
+        for x in c.get('conditions') or ():
+            n, t = condition_deps(x)
+            names |= n
+            timed = timed or t
+
+    return names, timed
+
+
+class CachedCondition(object):
+    """
+    Compiled subtree with result memoized on versions of its items and the minute for time conditions
+    """
+    __slots__ = ('key', 'fn', 'refs', 'items', 'timed', 'hits', 'misses', 'last_hit', '_versions', '_minute',
+                 '_result', '__weakref__')
+
+    def __init__(self, key, fn, refs, timed):
+        self.key = key
+        self.fn = fn
+        # (name, item or None) for checking that items were not replaced when subtree is reused
+        self.refs = refs
+        self.items = tuple(item for _, item in refs if item is not None)
+        self.timed = timed
+        self.hits = 0
+        self.misses = 0
+        self.last_hit = False
+        self._versions = None
+        self._minute = None
+        self._result = False
+
+    def __call__(self):
+        minute = int(clock.time() // 60) if self.timed else None
+
+        if self._versions is not None and minute == self._minute:
+            for item, v in zip(self.items, self._versions):
+                if item.version != v:
+                    break
+            else:
+                self.hits += 1
+                self.last_hit = True
+                return self._result
+
+        self.misses += 1
+        self.last_hit = False
+        self._result = self.fn()
+        self._versions = tuple(item.version for item in self.items)
+        self._minute = minute
+        return self._result
+
+    def is_current(self, items):
+        for name, item in self.refs:
+            if items.get_item(name) is not item:
+                return False
+        return True
+
+
+class ConditionCache(object):
+    """
+    Compiled and/or subtrees by canonical key. Subtrees are kept while some compiled rule uses them
+    """
+
+    def __init__(self):
+        self._nodes = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @staticmethod
+    def key(c):
+        return json.dumps(c, sort_keys=True, default=str)
+
+    def get(self, c, items, compile_fn):
+        key = self.key(c)
+        node = self._nodes.get(key)
+
+        if node is not None and node.is_current(items):
+            return node
+
+        names, timed = condition_deps(c)
+        node = CachedCondition(key, compile_fn(), tuple((n, items.get_item(n)) for n in sorted(names)), timed)
+        self._nodes[key] = node
+        return node
+
+    def to_dict(self):
+        nodes = list(self._nodes.values())
+        hits = sum(x.hits for x in nodes)
+        misses = sum(x.misses for x in nodes)
+        return dict(nodes=len(nodes), hits=hits, misses=misses,
+                    hit_rate=round(hits / (hits + misses), 3) if hits + misses else None)
+
+
+COMPILERS = {
+    'state': _compile_state,
+    'numeric_state': _compile_numeric,
+    'time': _compile_time,
+    'or': _compile_or,
+    'and': _compile_and,
+}
+
+
+def is_condition_step(act):
+    return 'condition_type' in act or 'condition' in act
+
+
+def step_condition(act):
+    """
+    Condition dict of action step
+    """
+    return act['condition'] if isinstance(act.get('condition'), dict) else act
@@ -1,15 +1,45 @@
 import asyncio
 import collections
+import contextlib
 import functools
+import heapq
 import logging
 
+from . import clock
+from .commands import CommandQueue, PRIO_INTERACTIVE, PRIO_RULE, DEFAULT_SIZE
+from .conditions import ConditionCache
+from .expr import Expressions
+from .graph import DependencyGraph
+from .history import template_helpers
 from .items import Items
 from .rules import AbstractRule
+from .templates import Templates
+from .topics import TopicTrie
 
 CB_ONCHANGE = 'onchange'
 CB_ONCHECK = 'oncheck'
 
 LOG = logging.getLogger('mahno.' + __name__)
+RULES_LOG = logging.getLogger('mahno.core.rules')
+
+# depth is number of rule actions in cascade leading to this change, 0 for external changes
+Change = collections.namedtuple('Change', 'name value old_value age depth')
+
+MAX_DEPTH = 10
+
+
+class Callback(object):
+    """
+    Callback classified once on registration
+    """
+    __slots__ = ('fn', 'priority', 'batch', 'is_async', 'detached')
+
+    def __init__(self, fn, priority=0, batch=False, detached=False):
+        self.fn = fn
+        self.priority = priority
+        self.batch = batch
+        self.is_async = asyncio.iscoroutinefunction(fn)
+        self.detached = detached
 
 
 class Context(object):
@@ -18,9 +48,32 @@ class Context(object):
         self.items = Items()
         self.actors = {}
         self.rules = []
-        self.commands = collections.deque()
+        self.graph = DependencyGraph([])
+        self._triggers = {}
+        self.queues = {}
+        self.archive = None
+        self._actors_by_name = {}
         self.loop = None
         self.callbacks = {}
+        self._pending = []
+        self._flush_scheduled = False
+        self._batch = None
+        self._batch_depth = 0
+        self.templates = Templates(template_helpers(self.items))
+        self.expressions = Expressions(self.items, template_helpers(self.items))
+        self.conditions = ConditionCache()
+        self._expiry = []
+        self._expiry_timer = None
+        self._expiry_at = 0
+        self._cron = []
+        self._cron_seq = 0
+        self._cron_timer = None
+        self._cron_at = 0
+        self._for_triggers = {}
+        self._for_timers = {}
+        # trie of (seq, rule, mqtt trigger), seq keeps order of rules and their triggers
+        self._mqtt = TopicTrie()
+        self._mqtt_seq = 0
 
     def do_async(self, fn, *args):
         if asyncio.iscoroutinefunction(fn):
@@ -28,44 +81,242 @@ class Context(object):
         else:
             self.loop.call_soon(functools.partial(fn, *args))
 
-    def add_cb(self, name, cb):
-        self.callbacks.setdefault(name, []).append(cb)
+    def add_cb(self, name, cb, batch=False, priority=0, detached=False):
+        """
+        Batch callbacks get one list of (item, changed) for oncheck or list of Change for onchange.
+        Sync callbacks are called inline, async ones are run in one task per loop iteration ordered by
+        priority (lower first). Detached async callbacks get own task, use it for slow network calls.
+        """
+        cbs = self.callbacks.setdefault(name, [])
+        cbs.append(Callback(cb, priority, batch, detached))
+        cbs.sort(key=lambda x: x.priority)
+
+    def setup_queues(self):
+        """
+        Make command queue for every actor. Must be called after actors are set
+        """
+        size = self.config.get('commands', {}).get('queue_size', DEFAULT_SIZE)
+        self.queues = {}
+        self._actors_by_name = {}
+
+        for key, actor in self.actors.items():
+            self.queues[key] = CommandQueue(key, size)
+            self._actors_by_name.setdefault(actor.name, []).append(key)
 
-    def command(self, name, cmd):
+    def get_actor(self, name):
+        keys = self._actors_by_name.get(name)
+        return self.actors[keys[0]] if keys else None
+
+    def command(self, name, cmd, priority=PRIO_RULE, key=None):
         LOG.info('external command %s', name)
-        self.commands.append((name, cmd))
+        keys = self._actors_by_name.get(name)
+
+        if not keys:
+            LOG.error('no actor %s', name)
+            return
+
+        for k in keys:
+            self.queues[k].put(cmd, priority, key)
 
-    def item_command(self, name, cmd):
+    def item_command(self, name, cmd, priority=PRIO_RULE, depth=0):
         item = self.items.get_item(name)
 
         if not item:
             LOG.error('no item %s', name)
             return
 
-        if item.config.get('output'):
-            for actor in self.actors.values():
-                if actor.name == item.config['output'].get('channel'):
-                    msg = actor.format_simple_cmd(item.config['output'], cmd)
-                    LOG.info('sending msg %s to %s', msg, actor.name)
-                    self.commands.append((item.config['output']['channel'], msg))
+        if item.output:
+            actor = self.get_actor(item.output.get('channel'))
+            if actor is not None:
+                msg = actor.format_simple_cmd(item.output, cmd)
+                LOG.info('sending msg %s to %s', msg, actor.name)
+                self.command(actor.name, msg, priority, key=name)
 
-            if item.config.get('fast_change'):
+            if item.fast_change:
                 LOG.debug('fast change set %s to %s', name, cmd)
-                self.set_item_value(name, cmd)
+                self.set_item_value(name, cmd, depth=depth)
         else:
             LOG.info('directly set %s to %s', name, cmd)
-            self.set_item_value(name, cmd, True)
+            self.set_item_value(name, cmd, True, depth)
 
-    def add_rule(self, rule):
+    def add_rule(self, rule, compiled=False):
+        """
+        Add rule to trigger indexes and timers, rule is compiled unless it was compiled with this context already
+        """
         assert isinstance(rule, AbstractRule)
         rule.context = self
+        if not compiled:
+            rule.compile(self)
         self.rules.append(rule)
 
+        for t in rule.item_triggers:
+            if t.for_ is None:
+                self._triggers.setdefault(t.item_id, []).append((rule, t))
+            else:
+                self._for_triggers.setdefault(t.item_id, []).append((rule, t))
+                if self.loop is not None:
+                    self.arm_for_trigger(rule, t)
+
+        for t in rule.mqtt_triggers:
+            self._mqtt_seq += 1
+            self._mqtt.add(t.topic, (self._mqtt_seq, rule, t))
+
+        if self.loop is not None:
+            self.schedule_cron(rule)
+
+    def remove_rule(self, rule):
+        """
+        Remove rule from trigger indexes, cancel its timers and pending gated triggers
+        """
+        self.rules.remove(rule)
+
+        for t in rule.item_triggers:
+            index = self._triggers if t.for_ is None else self._for_triggers
+            rest = [x for x in index.get(t.item_id, ()) if x[0] is not rule]
+            if rest:
+                index[t.item_id] = rest
+            else:
+                index.pop(t.item_id, None)
+
+            timer = self._for_timers.pop((rule, t), None)
+            if timer is not None:
+                timer.cancel()
+
+        for t in rule.mqtt_triggers:
+            self._mqtt.remove(t.topic, lambda x: x[1] is rule)
+
+        for t in list(rule.item_triggers) + list(rule.mqtt_triggers):
+            if t.gate is not None:
+                t.gate.cancel()
+
+        if rule.cron:
+            self._cron = [x for x in self._cron if x[2] is not rule]
+            heapq.heapify(self._cron)
+
+    def build_graph(self):
+        """
+        Build rules dependency graph, must be called after all rules are added
+        """
+        self.graph = DependencyGraph(self.rules)
+
+        for cycle in self.graph.cycles():
+            LOG.warning('rules loop: %s', ', '.join(cycle))
+
+    @property
+    def max_depth(self):
+        return self.config.get('rules', {}).get('max_depth', MAX_DEPTH)
+
+    def clear_rules(self):
+        for rule in self.rules:
+            for t in list(rule.item_triggers) + list(rule.mqtt_triggers):
+                if t.gate is not None:
+                    t.gate.cancel()
+
+        self.rules = []
+        self._triggers = {}
+        self._mqtt = TopicTrie()
+        self._cron = []
+        self._for_triggers = {}
+
+        if self._cron_timer is not None:
+            self._cron_timer.cancel()
+            self._cron_timer = None
+
+        for timer in self._for_timers.values():
+            timer.cancel()
+        self._for_timers = {}
+
+    def triggers_for_change(self, name, val, old_val):
+        """
+        Return (rule, trigger) pairs with item trigger matching this change
+        """
+        return [(rule, t) for rule, t in self._triggers.get(name, ()) if t.matches(val, old_val)]
+
+    def rules_for_change(self, name, val, old_val):
+        """
+        Return rules with item trigger matching this change
+        """
+        res = []
+        for rule, t in self.triggers_for_change(name, val, old_val):
+            if rule not in res:
+                res.append(rule)
+        return res
+
+    def mqtt_message(self, channel, topic, value):
+        """
+        Route mqtt message: item command on in_topic, item inputs and rule mqtt triggers
+        """
+        in_topic = self.config.get('mqtt', {}).get('in_topic')
+
+        if in_topic and topic.startswith(in_topic):
+            cmd = topic.split('/')[-1]
+
+            if value:
+                LOG.info('got command %s %s', cmd, value)
+                self.item_command(cmd, value, PRIO_INTERACTIVE)
+                return
+
+        # items input topic
+        for t in self.items.get_by_topic(channel, topic):
+            self.set_item_value(t.name, value)
+
+        # signals, first matching trigger of every rule
+        matched = self._mqtt.match(topic)
+
+        if not matched:
+            return
+
+        if len(matched) > 1:
+            matched.sort(key=lambda x: x[0])
+
+        fired = set()
+
+        for _, rule, t in matched:
+            if rule in fired or not t.matches_payload(value):
+                continue
+
+            fired.add(rule)
+            LOG.info('running rule %s on signal %s, val %s', rule.name, topic, value)
+            if t.gate is not None:
+                t.gate.submit(self.loop, value, self.do_async, rule.process_signal, topic, value)
+            else:
+                self.do_async(rule.process_signal, topic, value)
+
+    def fire_rules(self, changes):
+        """
+        Batch onchange callback running rules with matching item triggers
+        """
+        fired = set()
+        max_depth = self.max_depth
+
+        for ch in changes:
+            triggers = self.triggers_for_change(ch.name, ch.value, ch.old_value)
+
+            if triggers and ch.depth >= max_depth:
+                RULES_LOG.warning('cascade depth %s reached on item %s, rules %s are not fired', ch.depth, ch.name,
+                                  ', '.join(sorted(set(r.name for r, _ in triggers))))
+                continue
+
+            for rule, t in triggers:
+                # rule is fired once per batch, gated or not
+                if rule in fired:
+                    continue
+                fired.add(rule)
+
+                try:
+                    if t.gate is not None:
+                        t.gate.submit(self.loop, ch.value, self.do_async, rule.process_item_change, ch.name, ch.value,
+                                      ch.old_value, ch.age, ch.depth)
+                    else:
+                        self.do_async(rule.process_item_change, ch.name, ch.value, ch.old_value, ch.age, ch.depth)
+                except:
+                    RULES_LOG.exception('item change on rule %s', rule.name)
+
     def get_item_value(self, name):
         item = self.items.get_item(name)
         return item.value if item is not None else None
 
-    def set_item_value(self, name, value, force=False):
+    def set_item_value(self, name, value, force=False, depth=0):
         item = self.items.get_item(name)
 
         if not item:
@@ -75,17 +326,231 @@ class Context(object):
         old_value = item.value
         age = item.age
 
-        changed = self.items.set_item_value(name, value)
+        changed = item.set_value(value)
+
+        if item.ttl:
+            self.schedule_expiry(item)
+
+        self._notify(item, changed, old_value, age, force, depth)
+
+    def set_item_values(self, values, force=False):
+        with self.batch():
+            for name, value in values.items():
+                self.set_item_value(name, value, force)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collect all item updates and send one coalesced set of callbacks on exit
+        """
+        if self._batch is None:
+            self._batch = collections.OrderedDict()
+
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                batch, self._batch = self._batch, None
+                self._dispatch(batch.values())
+
+    def _notify(self, item, changed, old_value, age, force=False, depth=0):
+        if self._batch is None:
+            self._dispatch([[item, changed, old_value, age, force, depth]])
+            return
+
+        pending = self._batch.get(item.name)
+
+        if pending is None:
+            self._batch[item.name] = [item, changed, old_value, age, force, depth]
+        else:
+            pending[1] = pending[1] or changed
+            pending[4] = pending[4] or force
+            pending[5] = max(pending[5], depth)
+
+    def _dispatch(self, updates):
+        checks = []
+        changes = []
+
+        for item, changed, old_value, age, force, depth in updates:
+            changed = changed and item.value != old_value
+            checks.append((item, changed))
+            if changed or force:
+                changes.append(Change(item.name, item.value, old_value, age, depth))
+            if changed and item.name in self._for_triggers:
+                for rule, t in self._for_triggers[item.name]:
+                    self.arm_for_trigger(rule, t)
+
+        if checks:
+            self.run_batch_cb(CB_ONCHECK, checks)
+        if changes:
+            self.run_batch_cb(CB_ONCHANGE, changes)
+
+    def init_expiry(self):
+        for item in self.items:
+            self.schedule_expiry(item)
+
+        # items scheduled by loader before the loop was set
+        self._arm_expiry()
+
+    def schedule_expiry(self, item):
+        """
+        Put item with ttl to expiry heap. Item is kept in heap at most once, newer deadline is checked on pop
+        """
+        if not item.ttl or not item.checked or item.expires:
+            return
+
+        item.expires = item.checked + item.ttl
+        heapq.heappush(self._expiry, (item.expires, item.name))
+        self._arm_expiry()
+
+    def _arm_expiry(self):
+        if not self._expiry or self.loop is None:
+            return
+
+        deadline = self._expiry[0][0]
+
+        if self._expiry_timer is not None:
+            if self._expiry_at <= deadline:
+                return
+            self._expiry_timer.cancel()
+
+        self._expiry_at = deadline
+        self._expiry_timer = clock.call_at(self.loop, deadline, self.check_expired)
+
+    def check_expired(self):
+        self._expiry_timer = None
+        now = clock.time()
+
+        with self.batch():
+            while self._expiry and self._expiry[0][0] <= now:
+                deadline, name = heapq.heappop(self._expiry)
+                item = self.items.get_item(name)
+
+                # removed, ttl dropped or entry left by reconfigured item
+                if item is None or not item.ttl or deadline != item.expires:
+                    continue
+
+                item.expires = 0
+
+                if item.checked + item.ttl > now:
+                    self.schedule_expiry(item)
+                    continue
+
+                old_value = item.value
+                age = item.age
+                if item.expire():
+                    self._notify(item, True, old_value, age)
+
+        self._arm_expiry()
+
+    def init_cron(self):
+        for rule in self.rules:
+            self.schedule_cron(rule)
+
+    def schedule_cron(self, rule, t=None, arm=True):
+        """
+        Put next cron firing of rule after t to cron heap
+        """
+        nxt = rule.next_fire(clock.time() if t is None else t)
+
+        if nxt is None:
+            rule.next_run = 0
+            return
+
+        rule.next_run = nxt[0]
+        self._cron_seq += 1
+        heapq.heappush(self._cron, (nxt[0], self._cron_seq, rule, nxt[1]))
+
+        if arm:
+            self._arm_cron()
+
+    def _arm_cron(self):
+        if not self._cron or self.loop is None:
+            return
+
+        deadline = self._cron[0][0]
+
+        if self._cron_timer is not None:
+            if self._cron_at <= deadline:
+                return
+            self._cron_timer.cancel()
+
+        self._cron_at = deadline
+        self._cron_timer = clock.call_at(self.loop, deadline, self.check_cron)
+
+    def check_cron(self):
+        """
+        Fire due cron rules. Next firing is computed from the due minute or from now if we are late,
+        so every minute is fired once and missed ones are not caught up
+        """
+        self._cron_timer = None
+        now = clock.time()
+
+        # timer can fire a bit before wall clock deadline
+        while self._cron and self._cron[0][0] <= now + 0.01:
+            ts, _, rule, expr = heapq.heappop(self._cron)
+            try:
+                self.do_async(rule.process_cron, 'cron {}'.format(expr.expr))
+            except:
+                LOG.exception('cron on rule %s', rule.name)
+            self.schedule_cron(rule, max(ts, now), arm=False)
+
+        self._arm_cron()
+
+    def init_for_triggers(self):
+        """
+        Arm timers of 'for' triggers from restored item change times. Triggers that have already
+        run out before restart are not fired again
+        """
+        for triggers in self._for_triggers.values():
+            for rule, t in triggers:
+                self.arm_for_trigger(rule, t)
+
+    def arm_for_trigger(self, rule, t):
+        """
+        Start timer when item is in target state, cancel it when item leaves it
+        """
+        item = self.items.get_item(t.item_id)
+        key = (rule, t)
+
+        if item is None or item.value != t.to or not item.changed:
+            rule.active = False
+            timer = self._for_timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            return
+
+        if key in self._for_timers or self.loop is None:
+            return
+
+        remaining = item.changed + t.for_ - clock.time()
+
+        if remaining > 0:
+            self._for_timers[key] = clock.call_later(self.loop, remaining, self._fire_for_trigger, rule, t)
 
-        self.run_cb(CB_ONCHECK, item, changed)
+    def _fire_for_trigger(self, rule, t):
+        self._for_timers.pop((rule, t), None)
+        item = self.items.get_item(t.item_id)
 
-        if changed or force:
-            self.run_cb(CB_ONCHANGE, name, item.value, old_value, age)
+        if item is None or item.value != t.to:
+            return
+
+        if item.changed + t.for_ - clock.time() > 0.01:
+            # item left and reentered the state inside one batch
+            self.arm_for_trigger(rule, t)
+            return
+
+        rule.active = True
+        try:
+            self.do_async(rule.process_item_for, item.name, item.value, int(item.age))
+        except:
+            LOG.exception('for trigger on rule %s', rule.name)
 
     def add_delayed(self, seconds, fn):
         if self.loop:
-            t = self.loop.time() + seconds
-            return self.loop.call_at(t, fn)
+            return clock.call_later(self.loop, seconds, fn)
 
     @staticmethod
     def remove_delayed(d):
@@ -94,6 +559,45 @@ class Context(object):
             d.cancel()
 
     def run_cb(self, name, *args):
-        for cb in self.callbacks.get(name, []):
-            if cb:
-                self.do_async(cb, *args)
+        self.run_batch_cb(name, [args])
+
+    def run_batch_cb(self, name, args_list):
+        for cb in self.callbacks.get(name, ()):
+            if cb.batch:
+                self._call(cb, (args_list,))
+            else:
+                for args in args_list:
+                    # single onchange callbacks keep (name, value, old_value, age) signature
+                    self._call(cb, args[:4] if isinstance(args, Change) else args)
+
+    def _call(self, cb, args):
+        if not cb.is_async:
+            try:
+                cb.fn(*args)
+            except:
+                LOG.exception('error in callback %s', cb.fn)
+            return
+
+        if cb.detached:
+            asyncio.ensure_future(cb.fn(*args), loop=self.loop)
+            return
+
+        self._pending.append((cb.priority, len(self._pending), cb.fn, args))
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, []
+        pending.sort()
+        asyncio.ensure_future(self._run_pending(pending), loop=self.loop)
+
+    @staticmethod
+    async def _run_pending(pending):
+        for _, _, fn, args in pending:
+            try:
+                await fn(*args)
+            except:
+                LOG.exception('error in callback %s', fn)
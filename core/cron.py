@@ -1,67 +1,148 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 name = '*cron*'
 
+# minute, hour, day, month, day of week (1 - monday, 7 - sunday)
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (1, 7))
 
-def check_cron_values(val, dt, last):
-    if isinstance(val, (tuple, list)):
-        for v in val:
-            if check_cron_value(v, dt):
-                return v
-        return None
+MAX_DAYS = 5 * 366
 
-    if isinstance(val, str):
-        return val if check_cron_value(val, dt) else None
+_cache = {}
 
 
-def check_cron_value(val, dt):
-    if isinstance(val, (dict, list)):
-        a = list(val)
-    elif isinstance(val, str):
-        a = val.split()
-    else:
-        raise Exception('invalid cron type: {}'.format(val))
-
-    if isinstance(dt, (int, float)):
-        dt = datetime.fromtimestamp(dt)
-
-    for c, v in zip(a, (dt.minute, dt.hour, dt.day, dt.month, dt.isoweekday())):
-        if not test_val(c, v):
+def parse_field(c, lo, hi):
+    """
+    Return bitset of allowed values
+    """
+    c = str(c).strip()
+
+    if c == '*':
+        return sum(1 << v for v in range(lo, hi + 1))
+
+    mask = 0
+
+    for s in [x.strip() for x in c.split(',') if x.strip()]:
+        if '/' in s:
+            r, n = s.split('/', 1)
+            n = int(n)
+            if n <= 0:
+                raise ValueError('invalid step in {}'.format(c))
+            if r == '*':
+                values = [v for v in range(lo, hi + 1) if v % n == 0]
+            else:
+                a, b = [int(x) for x in r.split('-', 1)]
+                values = range(a, b + 1, n)
+        elif '-' in s:
+            a, b = [int(x) for x in s.split('-', 1)]
+            values = range(a, b + 1)
+        else:
+            values = [int(s)]
+
+        for v in values:
+            if hi == 7 and v == 0:
+                # sunday
+                v = 7
+            if not lo <= v <= hi:
+                raise ValueError('value {} is out of range in {}'.format(v, c))
+            mask |= 1 << v
+
+    return mask
+
+
+class CronExpr(object):
+    """
+    Cron expression compiled to bitsets of minutes, hours, days, months and days of week.
+    Missing fields match any value.
+    """
+    __slots__ = ('expr', 'minutes', 'hours', 'days', 'months', 'weekdays')
+
+    def __init__(self, expr):
+        if isinstance(expr, (dict, list, tuple)):
+            parts = [str(x) for x in expr]
+        elif isinstance(expr, str):
+            parts = expr.split()
+        else:
+            raise ValueError('invalid cron type: {}'.format(expr))
+
+        if len(parts) > 5:
+            raise ValueError('invalid cron expression: {}'.format(expr))
+
+        parts += ['*'] * (5 - len(parts))
+        self.expr = ' '.join(parts)
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            parse_field(p, lo, hi) for p, (lo, hi) in zip(parts, FIELDS)]
+
+    def __repr__(self):
+        return 'CronExpr({})'.format(self.expr)
+
+    def match(self, dt):
+        if isinstance(dt, (int, float)):
+            dt = datetime.fromtimestamp(dt)
+
+        if not (self.minutes >> dt.minute & 1 and self.hours >> dt.hour & 1):
             return False
 
-    return True
+        return bool(self.days >> dt.day & 1 and self.months >> dt.month & 1 and self.weekdays >> dt.isoweekday() & 1)
 
+    def next_after(self, t):
+        """
+        Return timestamp of first matching minute after timestamp t, None if there is no one in 5 years
+        """
+        dt = datetime.fromtimestamp(t).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        end = dt + timedelta(days=MAX_DAYS)
 
-def test_val(c, v):
-    if c == '*':
-        return True
+        while dt < end:
+            if not self.months >> dt.month & 1:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+                continue
 
-    values = get_values(c)
+            if not (self.days >> dt.day & 1 and self.weekdays >> dt.isoweekday() & 1):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
 
-    for val in values:
-        if '/' in str(val):
-            _, n = val.split('/')
-            if int(v) % int(n) == 0:
-                return True
-        else:
-            if int(v) == int(val):
-                return True
-    return False
+            if not self.hours >> dt.hour & 1:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+                continue
+
+            if not self.minutes >> dt.minute & 1:
+                dt += timedelta(minutes=1)
+                continue
 
+            return dt.timestamp()
 
-def get_values(v):
-    res = []
+        return None
 
-    if ',' in v:
-        parsed = [x.strip() for x in v.split(',') if x.strip()]
-    else:
-        parsed = [v.strip(), ]
 
-    for s in parsed:
-        if '-' in s:
-            a, b = [int(x) for x in s.split('-', 1)]
-            res += range(a, b + 1)
-        else:
-            res.append(s)
+def compile_cron(val):
+    """
+    Return list of CronExpr from string or list of strings
+    """
+    if isinstance(val, (tuple, list)):
+        return [get_expr(v) for v in val]
+
+    return [get_expr(val)]
+
+
+def get_expr(val):
+    key = val if isinstance(val, str) else repr(val)
+    expr = _cache.get(key)
+
+    if expr is None:
+        expr = _cache[key] = CronExpr(val)
+
+    return expr
+
+
+def check_cron_values(val, dt, last):
+    if isinstance(val, (tuple, list)):
+        for v in val:
+            if check_cron_value(v, dt):
+                return v
+        return None
 
-    return res
+    if isinstance(val, str):
+        return val if check_cron_value(val, dt) else None
+
+
+def check_cron_value(val, dt):
+    return get_expr(val).match(dt)
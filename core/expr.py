@@ -0,0 +1,476 @@
+# coding: UTF-8
+
+"""
+Small safe expression language for `value_expr` of rule actions, a fast alternative to jinja for trivial
+value templates:
+
+    value|float * 1.8 + 32
+    'On' if value == 'Off' else 'Off'
+    max(item('temp_1'), item('temp_2')) - 0.5
+
+Expressions are parsed by Pratt parser straight to closures taking rule context dict, constant subexpressions
+are folded. There are no attributes, subscripts or imports, only rule context variables, literals, operators,
+filters and functions from the whitelist.
+"""
+
+import ast
+import logging
+import operator
+import re
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+VARIABLES = ('name', 'value', 'old_value', 'triggered', 'type')
+
+CONSTANTS = {'True': True, 'False': False, 'None': None, 'true': True, 'false': False, 'none': None}
+
+TOKEN_RE = re.compile(r'''\s*(?:(\d+\.\d*|\.\d+|\d+)|('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|([A-Za-z_]\w*)|'''
+                      r'''(//|==|!=|<=|>=|[-+*/%<>()\[\]|,~]))''')
+
+
+class ExprError(ValueError):
+    pass
+
+
+def _to_float(v, default=0.0):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return default
+
+
+def _to_int(v, default=0):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        try:
+            return int(float(v))
+        except (TypeError, ValueError):
+            return default
+
+
+def _default(v, default=''):
+    return default if v is None else v
+
+
+def _concat(a, b):
+    return '{}{}'.format(a, b)
+
+
+def _contains(a, b):
+    return a in b
+
+
+def _not_contains(a, b):
+    return a not in b
+
+
+# value|name(args) -> fn(value, *args), same defaults as jinja filters
+FILTERS = {
+    'float': _to_float,
+    'int': _to_int,
+    'round': round,
+    'abs': abs,
+    'string': str,
+    'lower': lambda v: str(v).lower(),
+    'upper': lambda v: str(v).upper(),
+    'default': _default,
+    'length': len,
+}
+
+FUNCTIONS = {
+    'min': min,
+    'max': max,
+    'abs': abs,
+    'round': round,
+    'float': _to_float,
+    'int': _to_int,
+    'str': str,
+    'len': len,
+    'bool': bool,
+}
+
+BINARY = {
+    '+': (6, operator.add),
+    '-': (6, operator.sub),
+    '~': (6, _concat),
+    '*': (7, operator.mul),
+    '/': (7, operator.truediv),
+    '//': (7, operator.floordiv),
+    '%': (7, operator.mod),
+}
+
+COMPARE = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': _contains,
+    'not in': _not_contains,
+}
+
+BP_TERNARY = 1
+BP_OR = 2
+BP_AND = 3
+BP_NOT = 4
+BP_COMPARE = 5
+BP_UNARY = 8
+BP_PIPE = 9
+
+
+def tokenize(source):
+    """
+    Return list of (kind, value, position), kind is num, str, name, op or end
+    """
+    res = []
+    pos = 0
+    source = source.rstrip()
+
+    while pos < len(source):
+        m = TOKEN_RE.match(source, pos)
+
+        if m is None:
+            raise ExprError('invalid character \'{}\' at {}'.format(source[pos:].lstrip()[:1], pos))
+
+        num, s, name, op = m.groups()
+        start = m.start(m.lastindex)
+
+        if num is not None:
+            res.append(('num', float(num) if '.' in num else int(num), start))
+        elif s is not None:
+            res.append(('str', ast.literal_eval(s), start))
+        elif name is not None:
+            res.append(('name', name, start))
+        else:
+            res.append(('op', op, start))
+
+        pos = m.end()
+
+    res.append(('end', None, pos))
+    return res
+
+
+class _Const(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, env):
+        return self.value
+
+
+def _fold(fn, args):
+    """
+    Closure calling fn with results of args, constant if all args are constant
+    """
+    if all(isinstance(x, _Const) for x in args):
+        try:
+            return _Const(fn(*[x.value for x in args]))
+        except Exception:
+            # error is raised on evaluation
+            pass
+
+    if len(args) == 1:
+        a, = args
+        return lambda env: fn(a(env))
+
+    if len(args) == 2:
+        a, b = args
+        if isinstance(b, _Const):
+            bv = b.value
+            return lambda env: fn(a(env), bv)
+        if isinstance(a, _Const):
+            av = a.value
+            return lambda env: fn(av, b(env))
+        return lambda env: fn(a(env), b(env))
+
+    args = tuple(args)
+    return lambda env: fn(*[x(env) for x in args])
+
+
+def _variable(name):
+    return lambda env: env.get(name)
+
+
+def _and(a, b):
+    if isinstance(a, _Const):
+        return b if a.value else a
+    return lambda env: a(env) and b(env)
+
+
+def _or(a, b):
+    if isinstance(a, _Const):
+        return a if a.value else b
+    return lambda env: a(env) or b(env)
+
+
+def _ternary(then, cond, else_):
+    if isinstance(cond, _Const):
+        return then if cond.value else else_
+    return lambda env: then(env) if cond(env) else else_(env)
+
+
+def _chain(first, ops):
+    """
+    Chained comparison a < b < c, every operand is evaluated once
+    """
+    ops = tuple(ops)
+
+    def fn(env):
+        left = first(env)
+        for op, right in ops:
+            r = right(env)
+            if not op(left, r):
+                return False
+            left = r
+        return True
+
+    return fn
+
+
+class Parser(object):
+    def __init__(self, source, functions):
+        self.source = source
+        self.functions = functions
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+    def parse(self):
+        res = self.expression(0)
+        kind, value, pos = self.tokens[self.pos]
+
+        if kind != 'end':
+            raise ExprError('unexpected \'{}\' at {}'.format(value, pos))
+
+        return res
+
+    def next(self):
+        t = self.tokens[self.pos]
+        self.pos += 1
+        return t
+
+    def peek(self, n=0):
+        return self.tokens[min(self.pos + n, len(self.tokens) - 1)]
+
+    def expect(self, value):
+        kind, v, pos = self.next()
+
+        if v != value or kind not in ('op', 'name'):
+            raise ExprError('expected \'{}\' at {}'.format(value, pos))
+
+    def lbp(self):
+        kind, value, _ = self.peek()
+
+        if kind == 'op':
+            if value in BINARY:
+                return BINARY[value][0]
+            if value in COMPARE:
+                return BP_COMPARE
+            if value == '|':
+                return BP_PIPE
+        elif kind == 'name':
+            if value == 'if':
+                return BP_TERNARY
+            if value == 'or':
+                return BP_OR
+            if value == 'and':
+                return BP_AND
+            if value == 'in' or (value == 'not' and self.peek(1)[1] == 'in'):
+                return BP_COMPARE
+
+        return 0
+
+    def expression(self, rbp):
+        left = self.nud(self.next())
+
+        while rbp < self.lbp():
+            left = self.led(self.next(), left)
+
+        return left
+
+    def nud(self, t):
+        kind, value, pos = t
+
+        if kind in ('num', 'str'):
+            return _Const(value)
+
+        if kind == 'name':
+            if value in CONSTANTS:
+                return _Const(CONSTANTS[value])
+
+            if value == 'not':
+                return _fold(operator.not_, [self.expression(BP_NOT)])
+
+            if self.peek()[1] == '(' and self.peek()[0] == 'op':
+                return self.call(value, pos)
+
+            if value in VARIABLES:
+                return _variable(value)
+
+            raise ExprError('unknown name \'{}\' at {}'.format(value, pos))
+
+        if kind == 'op':
+            if value == '(':
+                res = self.expression(0)
+                self.expect(')')
+                return res
+
+            if value == '[':
+                return _fold(lambda *args: args, self.arguments(']'))
+
+            if value == '-':
+                return _fold(operator.neg, [self.expression(BP_UNARY)])
+
+            if value == '+':
+                return _fold(operator.pos, [self.expression(BP_UNARY)])
+
+        raise ExprError('unexpected \'{}\' at {}'.format(value if kind != 'end' else 'end', pos))
+
+    def led(self, t, left):
+        kind, value, pos = t
+
+        if kind == 'op' and value in BINARY:
+            bp, fn = BINARY[value]
+            return _fold(fn, [left, self.expression(bp)])
+
+        if value == '|':
+            return self.pipe(left)
+
+        if value == 'if':
+            cond = self.expression(BP_TERNARY)
+            self.expect('else')
+            return _ternary(left, cond, self.expression(0))
+
+        if value == 'or':
+            return _or(left, self.expression(BP_OR))
+
+        if value == 'and':
+            return _and(left, self.expression(BP_AND))
+
+        # comparison, maybe chained
+        ops = []
+
+        while True:
+            if value == 'not':
+                self.next()
+                value = 'not in'
+            ops.append((COMPARE[value], self.expression(BP_COMPARE)))
+
+            if self.lbp() != BP_COMPARE:
+                break
+
+            _, value, _ = self.next()
+
+        if len(ops) == 1:
+            return _fold(ops[0][0], [left, ops[0][1]])
+
+        return _chain(left, ops)
+
+    def arguments(self, close):
+        args = []
+
+        if self.peek()[1] == close:
+            self.next()
+            return args
+
+        while True:
+            args.append(self.expression(0))
+            kind, value, pos = self.next()
+
+            if value == close:
+                return args
+
+            if value != ',':
+                raise ExprError('expected \',\' or \'{}\' at {}'.format(close, pos))
+
+    def call(self, name, pos):
+        fn = self.functions.get(name)
+
+        if fn is None:
+            raise ExprError('unknown function \'{}\' at {}'.format(name, pos))
+
+        self.next()
+        args = self.arguments(')')
+
+        if name in FUNCTIONS:
+            return _fold(fn, args)
+
+        # item values and history can change, never fold
+        args = tuple(args)
+        return lambda env: fn(*[x(env) for x in args])
+
+    def pipe(self, left):
+        kind, name, pos = self.next()
+        fn = FILTERS.get(name) if kind == 'name' else None
+
+        if fn is None:
+            raise ExprError('unknown filter \'{}\' at {}'.format(name, pos))
+
+        args = [left]
+
+        if self.peek()[1] == '(' and self.peek()[0] == 'op':
+            self.next()
+            args.extend(self.arguments(')'))
+
+        return _fold(fn, args)
+
+
+def compile_expr(source, functions=None):
+    """
+    Return function of rule context dict, raise ExprError on invalid expression
+    """
+    if not isinstance(source, str):
+        raise ExprError('expression must be string, not {}'.format(type(source).__name__))
+
+    fns = dict(FUNCTIONS)
+    fns.update(functions or {})
+
+    res = Parser(source, fns).parse()
+
+    if isinstance(res, _Const):
+        value = res.value
+        return lambda env: value
+
+    return res
+
+
+class Expressions(object):
+    """
+    Compiled expressions cached by source. Besides FUNCTIONS expressions can use item('name') and helpers
+    """
+
+    def __init__(self, items, helpers=None):
+        self.functions = dict(helpers or {})
+        self.functions['item'] = self._item_value
+        self.items = items
+        self._compiled = {}
+
+    def _item_value(self, name):
+        item = self.items.get_item(name)
+        return item.value if item is not None else None
+
+    def get(self, source):
+        fn = self._compiled.get(source)
+
+        if fn is None:
+            fn = self._compiled[source] = compile_expr(source, self.functions)
+
+        return fn
+
+    def compile(self, source):
+        """
+        Compile expression into cache, raise ValueError on syntax error
+        """
+        try:
+            self.get(source)
+        except ExprError as e:
+            raise ExprError('invalid expression \'{}\': {}'.format(source, e))
+
+    def evaluate(self, source, d):
+        return self.get(source)(d)
+
+    def to_dict(self):
+        return dict(size=len(self._compiled))
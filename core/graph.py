@@ -0,0 +1,147 @@
+# coding: UTF-8
+
+"""
+Static dependency graph of rules and items: which items trigger rules, which items rule conditions read
+and which items rule actions write. Rule -> rule edge means rule writes item triggering another rule.
+"""
+
+import logging
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+WRITE_SERVICES = ('set_state', 'command')
+
+
+def condition_items(c):
+    """
+    Return set of item names used by condition dict
+    """
+    res = set()
+
+    if not isinstance(c, dict):
+        return res
+
+    if c.get('item_id') is not None:
+        res.add(c['item_id'])
+
+    for x in c.get('conditions') or ():
+        res |= condition_items(x)
+
+    return res
+
+
+def rule_dependencies(rule):
+    """
+    Return (triggers, reads, writes) sets of item names of rule
+    """
+    triggers = set(t.item_id for t in rule.item_triggers)
+    reads = condition_items(rule.data.get('condition'))
+    writes = set()
+
+    for act in rule.data.get('action') or ():
+        if act.get('service') in WRITE_SERVICES and act.get('item_id') is not None:
+            writes.add(act['item_id'])
+        elif 'service' not in act:
+            reads |= condition_items(act.get('condition') if isinstance(act.get('condition'), dict) else act)
+
+    thermostat = rule.data.get('thermostat')
+    if thermostat:
+        writes.add(thermostat['actor_item'])
+
+    return triggers, reads, writes
+
+
+class DependencyGraph(object):
+    def __init__(self, rules):
+        self.rules = {}
+        self.triggers = {}
+        self.readers = {}
+        self.writers = {}
+
+        for rule in rules:
+            triggers, reads, writes = rule_dependencies(rule)
+            self.rules[rule.name] = (triggers, reads, writes)
+
+            for name in triggers:
+                self.triggers.setdefault(name, []).append(rule.name)
+            for name in reads:
+                self.readers.setdefault(name, []).append(rule.name)
+            for name in writes:
+                self.writers.setdefault(name, []).append(rule.name)
+
+        self.edges = {}
+
+        for name, (_, _, writes) in self.rules.items():
+            nxt = set()
+            for item in writes:
+                nxt.update(self.triggers.get(item, ()))
+            self.edges[name] = sorted(nxt)
+
+    def affected(self, item):
+        """
+        Return rules that can be fired by item change with min cascade depth and rules reading item in conditions
+        """
+        depth = {}
+        front = list(self.triggers.get(item, ()))
+        n = 1
+
+        while front:
+            nxt = []
+            for name in front:
+                if name in depth:
+                    continue
+                depth[name] = n
+                nxt.extend(self.edges.get(name, ()))
+            front = nxt
+            n += 1
+
+        return dict(item=item,
+                    triggered=[dict(rule=k, depth=v) for k, v in sorted(depth.items(), key=lambda x: (x[1], x[0]))],
+                    conditions=sorted(set(self.readers.get(item, ()))),
+                    written_by=sorted(set(self.writers.get(item, ()))))
+
+    def cycles(self):
+        """
+        Return list of rule loops (strongly connected components), Tarjan's algorithm
+        """
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        res = []
+        counter = [0]
+
+        def visit(v):
+            index[v] = low[v] = counter[0]
+            counter[0] += 1
+            stack.append(v)
+            on_stack.add(v)
+
+            for w in self.edges.get(v, ()):
+                if w not in index:
+                    visit(w)
+                    low[v] = min(low[v], low[w])
+                elif w in on_stack:
+                    low[v] = min(low[v], index[w])
+
+            if low[v] == index[v]:
+                comp = []
+                while True:
+                    w = stack.pop()
+                    on_stack.discard(w)
+                    comp.append(w)
+                    if w == v:
+                        break
+                if len(comp) > 1 or v in self.edges.get(v, ()):
+                    res.append(sorted(comp))
+
+        for v in sorted(self.edges):
+            if v not in index:
+                visit(v)
+
+        return res
+
+    def to_dict(self):
+        return dict(rules={k: dict(triggers=sorted(t), reads=sorted(r), writes=sorted(w), fires=self.edges[k])
+                           for k, (t, r, w) in self.rules.items()},
+                    cycles=self.cycles())
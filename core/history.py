@@ -0,0 +1,152 @@
+# coding: UTF-8
+
+import bisect
+import logging
+from array import array
+
+from core import clock
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+DEFAULT_SIZE = 2880
+
+
+class History(object):
+    """
+    Fixed size ring buffer of (timestamp, value) pairs.
+    Buffers are allocated once, append only overwrites slots.
+    """
+    __slots__ = ('size', 'times', 'values', 'pos', 'count')
+
+    def __init__(self, size=DEFAULT_SIZE):
+        if size <= 0:
+            raise ValueError('invalid history size {}'.format(size))
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t, v):
+        pos = self.pos
+        self.times[pos] = t
+        self.values[pos] = v
+        pos += 1
+        self.pos = 0 if pos == self.size else pos
+        if self.count < self.size:
+            self.count += 1
+
+    def _ordered(self):
+        if self.count < self.size:
+            return self.times[:self.count], self.values[:self.count]
+        pos = self.pos
+        return self.times[pos:] + self.times[:pos], self.values[pos:] + self.values[:pos]
+
+    def window(self, window=None, now=None):
+        """
+        Return (times, values) arrays for last `window` seconds, oldest first
+        """
+        times, values = self._ordered()
+
+        if window is None:
+            return times, values
+
+        if now is None:
+            now = clock.time()
+
+        i = bisect.bisect_left(times, now - window)
+        return times[i:], values[i:]
+
+    def stats(self, window=None, now=None, percentiles=()):
+        times, values = self.window(window, now)
+
+        if not values:
+            return {'count': 0}
+
+        res = {'count': len(values),
+               'from': times[0],
+               'to': times[-1],
+               'min': min(values),
+               'max': max(values),
+               'avg': sum(values) / len(values),
+               'last': values[-1],
+               'rate': rate(times, values)}
+
+        if percentiles:
+            s = sorted(values)
+            res['percentiles'] = {str(p): percentile(s, p) for p in percentiles}
+
+        return res
+
+    def percentile(self, p, window=None, now=None):
+        _, values = self.window(window, now)
+        return percentile(sorted(values), p) if values else None
+
+
+def percentile(s, p):
+    """
+    Linear interpolated percentile of sorted sequence
+    """
+    if not 0 <= p <= 100:
+        raise ValueError('invalid percentile {}'.format(p))
+
+    k = (len(s) - 1) * p / 100.0
+    f = int(k)
+
+    if f == len(s) - 1:
+        return s[f]
+
+    return s[f] + (s[f + 1] - s[f]) * (k - f)
+
+
+def rate(times, values):
+    """
+    Average change per second
+    """
+    if len(values) < 2 or times[-1] == times[0]:
+        return 0.0
+
+    return (values[-1] - values[0]) / (times[-1] - times[0])
+
+
+def read_history(d):
+    if not d:
+        return None
+
+    if isinstance(d, dict):
+        return History(int(d.get('size', DEFAULT_SIZE)))
+
+    if d is True:
+        return History()
+
+    return History(int(d))
+
+
+def template_helpers(items):
+    def _stats(name, window=None):
+        item = items.get_item(name)
+        if item is None or item.history is None:
+            return None
+        return item.history.stats(window)
+
+    def _get(key):
+        def fn(name, window=None):
+            s = _stats(name, window)
+            return s.get(key) if s else None
+        return fn
+
+    def _percentile(name, p, window=None):
+        item = items.get_item(name)
+        if item is None or item.history is None:
+            return None
+        return item.history.percentile(p, window)
+
+    return {'history': _stats,
+            'history_min': _get('min'),
+            'history_max': _get('max'),
+            'history_avg': _get('avg'),
+            'history_rate': _get('rate'),
+            'history_percentile': _percentile}
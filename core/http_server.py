@@ -2,9 +2,12 @@ import asyncio
 import json
 import logging
 import os
+import time
 
 from aiohttp import web
 
+from core.commands import PRIO_INTERACTIVE
+
 BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 LOG = logging.getLogger('mahno.' + __name__)
 
@@ -23,7 +26,7 @@ class WebSocket(web.View):
                 if ';' in msg:
                     tag, name, cmd = msg.split(';')
                     self.request.app['websockets'][h]['tag'] = tag
-                    self.request.app.context.item_command(name, cmd)
+                    self.request.app.context.item_command(name, cmd, PRIO_INTERACTIVE)
                 else:
                     self.request.app['websockets'][h]['tag'] = msg
                     LOG.info('got tag %s for %s', msg, h)
@@ -54,12 +57,26 @@ class Server(web.Application):
         self.router.add_route('GET', '/items/{name}/', self.get_item)
         self.router.add_route('GET', '/items/{name}/value', self.get_item_value)
         self.router.add_route('GET', '/items/{name}/value/', self.get_item_value)
+        self.router.add_route('GET', '/items/{name}/history', self.get_item_history)
+        self.router.add_route('GET', '/items/{name}/history/', self.get_item_history)
+        self.router.add_route('GET', '/items/{name}/archive', self.get_item_archive)
+        self.router.add_route('GET', '/items/{name}/archive/', self.get_item_archive)
         self.router.add_route('PUT', '/items/{name}', self.put_item)
         self.router.add_route('PUT', '/items/{name}/', self.put_item)
         self.router.add_route('POST', '/items/{name}', self.post_item)
         self.router.add_route('POST', '/items/{name}/', self.post_item)
         self.router.add_route('GET', '/rules', self.get_rules)
         self.router.add_route('GET', '/rules/', self.get_rules)
+        self.router.add_route('GET', '/rules/stats', self.get_rules_stats)
+        self.router.add_route('GET', '/rules/stats/', self.get_rules_stats)
+        self.router.add_route('DELETE', '/rules/stats', self.reset_rules_stats)
+        self.router.add_route('DELETE', '/rules/stats/', self.reset_rules_stats)
+        self.router.add_route('GET', '/rules/graph', self.get_rules_graph)
+        self.router.add_route('GET', '/rules/graph/', self.get_rules_graph)
+        self.router.add_route('GET', '/commands', self.get_commands)
+        self.router.add_route('GET', '/commands/', self.get_commands)
+        self.router.add_route('GET', '/templates', self.get_templates)
+        self.router.add_route('GET', '/templates/', self.get_templates)
 
     def get_app(self, config, loop):
         LOG.info('server on port %s', config['server']['port'])
@@ -69,6 +86,9 @@ class Server(web.Application):
         headers = {'Content-Type': 'application/json'}
         return web.Response(body=json.dumps(s).encode('UTF-8'), headers=headers)
 
+    def json_text_resp(self, s):
+        return web.Response(body=s.encode('UTF-8'), content_type='application/json')
+
     def resp_404(self, s):
         return web.Response(body=s.encode('UTF-8'), status=404)
 
@@ -80,14 +100,14 @@ class Server(web.Application):
 
     async def get_items(self, request):
         tag = request.match_info.get('tag')
-        return self.json_resp(self.context.items.as_list(tag))
+        return self.json_text_resp(self.context.items.as_json(tag))
 
     async def get_item(self, request):
         name = request.match_info['name']
         item = self.context.items.get_item(name)
         if not item:
             return self.resp_404('item %s not found' % name)
-        return self.json_resp(item.to_dict())
+        return self.json_text_resp(item.to_json())
 
     async def get_item_value(self, request):
         name = request.match_info['name']
@@ -96,6 +116,44 @@ class Server(web.Application):
             return self.resp_404('item %s not found' % name)
         return web.Response(body=str(item.value).encode('UTF-8'))
 
+    async def get_item_history(self, request):
+        name = request.match_info['name']
+        item = self.context.items.get_item(name)
+        if not item:
+            return self.resp_404('item %s not found' % name)
+        if item.history is None:
+            return self.resp_404('no history for item %s' % name)
+
+        try:
+            window = float(request.query['window']) if 'window' in request.query else None
+            percentiles = [float(x) for x in request.query.get('percentiles', '').split(',') if x]
+            res = item.history.stats(window, percentiles=percentiles)
+        except ValueError as e:
+            return web.Response(body=str(e).encode('UTF-8'), status=400)
+
+        if request.query.get('points'):
+            times, values = item.history.window(window)
+            res['points'] = list(zip(times, values))
+
+        return self.json_resp(res)
+
+    async def get_item_archive(self, request):
+        name = request.match_info['name']
+        if self.context.archive is None:
+            return self.resp_404('archive is not configured')
+        if not self.context.items.get_item(name):
+            return self.resp_404('item %s not found' % name)
+
+        try:
+            end = float(request.query.get('to', time.time()))
+            start = float(request.query.get('from', end - 24 * 3600))
+            step = float(request.query['step']) if 'step' in request.query else None
+        except ValueError as e:
+            return web.Response(body=str(e).encode('UTF-8'), status=400)
+
+        res = await self.context.loop.run_in_executor(None, self.context.archive.query, name, start, end, step)
+        return self.json_resp(res)
+
     async def put_item(self, request):
         name = request.match_info['name']
         item = self.context.items.get_item(name)
@@ -111,7 +169,7 @@ class Server(web.Application):
         if not item:
             return self.resp_404('')
         val = await request.content.read()
-        self.context.item_command(name, val.decode('utf-8'))
+        self.context.item_command(name, val.decode('utf-8'), PRIO_INTERACTIVE)
         return self.json_resp(item.to_dict())
 
     async def get_rules(self, request):
@@ -121,19 +179,60 @@ class Server(web.Application):
 
         return self.json_resp(res)
 
-    async def on_check(self, item, changed):
-        s = json.dumps(item.to_dict())
+    async def get_rules_stats(self, request):
+        return self.json_resp({r.name: r.stats.to_dict() for r in self.context.rules})
+
+    async def reset_rules_stats(self, request):
+        name = request.query.get('name')
+
+        for r in self.context.rules:
+            if name is None or r.name == name:
+                r.stats.reset()
+
+        return self.json_resp({'ok': True})
+
+    async def get_rules_graph(self, request):
+        if request.query.get('item'):
+            return self.json_resp(self.context.graph.affected(request.query['item']))
+
+        return self.json_resp(self.context.graph.to_dict())
+
+    async def get_commands(self, request):
+        return self.json_resp([q.to_dict() for q in self.context.queues.values()])
+
+    async def get_templates(self, request):
+        return self.json_resp(dict(self.context.templates.to_dict(), expressions=self.context.expressions.to_dict()))
+
+    async def on_check(self, checks):
+        """
+        Send one frame per client: item object for single item or list for batch
+        """
+        json_cache = {}
+
         for ws in self['websockets'].values():
-            if ws['tag'] and ws['tag'] in item.tags:
-                try:
-                    await ws['ws'].send_str(s)
-                except:
-                    pass
+            if not ws['tag']:
+                continue
+
+            data = []
+            for item, _ in checks:
+                if ws['tag'] in item.tags:
+                    if item.name not in json_cache:
+                        json_cache[item.name] = item.to_json()
+                    data.append(json_cache[item.name])
+
+            if not data:
+                continue
+
+            s = data[0] if len(data) == 1 else '[' + ', '.join(data) + ']'
+            try:
+                await ws['ws'].send_str(s)
+            except:
+                pass
 
 
 def get_app(context, config, loop):
     s = Server(loop=loop)
     s.context = context
     s.init()
-    context.add_cb('oncheck', s.on_check)
+    context.add_cb('oncheck', s.on_check, batch=True, priority=10)
     return s.get_app(config, loop)
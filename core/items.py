@@ -1,12 +1,15 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import bisect
+import json
 import logging
 import time
 from datetime import datetime, date
-from operator import attrgetter
 
-from core import functions
+from core import clock, functions
+from core.history import read_history
+from core.topics import TopicTrie
 
 LOG = logging.getLogger('mahno.' + __name__)
 
@@ -16,34 +19,125 @@ ON = 'On'
 OFF = 'Off'
 
 
+def input_key(inp):
+    """
+    Return (channel, key) used to index item input
+    """
+    if not inp:
+        return None, None
+
+    if isinstance(inp, str):
+        return inp, None
+
+    channel = inp.get('channel')
+
+    if 'topic' in inp:
+        return channel, inp['topic']
+
+    if 'reg' in inp:
+        return channel, (inp.get('fn'), inp.get('addr'), inp['reg'])
+
+    return channel, None
+
+
 class Items(object):
     def __init__(self):
-        self._items = []
+        self._items = {}
+        self._names = []
+        self._sorted = []
+        self._tags = {}
+        self._inputs = {}
+        # channel -> trie of items with input topic
+        self._topics = {}
 
     def __iter__(self):
-        for s in self._items:
+        for s in self._sorted:
             yield s
 
     def add_item(self, s):
-        assert not self.get_item(s.name), "already have this item"
-        self._items.append(s)
+        assert s.name not in self._items, "already have this item"
+        self._items[s.name] = s
+
+        self._insort(self._names, self._sorted, s)
+
+        for tag in getattr(s, 'tags', None) or []:
+            names, items = self._tags.setdefault(tag, ([], []))
+            self._insort(names, items, s)
+
+        key = input_key(getattr(s, 'input', None))
+        if key[0] is not None:
+            self._inputs.setdefault(key, []).append(s)
+
+        if isinstance(key[1], str):
+            self._topics.setdefault(key[0], TopicTrie()).add(key[1], s)
+
+    @staticmethod
+    def _insort(names, items, s):
+        i = bisect.bisect(names, s.name)
+        names.insert(i, s.name)
+        items.insert(i, s)
+
+    def remove_item(self, name):
+        """
+        Remove item from all indexes, return removed item or None
+        """
+        s = self._items.pop(name, None)
+
+        if s is None:
+            return None
+
+        self._remove_sorted(self._names, self._sorted, name)
+
+        for tag in getattr(s, 'tags', None) or []:
+            names, items = self._tags[tag]
+            self._remove_sorted(names, items, name)
+            if not names:
+                del self._tags[tag]
+
+        key = input_key(getattr(s, 'input', None))
+        if key[0] is not None:
+            items = self._inputs[key]
+            items.remove(s)
+            if not items:
+                del self._inputs[key]
+
+        if isinstance(key[1], str):
+            self._topics[key[0]].remove(key[1], lambda x: x is s)
+
+        return s
+
+    @staticmethod
+    def _remove_sorted(names, items, name):
+        i = bisect.bisect_left(names, name)
+        del names[i]
+        del items[i]
 
     @property
     def num(self):
         return len(self._items)
 
     def get_item(self, name):
-        for s in self._items:
-            if s.name == name:
-                return s
-        return None
+        return self._items.get(name)
+
+    def get_by_tag(self, tag):
+        return self._tags.get(tag, ((), ()))[1]
+
+    def get_by_input(self, channel, key=None):
+        return self._inputs.get((channel, key), ())
+
+    def get_by_topic(self, channel, topic):
+        """
+        Items with input topic of channel matching topic, input topics can have + and # wildcards
+        """
+        trie = self._topics.get(channel)
+        return trie.match(topic) if trie is not None else ()
 
     def set_item_value(self, name, value):
         """
         Return true if item changed
         """
 
-        item = self.get_item(name)
+        item = self._items.get(name)
 
         if not item:
             raise Exception('not found item %s' % name)
@@ -52,59 +146,97 @@ class Items(object):
 
     def as_list(self, tag=None):
         if tag:
-            return [x.to_dict() for x in sorted(self._items, key=attrgetter('name')) if tag in x.tags]
+            return [x.to_dict() for x in self.get_by_tag(tag)]
         else:
-            return [x.to_dict() for x in sorted(self._items, key=attrgetter('name'))]
+            return [x.to_dict() for x in self._sorted]
+
+    def as_json(self, tag=None):
+        items = self.get_by_tag(tag) if tag else self._sorted
+        return '[' + ', '.join(x.to_json() for x in items) + ']'
 
     def value_is(self, name, val):
-        return self.get_item(name) and self.get_item(name).value == val
+        item = self._items.get(name)
+        return item is not None and item.value == val
 
     def __str__(self):
         return self.as_list()
 
 
+ITEM_TYPES = {}
+
+
 def read_item(d):
-    item = None
-    if d['type'] == 'switch':
-        item = SwitchItem(d['name'])
-    if d['type'] == 'number':
-        item = NumberItem(d['name'])
-    if d['type'] == 'text':
-        item = TextItem(d['name'])
-    if d['type'] == 'date':
-        item = DateItem(d['name'])
-    if d['type'] == 'select':
-        item = SelectItem(d['name'])
-    if item:
-        item.config = d
-        item.input = d.get('input')
-        item.output = d.get('output')
-        item.ttl = d.get('ttl', 0)
-        item.ui = bool(d.get('ui', False))
-        item.tags = d.get('tags', [])
-        if 'default' in d:
-            item.set_value(d['default'])
+    cls = ITEM_TYPES.get(d['type'])
+    if cls is None:
+        return None
+    item = cls(d['name'])
+    item.configure(d)
+    if 'default' in d:
+        item.set_value(d['default'])
     return item
 
 
 class Item(object):
-    input = None
-    output = None
-    ttl = 0
-    ui = False
-    tags = []
-    config = {}
+    __slots__ = ('name', '_value', 'checked', 'changed', 'ttl', 'ui', 'tags', 'input', 'output',
+                 'fast_change', 'format', '_formatter', '_h_name', 'history', 'value', 'expires', 'version',
+                 '_cache')
 
     def __init__(self, name, value=None, ttl=None):
         self.name = name
-        if ttl is not None:
-            self.ttl = ttl
+        self.ttl = ttl or 0
+        self.ui = False
+        self.tags = []
+        self.input = None
+        self.output = None
+        self.fast_change = False
+        self.format = None
+        self._formatter = None
+        self._h_name = None
+        self.history = None
+        self.expires = 0
+        self.version = 0
+        self._cache = None
+        self._value = None
+        self.value = None
+        self.checked = 0
+        self.changed = 0
         if value is not None:
             self.set_value(value)
-        else:
-            self._value = None
-            self.checked = 0
-            self.changed = 0
+
+    def configure(self, d):
+        """
+        Take only used fields from yaml item config
+        """
+        self.input = d.get('input')
+        self.output = d.get('output')
+        self.ttl = d.get('ttl', 0)
+        self.ui = bool(d.get('ui', False))
+        self.tags = d.get('tags', [])
+        self.fast_change = bool(d.get('fast_change', False))
+        self.format = d.get('format')
+        self._formatter = getattr(functions, self.format, None) if self.format else None
+        if not callable(self._formatter):
+            self._formatter = None
+        self._h_name = d.get('h_name')
+        history = read_history(d.get('history'))
+        if history is None or self.history is None or history.size != self.history.size:
+            # same size buffer is kept with its values on reload
+            self.history = history
+        self.version += 1
+
+    @property
+    def config(self):
+        d = {'name': self.name, 'ttl': self.ttl, 'ui': self.ui, 'tags': self.tags}
+        for k in ('input', 'output', 'format'):
+            if getattr(self, k) is not None:
+                d[k] = getattr(self, k)
+        if self.fast_change:
+            d['fast_change'] = True
+        if self._h_name:
+            d['h_name'] = self._h_name
+        if self.history is not None:
+            d['history'] = {'size': self.history.size}
+        return d
 
     def __str__(self):
         return "%s is %s for %s seconds" % (self.name, self._value, self.age)
@@ -112,15 +244,12 @@ class Item(object):
     def __getitem__(self, item):
         return getattr(self, item)
 
-    def to_dict(self):
+    def _static_dict(self):
         return {'name': self.name,
                 'class': self.__class__.__name__,
                 'ttl': self.ttl,
                 'value': self.value,
                 '_value': self._value,
-                'age': self.age,
-                'check_age': self.check_age,
-                'checked': self.checked,
                 'changed': self.changed,
                 'tags': self.tags,
                 'formatted': self.formatted,
@@ -128,20 +257,48 @@ class Item(object):
                 'ui': self.ui,
                 }
 
+    def overlay(self):
+        """
+        Fields changed without version change
+        """
+        return {'checked': self.checked,
+                'age': self.age,
+                'check_age': self.check_age}
+
+    def _cached(self):
+        """
+        Return (version, dict, json head) for current version. Json head is object without closing brace
+        """
+        if self._cache is None or self._cache[0] != self.version:
+            d = self._static_dict()
+            self._cache = (self.version, d, json.dumps(d)[:-1])
+        return self._cache
+
+    def to_dict(self):
+        d = dict(self._cached()[1])
+        d.update(self.overlay())
+        return d
+
+    def to_json(self):
+        return self._cached()[2] + self._json_overlay()
+
+    def _json_overlay(self):
+        return ', "checked": %r, "age": %r, "check_age": %r}' % (self.checked, self.age, self.check_age)
+
     def is_value(self, st, for_time=1.0):
         return self._value == st and self.age >= for_time
 
     @property
     def age(self):
         if self.changed:
-            return time.time() - self.changed
+            return clock.time() - self.changed
         else:
             return -1
 
     @property
     def check_age(self):
         if self.checked:
-            return time.time() - self.checked
+            return clock.time() - self.checked
         else:
             return -1
 
@@ -149,71 +306,128 @@ class Item(object):
     def is_fresh(self):
         return self.check_age != -1 and (self.ttl == 0 or self.check_age <= self.ttl)
 
-    @property
-    def value(self):
-        return self._value if self.is_fresh else None
+    def expire(self):
+        """
+        Called by expiry scheduler when ttl is over. Return true if value was fresh
+        """
+        if self.value is None:
+            return False
+        LOG.info('%s is expired', self.name)
+        self.value = None
+        self.version += 1
+        return True
+
+    def restore(self, value, checked, changed):
+        self._value = self.convert_value(value) if value is not None else None
+        self.checked = checked
+        self.changed = changed
+        self.value = self._value if self.is_fresh else None
+        self.version += 1
 
     def set_value(self, value):
         val = self.convert_value(value)
-        self.checked = time.time()
+        self.checked = clock.time()
 
-        if val is not None and self._value != val:
-            LOG.info('%s changed from %s to %s', self.name, self._value, val)
+        if self.history is not None and val is not None:
+            v = self.to_number(val)
+            if v is not None:
+                self.history.append(self.checked, v)
+
+        if val is not None and (self._value != val or self.value is None):
+            LOG.info('%s changed from %s to %s', self.name, self.value, val)
             self._value = val
-            self.changed = time.time()
+            self.value = val
+            self.changed = clock.time()
+            self.version += 1
             return True
         else:
+            if self.value is None and self._value is not None:
+                # fresh again after expiry
+                self.version += 1
+            self.value = self._value
             return False
 
     def convert_value(self, val):
         return val
 
+    @staticmethod
+    def to_number(val):
+        """
+        Value as float for history, None if value is not numeric
+        """
+        try:
+            return float(val)
+        except (TypeError, ValueError):
+            return None
+
     def command(self, cmd):
-        if not self.config.get('output'):
+        if not self.output:
             self.set_value(cmd)
 
     @property
     def formatted(self):
         if self.value is None:
             return None
-        frm = self.config.get('format')
-        if frm:
-            if frm in dir(functions):
-                return getattr(functions, frm)(self.value)
-            else:
-                return frm.format(self.value)
-        else:
-            return self.value
+        if self._formatter is not None:
+            return self._formatter(self.value)
+        if self.format:
+            return self.format.format(self.value)
+        return self.value
 
     @property
     def h_name(self):
-        return self.config.get('h_name') or self.name
+        return self._h_name or self.name
 
 
 class TextItem(Item):
+    __slots__ = ()
+
     def convert_value(self, val):
         return val
 
 
 class NumberItem(Item):
+    __slots__ = ('decimals',)
+
+    def __init__(self, name, value=None, ttl=None):
+        self.decimals = None
+        Item.__init__(self, name, value, ttl)
+
+    def configure(self, d):
+        Item.configure(self, d)
+        self.decimals = d.get('decimals')
+
+    @property
+    def config(self):
+        d = Item.config.fget(self)
+        if self.decimals is not None:
+            d['decimals'] = self.decimals
+        return d
+
     def convert_value(self, val):
         if val is None:
             return None
 
         v = float(val)
 
-        if self.config.get('decimals'):
-            d = self.config['decimals']
+        if self.decimals:
+            d = self.decimals
             if d == 0:
                 return int(v)
             else:
-                n = pow(10, self.config['decimals'])
+                n = pow(10, self.decimals)
                 return int(v * n) / float(n)
 
         return v
 
 
 class SwitchItem(Item):
+    __slots__ = ()
+
+    @staticmethod
+    def to_number(val):
+        return 1.0 if val == ON else 0.0
+
     def convert_value(self, val):
         if str(val).lower() in ('click', 'switch'):
             return ON if self._value == OFF else OFF
@@ -222,15 +436,46 @@ class SwitchItem(Item):
 
 
 class SelectItem(Item):
+    __slots__ = ('choices',)
+
+    def __init__(self, name, value=None, ttl=None):
+        self.choices = []
+        Item.__init__(self, name, value, ttl)
+
+    def configure(self, d):
+        Item.configure(self, d)
+        self.choices = d['choices']
+
+    @property
+    def config(self):
+        d = Item.config.fget(self)
+        d['choices'] = self.choices
+        return d
+
     def convert_value(self, val):
         nv = str(val).lower()
-        for v in self.config['choices']:
+        for v in self.choices:
             if v.lower() == nv:
                 return v
         return None
 
 
 class DateItem(Item):
+    __slots__ = ()
+
+    def _static_dict(self):
+        d = Item._static_dict(self)
+        del d['formatted']
+        return d
+
+    def overlay(self):
+        d = Item.overlay(self)
+        d['formatted'] = self.formatted
+        return d
+
+    def _json_overlay(self):
+        return ', "formatted": %s' % json.dumps(self.formatted) + Item._json_overlay(self)
+
     def convert_value(self, val):
         if isinstance(val, (datetime, date)):
             return time.mktime(val.timetuple())
@@ -241,9 +486,18 @@ class DateItem(Item):
         if self.value is None:
             return None
 
-        now = datetime.now()
+        now = clock.now()
         d = datetime.fromtimestamp(self.value)
         if now.date() == d.date():
             return d.strftime('%H:%M')
         else:
             return d.strftime('%d.%m %H:%M')
+
+
+ITEM_TYPES.update({
+    'switch': SwitchItem,
+    'number': NumberItem,
+    'text': TextItem,
+    'date': DateItem,
+    'select': SelectItem,
+})
@@ -0,0 +1,142 @@
+# coding: UTF-8
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from core.snapshot import SnapshotWriter, item_state, read_snapshot
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+_COMPACT = object()
+_STOP = object()
+
+
+def read_journal(fn):
+    """
+    Yield (name, type, value, checked, changed) records. Broken tail after crash is skipped
+    """
+    if not os.path.isfile(fn):
+        return
+
+    with open(fn, 'r', encoding='UTF-8') as f:
+        for n, line in enumerate(f):
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                LOG.warning('broken journal record %s at line %s', line.strip(), n + 1)
+                continue
+
+            if len(rec) == 4:
+                # record without type
+                rec.insert(1, '')
+            yield tuple(rec)
+
+
+def replay(journal_fn, snapshot_fn):
+    """
+    Return dict name -> (name, type, value, checked, changed) from snapshot and journal on top of it
+    """
+    state = {x[0]: x for x in read_snapshot(snapshot_fn)}
+
+    for rec in read_journal(journal_fn):
+        state[rec[0]] = rec
+
+    return state
+
+
+class Journal(object):
+    """
+    Append only journal of item changes. Records are written and fsynced by background thread,
+    compaction updates binary snapshot with dirty items and truncates the journal.
+    """
+
+    def __init__(self, journal_fn, snapshot_fn, fsync_interval=1.0):
+        self.journal_fn = journal_fn
+        self.snapshot_fn = snapshot_fn
+        self.fsync_interval = fsync_interval
+        self.writer = SnapshotWriter(snapshot_fn)
+        self.written = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._f = None
+
+    def start(self):
+        self._f = open(self.journal_fn, 'a', encoding='UTF-8')
+        self._thread = threading.Thread(target=self._worker, name='journal', daemon=True)
+        self._thread.start()
+
+    def stop(self, states=None, names=None):
+        """
+        Stop writer thread, write final snapshot if states given
+        """
+        if self._thread is None:
+            return
+
+        if states is not None:
+            self.compact(states, names)
+
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def record(self, item):
+        self._queue.put(item_state(item))
+
+    def on_change(self, changes, items):
+        for ch in changes:
+            item = items.get_item(ch.name)
+            if item is not None:
+                self.record(item)
+
+    def compact(self, states, names=None):
+        """
+        Save states of dirty items to snapshot. Items not in names are removed from snapshot
+        """
+        self._queue.put((_COMPACT, states, names))
+
+    def _worker(self):
+        last_sync = time.time()
+        dirty = False
+
+        while True:
+            try:
+                rec = self._queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                rec = None
+
+            if rec is _STOP:
+                self._sync()
+                self._f.close()
+                return
+
+            try:
+                if rec is not None and rec[0] is _COMPACT:
+                    self._compact(rec[1], rec[2])
+                    dirty = False
+                elif rec is not None:
+                    self._f.write(json.dumps(rec, default=str))
+                    self._f.write('\n')
+                    self.written += 1
+                    dirty = True
+
+                if dirty and time.time() - last_sync >= self.fsync_interval:
+                    self._sync()
+                    last_sync = time.time()
+                    dirty = False
+            except:
+                LOG.exception('journal write error')
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def _compact(self, states, names):
+        self._sync()
+        self.writer.save(states, names)
+        self._f.truncate(0)
+        self._f.seek(0)
+        LOG.info('journal compacted, %s of %s items updated in snapshot', len(states), len(self.writer.records))
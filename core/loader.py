@@ -0,0 +1,300 @@
+# coding: UTF-8
+
+"""
+Incremental loader of items_*.yml and rules_*.yml. Only files with changed mtime and content are parsed,
+items and rules are diffed by name: unchanged rules are kept, changed items are reconfigured in place
+with their values, rules depending on added, removed or replaced items are recompiled.
+"""
+
+import hashlib
+import logging
+import os
+
+import yaml
+
+from core.items import read_item
+from core.rules import Rule, ThermostatRule
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+
+def make_rule(r):
+    if 'trigger' in r:
+        return Rule(r)
+    if 'thermostat' in r:
+        return ThermostatRule(r)
+    return None
+
+
+class ConfigFile(object):
+    __slots__ = ('fn', 'mtime', 'size', 'digest', 'defs', 'pending')
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.mtime = 0
+        self.size = -1
+        self.digest = None
+        self.defs = {}
+        # (mtime, size, digest) of parsed content, saved when all its definitions are applied
+        self.pending = None
+
+
+class Loader(object):
+    def __init__(self, context, conf_dir):
+        self.context = context
+        self.conf_dir = conf_dir
+        self.files = {}
+        # name -> (file name, definition)
+        self.item_defs = {}
+        self.rule_defs = {}
+        self.rules = {}
+        self._recompile = set()
+
+    def reload(self):
+        """
+        Apply changed items files, then rules files. Return (items changed, rules changed) counts
+        """
+        names = sorted(os.listdir(self.conf_dir))
+        items_files = [s for s in names if s.startswith('items_') and s.endswith('.yml')]
+        rules_files = [s for s in names if s.startswith('rules_') and s.endswith('.yml')]
+
+        changed_items = self._changed(items_files, 'items_')
+        changed_rules = self._changed(rules_files, 'rules_')
+
+        affected = set()
+        n_items = self._apply(changed_items, self.item_defs, self._update_item, affected) if changed_items else 0
+
+        # rules with conditions compiled with added, removed or replaced items
+        recompile = self._recompile = set()
+        for name in affected:
+            recompile.update(self.context.graph.readers.get(name, ()))
+
+        n_rules = self._apply(changed_rules, self.rule_defs, self._update_rule, None) if changed_rules else 0
+
+        for name in recompile:
+            rule = self.rules.get(name)
+            if rule is not None:
+                try:
+                    rule.compile(self.context)
+                except Exception:
+                    LOG.exception('can\'t recompile rule %s, previous conditions are kept', name)
+
+        if n_items and self.context.archive is not None:
+            self.context.archive.set_items(self.context.items)
+
+        if n_rules or recompile:
+            self.context.build_graph()
+
+        LOG.info('reload done: %s items and %s rules changed', n_items, n_rules)
+        return n_items, n_rules
+
+    def _changed(self, fnames, prefix):
+        """
+        Return dict file name -> new definitions of changed files, removed files have no definitions
+        """
+        res = {}
+
+        for s in fnames:
+            fn = os.path.join(self.conf_dir, s)
+            f = self.files.get(fn)
+
+            if f is None:
+                f = self.files[fn] = ConfigFile(fn)
+
+            try:
+                st = os.stat(fn)
+                if st.st_mtime == f.mtime and st.st_size == f.size:
+                    continue
+
+                with open(fn, 'rb') as fd:
+                    data = fd.read()
+
+                digest = hashlib.sha1(data).hexdigest()
+
+                if digest == f.digest:
+                    f.mtime, f.size = st.st_mtime, st.st_size
+                    continue
+
+                try:
+                    conf = yaml.safe_load(data.decode('UTF-8')) or []
+                except:
+                    # not parsed again until file is changed
+                    f.mtime, f.size = st.st_mtime, st.st_size
+                    raise
+
+                f.pending = (st.st_mtime, st.st_size, digest)
+            except:
+                LOG.exception('yml load %s', fn)
+                continue
+
+            defs = {}
+            for d in conf:
+                if not isinstance(d, dict) or not d.get('name'):
+                    LOG.error('definition without name in %s: %s', fn, d)
+                    continue
+                if d['name'] in defs:
+                    LOG.error('duplicate %s in %s', d['name'], fn)
+                    continue
+                defs[d['name']] = d
+
+            LOG.info('load %s definitions from file %s', len(defs), fn)
+            res[fn] = defs
+
+        fnames = set(os.path.join(self.conf_dir, s) for s in fnames)
+        for fn in [x for x in self.files if os.path.basename(x).startswith(prefix) and x not in fnames]:
+            LOG.info('file %s is removed', fn)
+            res[fn] = {}
+
+        return res
+
+    def _apply(self, changed, defs, update, affected):
+        """
+        Diff definitions of changed files by name and call update(name, old, new) for each difference.
+        Failed definition keeps the previous one, its file is applied again on next reload
+        """
+        n = 0
+        names = set()
+        failed = set()
+
+        for fn, new_defs in changed.items():
+            f = self.files.get(fn)
+            if f is not None:
+                names.update(f.defs)
+            names.update(new_defs)
+
+        for name in sorted(names):
+            old = defs.get(name)
+            new = None
+
+            for fn, new_defs in changed.items():
+                if name in new_defs:
+                    new = (fn, new_defs[name])
+                    break
+
+            if new is None and (old is None or old[0] not in changed):
+                # already removed or defined in unchanged file
+                continue
+
+            if new is not None and old is not None and old[0] != new[0] and old[0] not in changed:
+                LOG.error('%s is already defined in %s', name, old[0])
+                continue
+
+            if old is not None and new is not None and old[1] == new[1]:
+                defs[name] = new
+                continue
+
+            try:
+                if update(name, old and old[1], new and new[1], affected):
+                    n += 1
+            except Exception:
+                fn = new[0] if new is not None else old[0]
+                LOG.exception('can\'t apply %s from %s, previous definition is kept', name, fn)
+                failed.add(fn)
+                continue
+
+            if new is None:
+                defs.pop(name, None)
+            else:
+                defs[name] = new
+
+        for fn, new_defs in changed.items():
+            f = self.files.get(fn)
+
+            if f is None or fn in failed:
+                continue
+
+            if not os.path.isfile(fn):
+                self.files.pop(fn, None)
+                continue
+
+            f.defs = new_defs
+            if f.pending is not None:
+                f.mtime, f.size, f.digest = f.pending
+                f.pending = None
+
+        return n
+
+    def _update_item(self, name, old, new, affected):
+        """
+        Apply item definition, raise exception on invalid one leaving the item as it was
+        """
+        items = self.context.items
+        item = items.get_item(name)
+
+        if new is None:
+            if item is not None:
+                items.remove_item(name)
+                affected.add(name)
+                LOG.info('item %s removed', name)
+            return True
+
+        if item is not None and old is not None and new.get('type') == old.get('type'):
+            # same type: configure in place, value is kept
+            items.remove_item(name)
+            try:
+                item.configure(new)
+            except:
+                item.configure(old)
+                raise
+            finally:
+                items.add_item(item)
+
+            self._reschedule_expiry(item)
+            LOG.info('item %s updated', name)
+            return True
+
+        s = read_item(new)
+
+        if s is None:
+            raise ValueError('invalid item type {}'.format(new.get('type')))
+
+        if item is not None:
+            items.remove_item(name)
+
+        items.add_item(s)
+        self._reschedule_expiry(s)
+        affected.add(name)
+        LOG.info('item %s added', name)
+        return True
+
+    def _reschedule_expiry(self, item):
+        # old heap entry does not match item.expires anymore and is skipped
+        item.expires = 0
+        self.context.schedule_expiry(item)
+
+    def _update_rule(self, name, old, new, affected):
+        """
+        Apply rule definition, raise exception on invalid one leaving the old rule running
+        """
+        if new is None:
+            self._remove_rule(name)
+            return True
+
+        r = make_rule(new)
+
+        if r is None:
+            raise ValueError('can\'t make rule from definition {}'.format(new))
+
+        # compile errors are raised before the old rule is removed
+        r.compile(self.context)
+        rule = self.rules.get(name)
+
+        if rule is not None:
+            self._remove_rule(name)
+            r.last_run = rule.last_run
+            r.last_time = rule.last_time
+            r.triggered = rule.triggered
+            r.stats = rule.stats
+
+        self.context.add_rule(r, compiled=True)
+        self.rules[name] = r
+        self._recompile.discard(name)
+        LOG.info('rule %s loaded', name)
+        return True
+
+    def _remove_rule(self, name):
+        rule = self.rules.pop(name, None)
+
+        if rule is not None:
+            self.context.remove_rule(rule)
+            LOG.info('rule %s removed', name)
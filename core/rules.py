@@ -1,16 +1,29 @@
 # coding: UTF-8
+import asyncio
+import collections
 import logging
 import time
-from datetime import datetime as dt
 
-from jinja2 import Template
-
-from core.cron import check_cron_values
+from core import clock
+from core.commands import PRIO_PERIODIC, PRIO_RULE
+from core.conditions import CachedCondition, ConditionError, compile_condition, is_condition_step, step_condition, time_checker
+from core.cron import compile_cron
 from core.items import ON, OFF
 from core.services import log_service, slack_service
+from core.stats import RuleStats
+from core.triggers import ItemTrigger, read_item_trigger, read_mqtt_trigger
 
 LOG = logging.getLogger('mahno.' + __name__)
 
+MODE_SINGLE = 'single'
+MODE_QUEUED = 'queued'
+MODE_RESTART = 'restart'
+MODE_PARALLEL = 'parallel'
+MODE_COALESCE = 'coalesce'
+
+MODES = (MODE_SINGLE, MODE_QUEUED, MODE_RESTART, MODE_PARALLEL, MODE_COALESCE)
+DEFAULT_MAX = 10
+
 
 class AbstractRule(object):
     name = 'unnamed'
@@ -19,23 +32,66 @@ class AbstractRule(object):
     last_run = 0
     last_time = 0
     triggered = ''
-    busy = False
     time_based = False
     active = False
     trigger = None
+    item_triggers = ()
+    mqtt_triggers = ()
+    cron = ()
+    next_run = 0
+    mode = MODE_SINGLE
+    max_runs = 1
+    _condition = None
+
+    def init_mode(self, c):
+        """
+        Read execution mode of rule and reset run counters, raise ValueError on invalid mode
+        """
+        self.mode = c.get('mode', MODE_SINGLE)
 
-    def check_time(self, t=None):
-        pass
+        if self.mode not in MODES:
+            raise ValueError('invalid mode {}'.format(self.mode))
+
+        self.max_runs = int(c.get('max', DEFAULT_MAX))
+
+        if self.max_runs < 1:
+            raise ValueError('invalid max {}'.format(self.max_runs))
+
+        self.runs = 0
+        self.dropped = 0
+        self.queued = 0
+        self.cancelled = 0
+        self._tasks = set()
+        self._pending = collections.deque()
+        self.stats = RuleStats()
+
+    @property
+    def busy(self):
+        return bool(self._tasks)
 
     def check_item_change(self, name, val, old_val, age):
         pass
 
-    async def process_item_change(self, name, val, old_val, age):
+    def next_fire(self, t):
+        """
+        Return (timestamp, cron expression) of first cron firing after t or None
+        """
+        res = None
+
+        for expr in self.cron:
+            ts = expr.next_after(t)
+            if ts is not None and (res is None or ts < res[0]):
+                res = (ts, expr)
+
+        return res
+
+    async def process_item_change(self, name, val, old_val, age, depth=0):
         d = dict(
             type='item_change',
             name=name,
             value=val,
             old_value=old_val,
+            depth=depth,
             triggered='item {} {} -> {}'.format(name, old_val, val)
         )
         await self._try_process(d)
@@ -50,6 +106,16 @@ class AbstractRule(object):
         )
         await self._try_process(d)
 
+    async def process_item_for(self, name, val, duration):
+        d = dict(
+            type='item_for',
+            name=name,
+            value=val,
+            old_value=None,
+            triggered='item {} {} for {} s'.format(name, val, duration)
+        )
+        await self._try_process(d)
+
     async def process_cron(self, v):
         d = dict(
             type='cron',
@@ -61,37 +127,123 @@ class AbstractRule(object):
         await self._try_process(d)
 
     async def _try_process(self, d):
-        if self.busy:
-            LOG.warning('rule %s is busy', self.name)
-            return
+        """
+        Run rule or queue trigger according to rule mode
+        """
+        self.stats.fire(d['type'])
+
+        if self._tasks:
+            if self.mode == MODE_SINGLE:
+                self.dropped += 1
+                LOG.warning('rule %s is busy, %s dropped', self.name, d['triggered'])
+                return
+
+            if self.mode == MODE_QUEUED:
+                if len(self._pending) >= self.max_runs:
+                    self.dropped += 1
+                    LOG.warning('rule %s queue is full, %s dropped', self.name, d['triggered'])
+                    return
+                self.queued += 1
+                self._pending.append(d)
+                return
+
+            if self.mode == MODE_COALESCE:
+                if self._pending:
+                    self.dropped += 1
+                    self._pending.clear()
+                self.queued += 1
+                self._pending.append(d)
+                return
+
+            if self.mode == MODE_RESTART:
+                for task in list(self._tasks):
+                    self.cancelled += 1
+                    task.cancel()
+                    self._tasks.discard(task)
+
+            if self.mode == MODE_PARALLEL and len(self._tasks) >= self.max_runs:
+                self.dropped += 1
+                LOG.warning('rule %s has %s runs, %s dropped', self.name, len(self._tasks), d['triggered'])
+                return
+
+        await self._start(d)
+
+        # queued and coalesce modes: pending triggers are run by the task that got the rule first
+        while self._pending and not self._tasks:
+            await self._start(self._pending.popleft())
+
+    async def _start(self, d):
+        task = asyncio.ensure_future(self._execute(d))
+        self._tasks.add(task)
+        try:
+            await task
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            LOG.info('rule %s run on %s cancelled', self.name, d['triggered'])
+        finally:
+            self._tasks.discard(task)
+
+    async def _execute(self, d):
+        start = time.time()
+        passed = self.check_conditions()
+        self.stats.add_condition(passed, time.time() - start)
 
-        if not self.check_conditions():
+        if not passed:
             LOG.debug('rule %s running on %s fail conditions', self.name, d['triggered'])
             return
 
         LOG.info('running rule %s on %s', self.name, d['triggered'])
         start = time.time()
-        self.busy = True
+        self.runs += 1
         try:
-            self.last_run = time.time()
+            self.last_run = clock.time()
             self.triggered = d['triggered']
             await self._run(d)
+        except asyncio.CancelledError:
+            raise
         except:
             LOG.exception('error in rule %s', self.name)
         finally:
             self.last_time = time.time() - start
-            self.busy = False
+            self.stats.action.add(self.last_time)
+
+    def compile(self, context):
+        """
+        Compile conditions with items of context, raise ConditionError on invalid config
+        """
+        if self.data.get('condition') is not None:
+            self._condition = compile_condition(self.data['condition'], context.items, context.conditions)
+        else:
+            self._condition = None
 
     def check_conditions(self):
-        if 'condition' not in self.data:
+        if self.data.get('condition') is None:
             return True
 
-        return self.check_condition(self.data['condition'], self.context)
+        if self._condition is None:
+            self.compile(self.context)
+
+        res = self._condition()
+
+        if isinstance(self._condition, CachedCondition):
+            self.stats.add_cache(self._condition.last_hit)
+
+        return res
 
     def to_dict(self):
         return dict(name=self.name,
                     busy=self.busy,
+                    mode=self.mode,
+                    max=self.max_runs,
+                    runs=self.runs,
+                    running=len(self._tasks),
+                    pending=len(self._pending),
+                    dropped=self.dropped,
+                    queued=self.queued,
+                    cancelled=self.cancelled,
                     last_run=self.last_run,
+                    next_run=self.next_run,
                     triggered=self.triggered,
                     last_time=self.last_time,
                     active=self.active,
@@ -99,128 +251,20 @@ class AbstractRule(object):
 
     @staticmethod
     def check_condition(condition, context):
-        if 'condition_type' not in condition:
-            LOG.error('no condition type in condition %s', condition)
+        try:
+            return compile_condition(condition, context.items)()
+        except ConditionError as e:
+            LOG.error('%s', e)
             return False
 
-        ct = condition['condition_type']
-
-        if ct == 'state':
-            item = context.items.get_item(condition['item_id'])
-
-            if item is None:
-                LOG.warning('no item %s', condition['item_id'])
-                return False
-
-            op = condition.get('check', 'is')
-
-            if op == 'is':
-                return item.value == condition['state']
-            
-            elif op == 'not':
-                return item.value != condition['state']
-
-            elif op == 'in':
-                assert isinstance(condition['state'], (list, tuple))
-
-                return item.value in condition['state']
-            else:
-                LOG.error('invalid check \'%s\'', op)
-                return False
-
-        elif ct == 'numeric_state':
-            return Rule.check_condition_numeric(condition, context)
-
-        elif ct == 'time':
-            return Rule.check_condition_time(condition)
-
-        elif ct == 'or':
-            return any(map(lambda x: Rule.check_condition(x, context), condition['conditions']))
-
-        elif ct == 'and':
-            return all(map(lambda x: Rule.check_condition(x, context), condition['conditions']))
-
-        else:
-            LOG.error('invalid condition type \'%s\'', ct)
-        return False
-
-    @staticmethod
-    def check_condition_numeric(condition, context):
-        assert condition['condition_type'] == 'numeric_state'
-
-        val = context.get_item_value(condition['item_id'])
-
-        if val is None:
-            return False
-
-        if isinstance(val, str):
-            if '.' in val:
-                val = float(val)
-            elif ',' in val:
-                val = float(val.replace(',', '.'))
-            else:
-                val = int(val)
-
-        for k, v in condition.items():
-            if k in ('item_id', 'condition_type'):
-                continue
-
-            if k == 'above':
-                if not val > v:
-                    return False
-
-            elif k == 'below':
-                if not val < v:
-                    return False
-
-            else:
-                raise Exception('invalid operator \'{}\' in numeric_state'.format(k))
-
-        return True
-
     @staticmethod
     def check_condition_time(condition, t=None):
         assert condition['condition_type'] == 'time'
 
         if t is None:
-            t = dt.now()
-
-        m = t.hour * 60 + t.minute
-
-        for k, v in condition.items():
-            if k == 'condition_type':
-                continue
-
-            if k == 'after':
-                h1, m1 = [int(x) for x in v.split(':', 1)]
-                m1 += h1 * 60
-
-                if m < m1:
-                    return False
-
-            elif k == 'before':
-                h1, m1 = [int(x) for x in v.split(':', 1)]
-                m1 += h1 * 60
+            t = clock.now()
 
-                if m > m1:
-                    return False
-
-            elif k == 'between':
-                h1, m1 = [int(x) for x in v[0].split(':', 1)]
-                h2, m2 = [int(x) for x in v[1].split(':', 1)]
-
-                m1 += h1 * 60
-                m2 += h2 * 60
-
-                if m1 < m2:
-                    if not m1 <= m <= m2:
-                        return False
-                else:
-                    if not m > m1 or m < m2:
-                        return False
-
-            else:
-                raise Exception('invalid operator \'{}\' in time'.format(k))
+        return time_checker(condition)(t.hour * 60 + t.minute)
 
     async def _run(self, d):
         pass
@@ -231,6 +275,7 @@ class ThermostatRule(AbstractRule):
         self.name = c['name']
         self.data = c
         self.active = False
+        self.init_mode(c)
         self.switch_item = c['thermostat']['switch_item']
         self.sensor_item = c['thermostat']['sensor_item']
         self.target_value_item = c['thermostat']['target_value_item']
@@ -239,6 +284,7 @@ class ThermostatRule(AbstractRule):
         self.gist = float(c['thermostat'].get('gist', 1.0))
         self.timeout = int(c['thermostat'].get('timeout', 60))
         self.last_switch = 0
+        self.item_triggers = [ItemTrigger(x) for x in (self.sensor_item, self.switch_item, self.target_value_item)]
 
     def check_item_change(self, name, val, old_val, age):
         return name in (self.sensor_item, self.switch_item, self.target_value_item)
@@ -259,7 +305,7 @@ class ThermostatRule(AbstractRule):
             self.context.item_command(self.actor_item, OFF)
             return False
 
-        if time.time() - self.last_switch < self.timeout:
+        if clock.time() - self.last_switch < self.timeout:
             # do not switch too fast
             return False
 
@@ -279,7 +325,7 @@ class ThermostatRule(AbstractRule):
             target_sw = OFF if self.is_cooler else ON
 
         if target_sw is not None and self.context.get_item_value(self.actor_item) != target_sw:
-            self.last_switch = time.time()
+            self.last_switch = clock.time()
             LOG.info('value is %s, range is %s - %s, setting %s to %s', t, t_d - self.gist / 2, t_d + self.gist / 2,
                      self.actor_item, target_sw)
             self.context.item_command(self.actor_item, target_sw)
@@ -291,6 +337,8 @@ class ThermostatRule(AbstractRule):
 
 
 class Rule(AbstractRule):
+    _actions = None
+
     def __init__(self, c):
         self.name = c['name']
         self.data = c
@@ -298,91 +346,65 @@ class Rule(AbstractRule):
         self.active = False
         self.last_run = 0
         self.triggered = ''
-        self.busy = False
         self.last_time = 0
+        self.init_mode(c)
 
         self.trigger = c['trigger']
+        self.item_triggers = [read_item_trigger(i) for i in self.trigger.get('items', [])]
+        self.mqtt_triggers = [read_mqtt_trigger(m) for m in self.trigger.get('mqtt', [])]
+        self.cron = compile_cron(self.trigger['time']) if self.trigger.get('time') else []
 
-        self.time_based = False
-        if self.trigger.get('time'):
-            self.time_based = True
-        else:
-            for i in self.trigger.get('items', []):
-                if isinstance(i, dict) and i.get('for') is not None:
-                    self.time_based = True
+        self.time_based = bool(self.trigger.get('time')) or any(t.for_ is not None for t in self.item_triggers)
 
-    def check_time(self, t=None):
+    def check_item_change(self, name, val, old_val, age):
+        for i in self.item_triggers:
+            if i.for_ is None and i.item_id == name and i.matches(val, old_val):
+                return True
+        return False
+
+    def compile(self, context):
         """
-        check if rule must be fired
+        Compile conditions, action steps and templates, on error compiled rule is not changed
         """
-        if t is None:
-            t = time.time()
-
-        if not self.time_based:
-            return None
-
-        tr = None
+        actions = []
 
-        # check cron
-        if self.trigger.get('time') and t - self.last_run > 60:
-            cron_value = self.trigger['time'].strip()
-
-            v = check_cron_values(cron_value, t, self.last_run)
-            if v is not None:
-                tr = 'cron {}'.format(cron_value)
-
-        # check items
-        for i in self.trigger.get('items', []):
-            if isinstance(i, dict) and i.get('item_id') is not None and i.get('for') is not None:
-                item = self.context.items.get_item(i['item_id'])
-
-                if item is None:
-                    continue
-
-                td = i['for'].get('hours', 0) * 3600 + i['for'].get('minutes', 0) * 60 + i['for'].get('seconds', 0)
-
-                if item.value == i.get('to', ON) and item.age >= td:
-                    tr = 'item {} {} for {} s'.format(item.name, item.value, int(item.age))
-                    break
-
-        if tr is not None and not self.active:
-            self.active = True
-            return tr
-
-        self.active = tr is not None
-        return None
-
-    def check_item_change(self, name, val, old_val, age):
-        for i in self.trigger.get('items', []):
-            if isinstance(i, str):
-                if i == name:
-                    return True
-
-            if isinstance(i, dict) and i.get('for') is None:
-                if i.get('item_id') != name:
-                    continue
+        for act in self.data.get('action', []):
+            if 'service' in act:
+                for source in self.templates(act):
+                    context.templates.compile(source)
+                if 'value_expr' in act:
+                    context.expressions.compile(act['value_expr'])
+                actions.append((act, None))
+            elif is_condition_step(act):
+                condition = compile_condition(step_condition(act), context.items, context.conditions)
+                actions.append((act, condition))
+            else:
+                raise ConditionError('invalid action step {}'.format(act))
 
-                if i.get('from') is not None and i.get('from') != old_val:
-                    continue
+        AbstractRule.compile(self, context)
+        self._actions = actions
 
-                if i.get('to') is not None and i.get('to') != val:
-                    continue
+    async def _run(self, rule_context):
+        if self._actions is None:
+            self.compile(self.context)
 
-                return True
-        return False
+        for n, (act, condition) in enumerate(self._actions):
+            start = time.time()
 
-    async def _run(self, rule_context):
-        for act in self.data.get('action', []):
-            if 'service' in act:
+            if condition is None:
                 LOG.info('running service %s', act['service'])
                 try:
                     await self._do_service(act, rule_context)
                 except:
                     LOG.exception('error in service %s', act['service'])
-            elif 'condition' in act:
-                if not self.check_condition(act, self.context):
-                    LOG.info('break on condition %s', act)
-                    break
+                self.stats.service.add(time.time() - start)
+                self.stats.add_action(n, time.time() - start)
+            elif not condition():
+                self.stats.add_action(n, time.time() - start)
+                LOG.info('break on condition %s', act)
+                break
+            else:
+                self.stats.add_action(n, time.time() - start)
 
     async def _do_service(self, act, rule_context):
         s_name = act['service']
@@ -390,16 +412,17 @@ class Rule(AbstractRule):
         if s_name == 'set_state':
             name = act['item_id']
             value = self.get_value(act, rule_context)
-            self.context.set_item_value(name, value)
+            self.context.set_item_value(name, value, depth=rule_context.get('depth', 0) + 1)
 
         elif s_name == 'command':
             name = act['item_id']
             value = self.get_value(act, rule_context)
             LOG.info('sending command \'%s\' to %s', value, name)
-            self.context.item_command(name, value)
+            prio = PRIO_PERIODIC if rule_context['type'] == 'cron' else PRIO_RULE
+            self.context.item_command(name, value, prio, rule_context.get('depth', 0) + 1)
 
         elif s_name == 'log':
-            log_service(act.get('data'), rule_context)
+            log_service(act.get('data'), rule_context, self.context)
 
         elif s_name == 'slack':
             slack_service(act.get('data'), rule_context, self.context)
@@ -408,12 +431,27 @@ class Rule(AbstractRule):
             LOG.error('invalid service name: %s', s_name)
 
     @staticmethod
-    def get_value(act, context):
+    def templates(act):
+        """
+        Template sources of action step
+        """
+        res = []
+
+        if 'value_template' in act:
+            res.append(act['value_template'])
+
+        if isinstance(act.get('data'), dict) and 'message' in act['data']:
+            res.append(act['data']['message'])
+
+        return res
+
+    def get_value(self, act, rule_context):
         if not isinstance(act, dict):
             return act
 
-        if 'value_template' in act:
-            t = Template(act['value_template'])
-            return t.render(**context)
+        if 'value_expr' in act:
+            return self.context.expressions.evaluate(act['value_expr'], rule_context)
+        elif 'value_template' in act:
+            return self.context.templates.render(act['value_template'], rule_context)
         else:
             return act.get('value')
@@ -2,16 +2,13 @@
 
 import logging
 
-from jinja2 import Template
-
 LOG = logging.getLogger('mahno.' + __name__)
 RULES_LOG = logging.getLogger('mahno.core.rules')
 
 
-def log_service(data, context):
+def log_service(data, rule_context, context):
     if 'message' in data:
-        t = Template(data['message'])
-        RULES_LOG.info(t.render(context))
+        RULES_LOG.info(context.templates.render(data['message'], rule_context))
     else:
         RULES_LOG.warning('empty message')
 
@@ -25,5 +22,5 @@ def slack_service(data, rule_context, context):
         RULES_LOG.warning('slack in not configured')
         return
 
-    t = Template(data['message']).render(rule_context)
+    t = context.templates.render(data['message'], rule_context)
     context.command('slack', t)
@@ -0,0 +1,165 @@
+# coding: UTF-8
+
+"""
+Binary item state snapshot.
+
+    header: magic 'MHNS', version u16, count u32
+    record: name (u16 size + utf-8), type (u8 size + ascii), value, checked f64, changed f64
+    value:  tag u8 - 0 none, 1 float f64, 2 int i64, 3 text (u32 size + utf-8)
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+
+from core.items import ITEM_TYPES
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+MAGIC = b'MHNS'
+VERSION = 1
+
+HEADER = struct.Struct('<4sHI')
+U8 = struct.Struct('<B')
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+F64 = struct.Struct('<d')
+I64 = struct.Struct('<q')
+TIMES = struct.Struct('<dd')
+
+V_NONE = 0
+V_FLOAT = 1
+V_INT = 2
+V_TEXT = 3
+
+TYPE_NAMES = {v: k for k, v in ITEM_TYPES.items()}
+
+
+def item_state(item):
+    """
+    State tuple taken on event loop: (name, type, value, checked, changed)
+    """
+    return item.name, TYPE_NAMES.get(type(item), ''), item._value, item.checked, item.changed
+
+
+def encode_value(v):
+    if v is None:
+        return U8.pack(V_NONE)
+
+    if isinstance(v, bool):
+        v = str(v)
+
+    if isinstance(v, float):
+        return U8.pack(V_FLOAT) + F64.pack(v)
+
+    if isinstance(v, int) and -2 ** 63 <= v < 2 ** 63:
+        return U8.pack(V_INT) + I64.pack(v)
+
+    b = str(v).encode('UTF-8')
+    return U8.pack(V_TEXT) + U32.pack(len(b)) + b
+
+
+def encode_record(state):
+    name, type_name, value, checked, changed = state
+    n = name.encode('UTF-8')
+    t = type_name.encode('ascii')
+    return b''.join((U16.pack(len(n)), n, U8.pack(len(t)), t, encode_value(value),
+                     TIMES.pack(checked or 0, changed or 0)))
+
+
+def iter_records(buf):
+    """
+    Yield (name, type, value, checked, changed) from snapshot buffer
+    """
+    magic, version, count = HEADER.unpack_from(buf, 0)
+
+    if magic != MAGIC:
+        raise Exception('not a snapshot file')
+
+    if version != VERSION:
+        raise Exception('unsupported snapshot version {}'.format(version))
+
+    pos = HEADER.size
+
+    for _ in range(count):
+        size, = U16.unpack_from(buf, pos)
+        pos += 2
+        name = bytes(buf[pos:pos + size]).decode('UTF-8')
+        pos += size
+
+        size, = U8.unpack_from(buf, pos)
+        pos += 1
+        type_name = bytes(buf[pos:pos + size]).decode('ascii')
+        pos += size
+
+        tag, = U8.unpack_from(buf, pos)
+        pos += 1
+        if tag == V_NONE:
+            value = None
+        elif tag == V_FLOAT:
+            value, = F64.unpack_from(buf, pos)
+            pos += 8
+        elif tag == V_INT:
+            value, = I64.unpack_from(buf, pos)
+            pos += 8
+        elif tag == V_TEXT:
+            size, = U32.unpack_from(buf, pos)
+            pos += 4
+            value = bytes(buf[pos:pos + size]).decode('UTF-8')
+            pos += size
+        else:
+            raise Exception('invalid value tag {} for {}'.format(tag, name))
+
+        checked, changed = TIMES.unpack_from(buf, pos)
+        pos += TIMES.size
+
+        yield name, type_name, value, checked, changed
+
+
+def read_snapshot(fn):
+    """
+    Return list of state tuples. Json snapshots of previous version are read too
+    """
+    if not os.path.isfile(fn) or os.path.getsize(fn) == 0:
+        return []
+
+    with open(fn, 'rb') as f:
+        if f.read(1) == b'{':
+            f.seek(0)
+            data = json.loads(f.read().decode('UTF-8'))
+            return [(x[0], '', x[1], x[2], x[3]) for x in data['items']]
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return list(iter_records(m))
+
+
+class SnapshotWriter(object):
+    """
+    Keeps encoded records and re-encodes only dirty items on save. Not thread safe, use from one thread
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.records = {}
+
+    def save(self, states, names=None):
+        """
+        Update records from dirty states, drop items not in names, write file atomically
+        """
+        for state in states:
+            self.records[state[0]] = encode_record(state)
+
+        if names is not None:
+            for name in set(self.records) - set(names):
+                del self.records[name]
+
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.records)))
+            for name in sorted(self.records):
+                f.write(self.records[name])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fn)
@@ -0,0 +1,105 @@
+# coding: UTF-8
+
+"""
+Rule instrumentation: fire and condition counters, condition cache hits and execution time histograms
+"""
+
+import bisect
+
+# bucket upper bounds in milliseconds, last bucket is everything above
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """
+        Upper bound of bucket with p-th percentile, ms
+        """
+        if not self.count:
+            return None
+
+        n = self.count * p / 100.
+        acc = 0
+
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= n:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+
+        return self.max
+
+    def to_dict(self):
+        return dict(count=self.count,
+                    sum=round(self.sum, 3),
+                    avg=round(self.sum / self.count, 3) if self.count else None,
+                    max=round(self.max, 3),
+                    p50=self.percentile(50),
+                    p99=self.percentile(99),
+                    buckets=dict(zip([str(x) for x in BUCKETS] + ['inf'], self.counts)))
+
+
+class RuleStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.fired = {}
+        self.passed = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.condition = Histogram()
+        self.action = Histogram()
+        self.service = Histogram()
+        self.actions = {}
+
+    def fire(self, trigger_type):
+        self.fired[trigger_type] = self.fired.get(trigger_type, 0) + 1
+
+    def add_condition(self, passed, seconds):
+        if passed:
+            self.passed += 1
+        else:
+            self.failed += 1
+        self.condition.add(seconds)
+
+    def add_cache(self, hit):
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def add_action(self, n, seconds):
+        h = self.actions.get(n)
+        if h is None:
+            h = self.actions[n] = Histogram()
+        h.add(seconds)
+
+    def to_dict(self):
+        n = self.cache_hits + self.cache_misses
+        return dict(fired=dict(self.fired),
+                    fired_total=sum(self.fired.values()),
+                    condition_passed=self.passed,
+                    condition_failed=self.failed,
+                    condition=self.condition.to_dict(),
+                    condition_cache=dict(hits=self.cache_hits, misses=self.cache_misses,
+                                         hit_rate=round(self.cache_hits / n, 3) if n else None),
+                    action=self.action.to_dict(),
+                    service=self.service.to_dict(),
+                    actions={str(n): h.to_dict() for n, h in sorted(self.actions.items())})
@@ -0,0 +1,68 @@
+# coding: UTF-8
+
+"""
+Shared jinja2 environment for rule templates. Compiled templates are cached by source,
+optional bytecode cache on disk makes restarts faster.
+"""
+
+import logging
+import os
+
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, TemplateSyntaxError
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+
+class SourceLoader(BaseLoader):
+    """
+    Template name is template source itself
+    """
+
+    def get_source(self, environment, template):
+        return template, None, lambda: True
+
+
+class Templates(object):
+    def __init__(self, helpers=None, cache_dir=None):
+        self.env = Environment(loader=SourceLoader(), cache_size=0)
+        self.env.globals.update(helpers or {})
+        self.hits = 0
+        self.misses = 0
+        self._templates = {}
+
+        if cache_dir:
+            self.set_cache_dir(cache_dir)
+
+    def set_cache_dir(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        LOG.info('template bytecode cache in %s', cache_dir)
+
+    def get(self, source):
+        t = self._templates.get(source)
+
+        if t is not None:
+            self.hits += 1
+            return t
+
+        self.misses += 1
+        t = self._templates[source] = self.env.get_template(source)
+        return t
+
+    def compile(self, source):
+        """
+        Compile template into cache, raise ValueError on syntax error
+        """
+        try:
+            self.get(source)
+        except TemplateSyntaxError as e:
+            raise ValueError('invalid template \'{}\': {}'.format(source, e))
+
+    def render(self, source, d):
+        return self.get(source).render(d)
+
+    def to_dict(self):
+        return dict(size=len(self._templates),
+                    hits=self.hits,
+                    misses=self.misses,
+                    bytecode_cache=self.env.bytecode_cache is not None)
@@ -0,0 +1,132 @@
+# coding: UTF-8
+
+"""
+MQTT topic matching. TopicTrie keeps values by topic masks with `+` (one level) and `#` (rest of topic)
+wildcards, matching a topic costs O(topic depth) instead of checking every mask.
+"""
+
+
+def match_topic(mask, topic):
+    mask_parts = mask.split('/')
+    topic_parts = topic.split('/')
+
+    for i, m in enumerate(mask_parts):
+        if m == '#':
+            return True
+
+        if i >= len(topic_parts):
+            return False
+
+        if m != '+' and m != topic_parts[i]:
+            return False
+
+    return len(mask_parts) == len(topic_parts)
+
+
+def check_topic_mask(mask):
+    """
+    Raise ValueError on mask with misplaced wildcards
+    """
+    parts = mask.split('/')
+
+    for i, p in enumerate(parts):
+        if ('#' in p or '+' in p) and len(p) > 1:
+            raise ValueError('wildcard must occupy whole level in topic {}'.format(mask))
+
+        if p == '#' and i != len(parts) - 1:
+            raise ValueError('# must be the last level in topic {}'.format(mask))
+
+
+class _Node(object):
+    __slots__ = ('children', 'values', 'rest')
+
+    def __init__(self):
+        self.children = {}
+        # values of masks ending here and of masks ending with # here
+        self.values = []
+        self.rest = []
+
+
+class TopicTrie(object):
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, mask, value):
+        node = self.root
+
+        for p in mask.split('/'):
+            if p == '#':
+                node.rest.append(value)
+                break
+            node = node.children.setdefault(p, _Node())
+        else:
+            node.values.append(value)
+
+        self.size += 1
+
+    def remove(self, mask, fn):
+        """
+        Remove values of mask for which fn(value) is true
+        """
+        path = [(None, self.root)]
+
+        for p in mask.split('/'):
+            if p == '#':
+                break
+            node = path[-1][1].children.get(p)
+            if node is None:
+                return
+            path.append((p, node))
+        else:
+            p = None
+
+        node = path[-1][1]
+        values = node.rest if p == '#' else node.values
+        rest = [x for x in values if not fn(x)]
+        self.size -= len(values) - len(rest)
+        values[:] = rest
+
+        # prune empty branch
+        while len(path) > 1:
+            p, node = path.pop()
+            if node.children or node.values or node.rest:
+                break
+            del path[-1][1].children[p]
+
+    def match(self, topic):
+        """
+        Return list of values with masks matching topic, values of one mask are in order of adding
+        """
+        res = []
+        nodes = [self.root]
+
+        for p in topic.split('/'):
+            nxt = []
+
+            for node in nodes:
+                if node.rest:
+                    res.extend(node.rest)
+
+                c = node.children.get(p)
+                if c is not None:
+                    nxt.append(c)
+
+                c = node.children.get('+')
+                if c is not None:
+                    nxt.append(c)
+
+            if not nxt:
+                return res
+
+            nodes = nxt
+
+        for node in nodes:
+            res.extend(node.values)
+            # a/# matches a too
+            res.extend(node.rest)
+
+        return res
@@ -0,0 +1,182 @@
+# coding: UTF-8
+
+from core import clock
+from core.items import ON
+from core.topics import check_topic_mask
+
+_NO_VALUE = object()
+
+
+class TriggerGate(object):
+    """
+    Debounce, throttle and distinct filter of one trigger. Times are in seconds. Debounce fires last event
+    after no events for `debounce`, throttle fires at most once per `throttle` and always fires the last
+    event of burst. Only one timer is kept, it is re-armed when it fires before new deadline
+    """
+    __slots__ = ('debounce', 'throttle', 'distinct', 'dropped', '_timer', '_deadline', '_last_fire', '_last_value',
+                 '_pending')
+
+    def __init__(self, debounce=0, throttle=0, distinct=False):
+        self.debounce = debounce
+        self.throttle = throttle
+        self.distinct = distinct
+        self.dropped = 0
+        self._timer = None
+        self._deadline = 0
+        self._last_fire = 0
+        self._last_value = _NO_VALUE
+        self._pending = None
+
+    def submit(self, loop, value, fn, *args):
+        """
+        Call fn(*args) now, later or never
+        """
+        if self.distinct:
+            if value == self._last_value:
+                self.dropped += 1
+                return
+            self._last_value = value
+
+        if not self.debounce and not self.throttle:
+            fn(*args)
+            return
+
+        now = clock.time()
+
+        if self._pending is not None:
+            # previous event is replaced
+            self.dropped += 1
+
+        if self.debounce:
+            self._pending = (fn, args)
+            self._deadline = now + self.debounce
+        elif self._timer is None and now - self._last_fire >= self.throttle:
+            self._last_fire = now
+            fn(*args)
+            return
+        else:
+            self._pending = (fn, args)
+            self._deadline = self._last_fire + self.throttle
+
+        if self._timer is None:
+            self._arm(loop, now)
+
+    def _arm(self, loop, now):
+        self._timer = clock.call_later(loop, max(0, self._deadline - now), self._on_timer, loop)
+
+    def _on_timer(self, loop):
+        self._timer = None
+        now = clock.time()
+
+        if self._pending is None:
+            return
+
+        if now < self._deadline - 0.001:
+            self._arm(loop, now)
+            return
+
+        (fn, args), self._pending = self._pending, None
+        self._last_fire = now
+        fn(*args)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = None
+
+
+def read_gate(d):
+    """
+    Return TriggerGate from debounce/throttle (ms) and distinct options of trigger or None
+    """
+    debounce = float(d.get('debounce', 0)) / 1000.
+    throttle = float(d.get('throttle', 0)) / 1000.
+    distinct = bool(d.get('distinct', False))
+
+    if debounce < 0 or throttle < 0:
+        raise ValueError('debounce and throttle must be positive')
+
+    if debounce and throttle:
+        raise ValueError('debounce and throttle can\'t be used together')
+
+    if not (debounce or throttle or distinct):
+        return None
+
+    return TriggerGate(debounce, throttle, distinct)
+
+
+class ItemTrigger(object):
+    """
+    Parsed item trigger from rule config. `for_` is duration in seconds or None
+    """
+    __slots__ = ('item_id', 'from_', 'to', 'for_', 'gate')
+
+    def __init__(self, item_id, from_=None, to=None, for_=None, gate=None):
+        self.item_id = item_id
+        self.from_ = from_
+        self.to = to
+        self.for_ = for_
+        self.gate = gate
+
+    def __repr__(self):
+        return 'ItemTrigger({}, from={}, to={}, for={})'.format(self.item_id, self.from_, self.to, self.for_)
+
+    def matches(self, val, old_val):
+        if self.from_ is not None and self.from_ != old_val:
+            return False
+
+        if self.to is not None and self.to != val:
+            return False
+
+        return True
+
+
+def duration(d):
+    return d.get('hours', 0) * 3600 + d.get('minutes', 0) * 60 + d.get('seconds', 0)
+
+
+def read_item_trigger(i):
+    if isinstance(i, str):
+        return ItemTrigger(i)
+
+    if not isinstance(i, dict) or i.get('item_id') is None:
+        raise ValueError('invalid item trigger {}'.format(i))
+
+    if i.get('for') is not None:
+        return ItemTrigger(i['item_id'], i.get('from'), i.get('to', ON), duration(i['for']))
+
+    return ItemTrigger(i['item_id'], i.get('from'), i.get('to'), gate=read_gate(i))
+
+
+class MqttTrigger(object):
+    """
+    Parsed mqtt trigger from rule config, topic can have + and # wildcards. Without payload key any payload
+    matches, `payload: null` compares with value like any other payload
+    """
+    __slots__ = ('topic', 'payload', 'gate')
+
+    def __init__(self, topic, payload=_NO_VALUE, gate=None):
+        self.topic = topic
+        self.payload = payload
+        self.gate = gate
+
+    def __repr__(self):
+        if self.payload is _NO_VALUE:
+            return 'MqttTrigger({})'.format(self.topic)
+        return 'MqttTrigger({}, payload={})'.format(self.topic, self.payload)
+
+    def matches_payload(self, value):
+        return self.payload is _NO_VALUE or self.payload == value
+
+
+def read_mqtt_trigger(m):
+    if isinstance(m, str):
+        check_topic_mask(m)
+        return MqttTrigger(m)
+
+    if not isinstance(m, dict) or not m.get('topic'):
+        raise ValueError('invalid mqtt trigger {}'.format(m))
+
+    check_topic_mask(m['topic'])
+    return MqttTrigger(m['topic'], m.get('payload', _NO_VALUE), read_gate(m))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Inspect and truncate mahno state journal. Stop mahno before truncating.
+
+    journal_tool.py inspect [-n 20]
+    journal_tool.py truncate
+"""
+
+import argparse
+import os
+import time
+
+from core.journal import read_journal, replay
+from core.snapshot import SnapshotWriter, read_snapshot
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def fmt_time(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t)) if t else '-'
+
+
+def inspect(args):
+    snapshot = read_snapshot(args.snapshot)
+    records = list(read_journal(args.journal))
+
+    print('snapshot %s: %s items' % (args.snapshot, len(snapshot)))
+    print('journal %s: %s records, %s items' % (args.journal, len(records), len(set(x[0] for x in records))))
+
+    for name, _, value, checked, changed in records[-args.n:]:
+        print('%s  %-30s %s' % (fmt_time(checked), name, value))
+
+
+def truncate(args):
+    state = replay(args.journal, args.snapshot)
+    SnapshotWriter(args.snapshot).save(list(state.values()))
+    open(args.journal, 'w').close()
+    print('%s items written to %s, journal truncated' % (len(state), args.snapshot))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--journal', default=os.path.join(BASE_PATH, 'mahno.journal'))
+    parser.add_argument('--snapshot', default=os.path.join(BASE_PATH, 'mahno.snapshot'))
+    sub = parser.add_subparsers(dest='cmd')
+    p = sub.add_parser('inspect')
+    p.add_argument('-n', type=int, default=20, help='show last n records')
+    p.set_defaults(fn=inspect)
+    p = sub.add_parser('truncate')
+    p.set_defaults(fn=truncate)
+    args = parser.parse_args()
+
+    if args.cmd is None:
+        parser.print_help()
+    else:
+        args.fn(args)
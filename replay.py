@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Replay recorded item changes and mqtt messages through items and rules from config dir with virtual clock.
+
+    replay.py -c config events.jsonl [--speed 60] [-o commands.jsonl]
+
+Every line of events file is json object with time `t` and either `item` and `value` or `topic` and `payload`.
+Without --speed events are replayed as fast as possible. Commands sent by rules are written as jsonl,
+per rule timing is printed at the end.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+import yaml
+
+from core import Context
+from core import clock
+from core.context import CB_ONCHANGE
+from core.loader import Loader
+
+LOG = logging.getLogger('mahno.' + __name__)
+
+SETTLE_STEPS = 1000
+
+# module functions since python 3.7, Task class methods before (removed in 3.9)
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+_all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+
+
+class ReplayContext(Context):
+    """
+    Context recording commands instead of sending them to actors
+    """
+
+    def __init__(self):
+        Context.__init__(self)
+        self.commands = []
+
+    def command(self, name, cmd, priority=0, key=None):
+        self.commands.append(dict(t=clock.time(), actor=name, cmd=cmd, priority=priority))
+
+    def get_actor(self, name):
+        return None
+
+    def item_command(self, name, cmd, priority=0, depth=0):
+        self.commands.append(dict(t=clock.time(), item=name, value=cmd, priority=priority))
+        Context.item_command(self, name, cmd, priority, depth)
+
+
+def read_events(fn):
+    with open(fn, 'r', encoding='UTF-8') as f:
+        for n, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                LOG.warning('broken event %s at line %s', line, n + 1)
+
+
+class Replay(object):
+    def __init__(self, conf_dir, speed=None):
+        self.speed = speed
+        self.context = ReplayContext()
+
+        conf_fn = os.path.join(conf_dir, 'config.yml')
+        if os.path.isfile(conf_fn):
+            self.context.config = yaml.safe_load(open(conf_fn, 'r', encoding='UTF-8')) or {}
+
+        self.context.add_cb(CB_ONCHANGE, self.context.fire_rules, batch=True)
+        Loader(self.context, conf_dir).reload()
+
+        self.clock = None
+        self.events = 0
+        self._last = None
+
+    def run(self, events):
+        """
+        Replay events and return time of the last one
+        """
+        loop = asyncio.new_event_loop()
+        self.context.loop = loop
+        try:
+            return loop.run_until_complete(self._run(events))
+        finally:
+            clock.set_clock(clock.RealClock())
+            loop.close()
+
+    async def _run(self, events):
+        for ev in events:
+            t = float(ev.get('t', self._last or 0))
+
+            if self.clock is None:
+                self.start(t)
+
+            await self.advance(t)
+
+            if 'item' in ev:
+                self.context.set_item_value(ev['item'], ev.get('value'))
+            elif 'topic' in ev:
+                self.context.mqtt_message('mqtt', ev['topic'], ev.get('payload'))
+            else:
+                LOG.warning('unknown event %s', ev)
+                continue
+
+            self.events += 1
+            await self.settle()
+
+        return self._last
+
+    def start(self, t):
+        self.clock = clock.VirtualClock(t)
+        clock.set_clock(self.clock)
+        self._last = t
+        self.context.init_expiry()
+        self.context.init_cron()
+        self.context.init_for_triggers()
+
+    async def advance(self, t):
+        """
+        Fire timers due before t in order, then move clock to t
+        """
+        while True:
+            timer = self.clock.pop_due(t)
+
+            if timer is None:
+                break
+
+            await self.wait(timer.ts)
+            timer.fn(*timer.args)
+            await self.settle()
+
+        await self.wait(t)
+        self.clock.set(t)
+
+    async def wait(self, t):
+        if self.speed and t > self._last:
+            await asyncio.sleep((t - self._last) / self.speed)
+        self._last = max(self._last, t)
+
+    async def settle(self):
+        """
+        Let rule tasks started by last event finish
+        """
+        current = _current_task()
+
+        for _ in range(SETTLE_STEPS):
+            await asyncio.sleep(0)
+            if not [x for x in _all_tasks() if x is not current and not x.done()]:
+                return
+
+        LOG.warning('rule tasks are still running after %s steps', SETTLE_STEPS)
+
+    def rules_timing(self):
+        res = []
+
+        for rule in self.context.rules:
+            d = rule.stats.to_dict()
+            res.append(dict(rule=rule.name,
+                            fired=d['fired_total'],
+                            runs=rule.runs,
+                            dropped=rule.dropped,
+                            avg_ms=d['action']['avg'],
+                            max_ms=d['action']['max']))
+
+        return res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
+    parser.add_argument('-c', dest='config_dir', default=default_dir)
+    parser.add_argument('--speed', type=float, default=None, help='replay speed, as fast as possible if not set')
+    parser.add_argument('-o', dest='output', default=None, help='commands output file, stdout by default')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('events')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    r = Replay(args.config_dir, args.speed)
+    start = time.time()
+    r.run(read_events(args.events))
+    elapsed = time.time() - start
+
+    out = open(args.output, 'w', encoding='UTF-8') if args.output else sys.stdout
+    for cmd in r.context.commands:
+        out.write(json.dumps(cmd, default=str))
+        out.write('\n')
+    if args.output:
+        out.close()
+
+    rate = r.events / max(elapsed, 1e-9)
+    print('%s events in %.3f s, %.0f events/s, %s commands' % (r.events, elapsed, rate, len(r.context.commands)),
+          file=sys.stderr)
+    print('%-30s %8s %8s %8s %10s %10s' % ('rule', 'fired', 'runs', 'dropped', 'avg ms', 'max ms'), file=sys.stderr)
+    for d in r.rules_timing():
+        row = (d['rule'], d['fired'], d['runs'], d['dropped'], d['avg_ms'], d['max_ms'])
+        print('%-30s %8s %8s %8s %10s %10s' % row, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
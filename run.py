@@ -21,15 +21,20 @@ from actors.mqtt import MqttActor
 from actors.slack import SlackActor
 from core import Context
 from core import http_server
+from core.archive import Archive
+from core.commands import DEFAULT_TIMEOUT
 from core.context import CB_ONCHECK, CB_ONCHANGE
-from core.items import read_item
-from core.rules import Rule, ThermostatRule
+from core.journal import Journal, replay
+from core.loader import Loader
+from core.snapshot import TYPE_NAMES, item_state
 
 LOG = logging.getLogger('mahno.' + __name__)
 RULES_LOG = logging.getLogger('mahno.core.rules')
 
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 DUMP_FILE = os.path.join(BASE_PATH, 'mahno.dump')
+JOURNAL_FILE = os.path.join(BASE_PATH, 'mahno.journal')
+SNAPSHOT_FILE = os.path.join(BASE_PATH, 'mahno.snapshot')
 
 
 class Main(object):
@@ -37,15 +42,17 @@ class Main(object):
     futs = []
 
     def __init__(self, args):
-        signal.signal(signal.SIGUSR1, self.load_items_rules)
         signal.signal(signal.SIGTERM, self.stop)
         self.loop = None
+        self.journal = None
+        self.dirty = set()
 
         self.context = Context()
         self.context.config = {'server': {'port': 8880}}
-        self.context.add_cb(CB_ONCHANGE, self.on_item_change)
+        self.context.add_cb(CB_ONCHANGE, self.context.fire_rules, batch=True)
 
         self.conf_dir = args.config_dir or os.path.join(BASE_PATH, 'config')
+        self.loader = Loader(self.context, self.conf_dir)
         self.load_config()
 
     def init_actors(self):
@@ -53,7 +60,8 @@ class Main(object):
         self.context.actors = {'mqtt': mqtt_act, 'astro': AstroActor()}
 
         if self.context.config['mqtt'].get('out_topic'):
-            self.context.add_cb(CB_ONCHECK, mqtt_act.send_out)
+            # sync batch callback only queues values, one out_sender task publishes them
+            self.context.add_cb(CB_ONCHECK, mqtt_act.send_out, batch=True)
 
         if 'modbus' in self.context.config:
             LOG.info('add modbus actor host %s', self.context.config['modbus']['host'])
@@ -76,11 +84,16 @@ class Main(object):
         for actor in self.context.actors.values():
             actor.init(self.context.config, self.context)
 
+        self.context.setup_queues()
+
         try:
-            self.load_dump(DUMP_FILE)
+            self.load_state()
         except:
             LOG.exception('cannot load state')
 
+        self.start_journal()
+        self.start_archive()
+
     def debug(self, sig, stack):
         LOG.info('DEBUG!!!')
         with open('running_stack', 'w') as f:
@@ -91,14 +104,102 @@ class Main(object):
             f.write('\n')
 
     def stop(self, *args):
-        self.save_dump(DUMP_FILE)
+        self.save_state()
         sys.exit(0)
 
-    def save_dump(self, fn):
-        LOG.info('saving state')
-        dump = self.context.items.as_list()
-        with open(fn, 'wb') as f:
-            pickle.dump(dump, f)
+    def state_config(self):
+        conf = self.context.config.get('state', {})
+        return (conf.get('journal', JOURNAL_FILE),
+                conf.get('snapshot', SNAPSHOT_FILE),
+                conf.get('fsync_interval', 1),
+                conf.get('compact_interval', 300))
+
+    def load_state(self):
+        journal_fn, snapshot_fn, _, _ = self.state_config()
+
+        if not os.path.isfile(journal_fn) and not os.path.isfile(snapshot_fn):
+            if os.path.isfile(DUMP_FILE):
+                self.load_dump(DUMP_FILE)
+                os.rename(DUMP_FILE, DUMP_FILE + '.old')
+                LOG.info('dump migrated, old file renamed to %s.old', DUMP_FILE)
+            return
+
+        LOG.info('loading state from %s and %s', snapshot_fn, journal_fn)
+
+        for name, type_name, value, checked, changed in replay(journal_fn, snapshot_fn).values():
+            s = self.context.items.get_item(name)
+            if not s:
+                continue
+            if type_name and type_name != TYPE_NAMES.get(type(s)):
+                LOG.info('item %s type changed, state is not restored', name)
+                continue
+            try:
+                s.restore(value, checked, changed)
+            except:
+                LOG.exception('cannot restore item %s', name)
+
+    def start_journal(self):
+        journal_fn, snapshot_fn, fsync_interval, _ = self.state_config()
+        self.journal = Journal(journal_fn, snapshot_fn, fsync_interval)
+        self.journal.start()
+        self.context.add_cb(CB_ONCHANGE, functools.partial(self.journal.on_change, items=self.context.items),
+                            batch=True)
+        self.context.add_cb(CB_ONCHECK, self.mark_dirty, batch=True)
+
+        # first snapshot has all items
+        self.dirty = set(x.name for x in self.context.items)
+        self.compact_journal()
+
+    def start_archive(self):
+        conf = self.context.config.get('archive')
+
+        if not conf:
+            return
+
+        archive = Archive(conf.get('path', os.path.join(BASE_PATH, 'mahno.sqlite')),
+                          conf.get('flush_interval', 5),
+                          conf.get('retention'))
+        archive.set_items(self.context.items)
+        archive.start()
+        self.context.archive = archive
+        self.context.add_cb(CB_ONCHECK, archive.on_check, batch=True)
+
+    def mark_dirty(self, checks):
+        for item, _ in checks:
+            self.dirty.add(item.name)
+
+    def compact_journal(self, stop=False):
+        """
+        Take states of dirty items on loop, encoding and writing is done by journal thread
+        """
+        if self.journal is None:
+            return
+
+        states = []
+        for name in self.dirty:
+            item = self.context.items.get_item(name)
+            if item is not None:
+                states.append(item_state(item))
+        self.dirty = set()
+        names = [x.name for x in self.context.items]
+
+        if stop:
+            self.journal.stop(states, names)
+            self.journal = None
+        else:
+            self.journal.compact(states, names)
+
+    def save_state(self):
+        if self.journal is not None:
+            LOG.info('saving state')
+            self.compact_journal(stop=True)
+
+    async def journal_compactor(self):
+        interval = self.state_config()[3]
+
+        while self.running:
+            await asyncio.sleep(interval)
+            self.compact_journal()
 
     def load_dump(self, fn):
         if not os.path.isfile(fn):
@@ -113,10 +214,7 @@ class Main(object):
         for st in dump:
             s = self.context.items.get_item(st['name'])
             if s:
-                s._value = s.convert_value(st['value'])
-                s.changed = st['changed']
-                s.checked = st['checked']
-                # s.ttl = st.get('ttl', 0)
+                s.restore(st['_value'], st['checked'], st['changed'])
 
     def load_config(self):
         LOG.info('loading config files from %s', self.conf_dir)
@@ -126,85 +224,31 @@ class Main(object):
             sys.exit(1)
 
         self.context.config = yaml.load(open(os.path.join(self.conf_dir, 'config.yml'), 'r', encoding='UTF-8'))
-        self.load_items_rules()
-
-    def load_items_rules(self):
-        LOG.info('loading items and rules')
-        self.context.rules = []
-
-        for s in os.listdir(self.conf_dir):
-            if s.startswith('items_') and s.endswith('.yml'):
-                try:
-                    self.load_items_file(os.path.join(self.conf_dir, s))
-                except:
-                    LOG.exception('yml items load')
-            elif s.startswith('rules_') and s.endswith('.yml'):
-                try:
-                    self.load_rules_file(os.path.join(self.conf_dir, s))
-                except:
-                    LOG.exception('yml rules load')
-
-    def load_items_file(self, fname):
-        conf = yaml.load(open(fname, 'r', encoding='UTF-8'))
-
-        n = 0
-        for item in conf:
-            s = read_item(item)
-            if s:
-                self.context.items.add_item(s)
-                n += 1
-        LOG.info('load %s items from config %s', n, fname)
-
-    def load_rules_file(self, fname):
-        LOG.info('load rules from file %s', fname)
-        conf = yaml.load(open(fname, 'r', encoding='UTF-8'))
 
-        n = 0
-        for r in conf:
-            rule = None
+        if self.context.config.get('templates', {}).get('cache_dir'):
+            self.context.templates.set_cache_dir(self.context.config['templates']['cache_dir'])
 
-            if 'trigger' in r:
-                rule = Rule(r)
-            if 'thermostat' in r:
-                rule = ThermostatRule(r)
+        self.load_items_rules()
 
-            if not rule:
-                LOG.error('cannon make rule from definition %s', r)
-                continue
+    def load_items_rules(self, *args):
+        LOG.info('loading items and rules')
+        self.loader.reload()
 
-            self.context.add_rule(rule)
-            n += 1
-        LOG.info('load %s rules from file %s', n, fname)
+    async def commands_processor(self, actor, queue):
+        """
+        Run commands of actor one by one in priority order, slow command is cancelled after timeout
+        """
+        timeout = self.context.config.get('commands', {}).get('timeout', DEFAULT_TIMEOUT)
 
-    async def cron_checker(self):
-        while self.running:
-            for rule in self.context.rules:
-                try:
-                    v = rule.check_time()
-                    if v is not None:
-                        self.do_async(rule.process_cron, v)
-                except:
-                    RULES_LOG.exception('cron worker on rule %s', rule.name)
-
-            await asyncio.sleep(0.5)
-
-    async def on_item_change(self, name, val, old_val, age):
-        for rule in self.context.rules:
-            if rule.check_item_change(name, val, old_val, age):
-                try:
-                    self.do_async(rule.process_item_change, name, val, old_val, age)
-                except:
-                    RULES_LOG.exception('item change on rule %s', rule.name)
-
-    async def commands_processor(self):
         while self.running:
-            if self.context.commands:
-                cmd, args = self.context.commands.popleft()
-                for actor in self.context.actors.values():
-                    if actor.name == cmd:
-                        self.do_async(actor.command, args)
-
-            await asyncio.sleep(0.01)
+            args = await queue.get()
+            try:
+                await asyncio.wait_for(actor.command(args), timeout)
+            except asyncio.TimeoutError:
+                queue.timed_out += 1
+                LOG.error('command %s to actor %s timed out after %s s', args, actor.name, timeout)
+            except:
+                LOG.exception('command %s to actor %s', args, actor.name)
 
     def do_async(self, fn, *args):
         if asyncio.iscoroutinefunction(fn):
@@ -215,16 +259,24 @@ class Main(object):
     def run(self):
         self.loop = asyncio.get_event_loop()
         self.context.loop = self.loop
+        # reload changes rules, indexes and timer heaps, run it on the loop between callbacks
+        self.loop.add_signal_handler(signal.SIGUSR1, self.load_items_rules)
         self.futs = []
         self.init_actors()
+        self.context.init_expiry()
+        self.context.init_cron()
+        self.context.init_for_triggers()
+
+        self.futs.append(asyncio.ensure_future(self.journal_compactor()))
 
-        for s in [self.cron_checker(), self.commands_processor()]:
-            self.futs.append(asyncio.ensure_future(s))
+        for key, queue in self.context.queues.items():
+            self.futs.append(asyncio.ensure_future(self.commands_processor(self.context.actors[key], queue)))
 
         for actor in self.context.actors.values():
             self.futs.append(asyncio.ensure_future(actor.loop()))
 
         if self.context.actors.get('mqtt') and self.context.config['mqtt'].get('out_topic'):
+            self.futs.append(asyncio.ensure_future(self.context.actors.get('mqtt').out_sender()))
             self.futs.append(asyncio.ensure_future(self.context.actors.get('mqtt').periodical_sender()))
 
         try:
@@ -238,7 +290,10 @@ class Main(object):
                 self.do_async(x.stop)
 
             asyncio.wait(self.futs, loop=self.loop)
-            self.save_dump(DUMP_FILE)
+            self.save_state()
+
+            if self.context.archive is not None:
+                self.context.archive.stop()
             self.loop.close()
 
 
@@ -90,18 +90,22 @@ app.controller('MainCtrl', function ($log, $scope, $http, $timeout) {
         };
 
         socket.onmessage = function(event) {
-            var obj = JSON.parse(event.data);
-            for (var item of $scope.data) {
-                 if (item != null && item.name == obj.name) {
-                        item.value = obj.value;
-                        item._value = obj._value;
-                        item.formatted = obj.formatted;
-                        item.checked = obj.checked;
-                        item.changed = obj.changed;
-                        $scope.$apply();
-                        break;
-                 }
+            var data = JSON.parse(event.data);
+            if (!Array.isArray(data))
+                data = [data];
+            for (var obj of data) {
+                for (var item of $scope.data) {
+                     if (item != null && item.name == obj.name) {
+                            item.value = obj.value;
+                            item._value = obj._value;
+                            item.formatted = obj.formatted;
+                            item.checked = obj.checked;
+                            item.changed = obj.changed;
+                            break;
+                     }
+                }
             }
+            $scope.$apply();
         };
     };
 
@@ -0,0 +1,52 @@
+# coding: utf-8
+
+import os
+import tempfile
+import time
+
+from core.archive import Archive, connect
+from core.items import read_item
+
+
+def test_archive():
+    fn = os.path.join(tempfile.mkdtemp(), 'archive.sqlite')
+    a = Archive(fn, flush_interval=0.01, retention={'temperature': {'raw': 30}})
+    item = read_item({'name': 'temp', 'type': 'number', 'tags': ['temperature']})
+    a.set_items([item])
+    assert a.policies['temp']['raw'] == 30 * 24 * 3600
+    assert a.policies['temp']['1h'] == 3650 * 24 * 3600
+
+    a.start()
+    for v in (10, 20, 30):
+        item.set_value(v)
+        a.on_check([(item, True)])
+    a.stop()
+
+    t = item.checked
+    raw = a.query('temp', t - 10, t + 10, step=1)
+    assert sum(x[4] for x in raw) == 3
+
+    res = a.query('temp', t - 3600, t + 3600, step=3600 * 2)
+    assert len(res) == 1
+    assert res[0][1:] == [10, 30, 20, 3]
+
+
+def test_archive_cleanup_removed():
+    fn = os.path.join(tempfile.mkdtemp(), 'archive.sqlite')
+    a = Archive(fn, flush_interval=0.01, retention={'default': {'raw': 1, '1m': 1, '1h': 1}})
+    a.start()
+    a.stop()
+
+    conn = connect(fn)
+    old = time.time() - 2 * 24 * 3600
+    a._write(conn, [('gone', old, 1.0), ('temp', old, 2.0)])
+
+    # 'gone' was removed from config, 'temp' has its own policy
+    item = read_item({'name': 'temp', 'type': 'number'})
+    a.set_items([item])
+    a.policies['temp'] = {'raw': 7 * 24 * 3600, '1m': 7 * 24 * 3600, '1h': 7 * 24 * 3600}
+    a._cleanup(conn)
+
+    for table in ('samples', 'rollup_1m', 'rollup_1h'):
+        assert [r[0] for r in conn.execute('SELECT item FROM {}'.format(table))] == ['temp']
+    conn.close()
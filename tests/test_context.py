@@ -0,0 +1,174 @@
+# coding: utf-8
+
+import asyncio
+import time
+
+from core.commands import CommandQueue, PRIO_INTERACTIVE, PRIO_RULE, PRIO_PERIODIC
+from core.context import Context, CB_ONCHANGE, CB_ONCHECK
+from core.items import read_item
+
+
+def make_context():
+    context = Context()
+    context.loop = asyncio.new_event_loop()
+    return context
+
+
+def run_pending(context, t=0.01):
+    context.loop.run_until_complete(asyncio.sleep(t))
+
+
+def test_expiry():
+    context = make_context()
+    changes = []
+    context.add_cb(CB_ONCHANGE, lambda name, val, old_val, age: changes.append((name, val, old_val)))
+    context.items.add_item(read_item({'name': 'temp', 'type': 'number', 'ttl': 0.05}))
+
+    context.set_item_value('temp', 20)
+    run_pending(context)
+    assert context.get_item_value('temp') == 20
+    assert changes == [('temp', 20, None)]
+
+    run_pending(context, 0.1)
+    assert context.get_item_value('temp') is None
+    assert changes[-1] == ('temp', None, 20)
+
+    context.set_item_value('temp', 20)
+    run_pending(context)
+    assert context.get_item_value('temp') == 20
+    assert changes[-1] == ('temp', 20, None)
+    context.loop.close()
+
+
+def test_expiry_scheduled_before_loop():
+    context = Context()
+    context.items.add_item(read_item({'name': 'temp', 'type': 'number', 'ttl': 0.05, 'default': 1}))
+    context.schedule_expiry(context.items.get_item('temp'))
+    context.loop = asyncio.new_event_loop()
+    context.init_expiry()
+    run_pending(context, 0.1)
+    assert context.get_item_value('temp') is None
+    context.loop.close()
+
+
+def test_batch():
+    context = make_context()
+    batches = []
+    single = []
+    context.add_cb(CB_ONCHANGE, lambda changes: batches.append(changes), batch=True)
+    context.add_cb(CB_ONCHANGE, lambda name, val, old_val, age: single.append(name))
+    for name in ('a', 'b', 'c'):
+        context.items.add_item(read_item({'name': name, 'type': 'number'}))
+
+    context.set_item_values({'a': 1, 'b': 2})
+    run_pending(context)
+    assert len(batches) == 1
+    assert [(x.name, x.value, x.old_value) for x in batches[0]] == [('a', 1, None), ('b', 2, None)]
+    assert single == ['a', 'b']
+
+    with context.batch():
+        context.set_item_value('c', 1)
+        context.set_item_value('c', 2)
+        context.set_item_value('a', 2)
+        context.set_item_value('a', 1)
+    run_pending(context)
+    assert len(batches) == 2
+    assert [(x.name, x.value, x.old_value) for x in batches[1]] == [('c', 2, None)]
+    context.loop.close()
+
+
+def test_callbacks_dispatch():
+    context = make_context()
+    calls = []
+    flushes = []
+    for name in ('a', 'b', 'c'):
+        context.items.add_item(read_item({'name': name, 'type': 'number'}))
+
+    async def slow(checks):
+        calls.append(('slow', [x[0].name for x in checks], asyncio.current_task()))
+
+    async def fast(checks):
+        calls.append(('fast', [x[0].name for x in checks], asyncio.current_task()))
+
+    async def detached(item, changed):
+        calls.append(('detached', item.name, asyncio.current_task()))
+
+    context.add_cb(CB_ONCHECK, slow, batch=True, priority=20)
+    context.add_cb(CB_ONCHECK, fast, batch=True, priority=10)
+    context.add_cb(CB_ONCHECK, detached, detached=True)
+    context.add_cb(CB_ONCHECK, lambda checks: calls.append(('sync', len(checks), None)), batch=True)
+
+    flush = context._flush
+    context._flush = lambda: (flushes.append(1), flush())
+
+    for name in ('a', 'b', 'c'):
+        context.set_item_value(name, 1)
+
+    # sync callbacks are called inline
+    assert [x[:2] for x in calls] == [('sync', 1)] * 3
+    run_pending(context)
+
+    # one flush per loop turn, batched callbacks run in one task ordered by priority
+    assert len(flushes) == 1
+    batched = [x for x in calls if x[0] in ('fast', 'slow')]
+    assert [x[:2] for x in batched] == [('fast', ['a']), ('fast', ['b']), ('fast', ['c']),
+                                        ('slow', ['a']), ('slow', ['b']), ('slow', ['c'])]
+    assert len(set(x[2] for x in batched)) == 1
+
+    # detached callbacks get own task for every call
+    detached_calls = [x for x in calls if x[0] == 'detached']
+    assert [x[1] for x in detached_calls] == ['a', 'b', 'c']
+    assert len(set(x[2] for x in detached_calls + batched[:1])) == 4
+    context.loop.close()
+
+
+def test_command_queue():
+    queue = CommandQueue('test', maxsize=3)
+    queue.put('rule1', PRIO_RULE)
+    queue.put('periodic', PRIO_PERIODIC)
+    queue.put('ui', PRIO_INTERACTIVE, key='lamp')
+    queue.put('ui2', PRIO_INTERACTIVE, key='lamp')
+    assert queue.coalesced == 1
+
+    queue.put('rule2', PRIO_RULE)
+    assert queue.dropped == 1
+    assert not queue.put('periodic2', PRIO_PERIODIC)
+    assert queue.dropped == 2
+
+    assert [queue.get_nowait() for _ in range(4)] == ['ui2', 'rule1', 'rule2', None]
+    assert queue.processed == 3
+
+    # same key is merged across lanes into the more important one
+    queue = CommandQueue('test')
+    queue.put('Off', PRIO_RULE, key='lamp')
+    queue.put('x', PRIO_RULE, key='fan')
+    queue.put('On', PRIO_INTERACTIVE, key='lamp')
+    queue.put('Off2', PRIO_PERIODIC, key='lamp')
+    assert queue.coalesced == 2
+    assert [queue.get_nowait() for _ in range(3)] == ['Off2', 'x', None]
+
+
+def test_cron_schedule():
+    from core.rules import Rule
+
+    context = make_context()
+    rule = Rule({'name': 'cron', 'trigger': {'time': '* * * * *'}})
+    context.add_rule(rule)
+    fired = []
+    rule.process_cron = lambda v: fired.append(v)
+    now = time.time()
+
+    assert len(context._cron) == 1
+    assert now < rule.next_run <= now + 60
+
+    # timer is late, due minute is fired once and next one is scheduled after now
+    context._cron = [(now - 0.5, 0, rule, rule.cron[0])]
+    context.check_cron()
+    run_pending(context)
+    assert fired == ['cron * * * * *']
+    assert len(context._cron) == 1
+    assert context._cron[0][0] > now
+
+    context.clear_rules()
+    assert context._cron == []
+    context.loop.close()
@@ -29,3 +29,25 @@ def test_check_cron_value():
 
     assert cron.check_cron_values(('20 15 * * 1-5', '0 10 * * 6,7'), dt, 0) == '20 15 * * 1-5'
     assert cron.check_cron_values(('20 0 * * 1-5', '20 15 * * 6,7'), dt, 0) is None
+
+
+def test_next_after():
+    t = datetime(2016, 10, 5, 15, 20, 2).timestamp()
+
+    assert cron.CronExpr('* * * * *').next_after(t) == datetime(2016, 10, 5, 15, 21).timestamp()
+    assert cron.CronExpr('20 15 * * *').next_after(t) == datetime(2016, 10, 6, 15, 20).timestamp()
+    assert cron.CronExpr('*/15').next_after(t) == datetime(2016, 10, 5, 15, 30).timestamp()
+    assert cron.CronExpr('0 10 * * 6,7').next_after(t) == datetime(2016, 10, 8, 10, 0).timestamp()
+    assert cron.CronExpr('0 0 1 1 *').next_after(t) == datetime(2017, 1, 1, 0, 0).timestamp()
+    assert cron.CronExpr('0 12 29 2 *').next_after(t) == datetime(2020, 2, 29, 12, 0).timestamp()
+    assert cron.CronExpr('0 0 31 2 *').next_after(t) is None
+
+
+def test_invalid():
+    for expr in ('61 * * * *', '* 24 * * *', '* * * * * *', 'x * * * *', '*/0 * * * *'):
+        try:
+            cron.CronExpr(expr)
+        except ValueError:
+            pass
+        else:
+            assert False, expr
@@ -0,0 +1,57 @@
+# coding: utf-8
+
+from core.context import Context
+from core.expr import ExprError, compile_expr
+from core.items import read_item
+from core.rules import Rule
+
+
+def test_expressions():
+    for source, env, res in (
+            ('value|float * 1.8 + 32', {'value': '20'}, 68.0),
+            ('\'On\' if value == \'Off\' else \'Off\'', {'value': 'Off'}, 'On'),
+            ('\'On\' if value == \'Off\' else \'Off\'', {'value': 'On'}, 'Off'),
+            ('2 + 3 * 4 - 10 // 3 % 2', {}, 13),
+            ('-value|abs', {'value': -3}, -3),
+            ('1 < value <= 3', {'value': 3}, True),
+            ('1 < value <= 3', {'value': 4}, False),
+            ('value not in [\'a\', \'b\'] and old_value in [\'a\']', {'value': 'c', 'old_value': 'a'}, True),
+            ('not value or 2', {'value': 1}, 2),
+            ('max(1, value, 3) ~ \' C\'', {'value': 5}, '5 C'),
+            ('value|round(1)', {'value': 1.26}, 1.3),
+            ('old_value|default(0) + 1', {'old_value': None}, 1),
+            ('value|int', {'value': 'x'}, 0),
+            ('name ~ \': \' ~ triggered', {'name': 'a', 'triggered': 't'}, 'a: t'),
+    ):
+        assert compile_expr(source)(env) == res, source
+
+
+def test_invalid():
+    for source in ('value.__class__', '__import__(\'os\')', 'value[0]', '1 +', 'x', 'value|nope', '(1', '1 if 2',
+                   '\'a\' \'b\'', 'open(\'x\')', 5):
+        try:
+            compile_expr(source)
+        except ExprError:
+            pass
+        else:
+            assert False, source
+
+
+def test_rule_value_expr():
+    context = Context()
+    context.items.add_item(read_item({'name': 'a', 'type': 'number'}))
+    context.set_item_value('a', 20)
+    rule = Rule({'name': 'r', 'trigger': {'items': ['a']},
+                 'action': [{'service': 'set_state', 'item_id': 'a', 'value_expr': 'item(\'a\') + value'}]})
+    context.add_rule(rule)
+    assert context.expressions.to_dict()['size'] == 1
+    assert rule.get_value(rule.data['action'][0], {'value': 5}) == 25
+
+    rule = Rule({'name': 'r', 'trigger': {'items': ['a']},
+                 'action': [{'service': 'set_state', 'item_id': 'a', 'value_expr': 'value +'}]})
+    try:
+        context.add_rule(rule)
+    except ValueError:
+        pass
+    else:
+        assert False
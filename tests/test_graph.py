@@ -0,0 +1,50 @@
+# coding: utf-8
+
+import asyncio
+
+from core.context import Context
+from core.items import read_item
+from core.rules import Rule
+
+RULES = [
+    {'name': 'a', 'trigger': {'items': ['x']}, 'action': [{'service': 'set_state', 'item_id': 'y', 'value': 1}]},
+    {'name': 'b', 'trigger': {'items': ['y']},
+     'condition': {'condition_type': 'and', 'conditions': [{'condition_type': 'state', 'item_id': 'z', 'state': 1}]},
+     'action': [{'service': 'command', 'item_id': 'x', 'value': 1}]},
+    {'name': 'c', 'trigger': {'items': ['y']}, 'action': [{'service': 'log', 'data': {'message': 'y'}}]},
+]
+
+
+def make_context():
+    context = Context()
+    for r in RULES:
+        context.add_rule(Rule(r))
+    context.build_graph()
+    return context
+
+
+def test_graph():
+    graph = make_context().graph
+
+    assert graph.edges == {'a': ['b', 'c'], 'b': ['a'], 'c': []}
+    assert graph.cycles() == [['a', 'b']]
+
+    d = graph.affected('x')
+    assert d['triggered'] == [{'rule': 'a', 'depth': 1}, {'rule': 'b', 'depth': 2}, {'rule': 'c', 'depth': 2}]
+    assert d['written_by'] == ['b']
+    assert graph.affected('z')['conditions'] == ['b']
+    assert graph.to_dict()['rules']['b']['reads'] == ['z']
+
+
+def test_cascade_depth():
+    context = make_context()
+    context.loop = asyncio.new_event_loop()
+    for name in ('x', 'y', 'z'):
+        context.items.add_item(read_item({'name': name, 'type': 'number'}))
+    changes = []
+    context.add_cb('onchange', lambda ch: changes.extend(ch), batch=True)
+
+    rule = context.rules[0]
+    context.loop.run_until_complete(rule.process_item_change('x', 1, None, 0, 3))
+    assert [(ch.name, ch.depth) for ch in changes] == [('y', 4)]
+    context.loop.close()
@@ -0,0 +1,131 @@
+# coding: utf-8
+
+import json
+
+from core.items import Items, read_item
+
+
+def make_items():
+    items = Items()
+    items.add_item(read_item({'name': 'b_temp', 'type': 'number', 'tags': ['temperature'],
+                              'input': {'channel': 'mqtt', 'topic': 'sensors/b'}}))
+    items.add_item(read_item({'name': 'a_temp', 'type': 'number', 'tags': ['temperature', 'room'],
+                              'input': {'channel': 'mqtt', 'topic': 'sensors/a'}}))
+    items.add_item(read_item({'name': 'relay', 'type': 'switch',
+                              'input': {'channel': 'modbus', 'fn': 3, 'addr': 1, 'reg': 5}}))
+    items.add_item(read_item({'name': 'plug', 'type': 'switch', 'input': 'kankun:plug'}))
+    return items
+
+
+def test_get_item():
+    items = make_items()
+    assert items.num == 4
+    assert items.get_item('relay').name == 'relay'
+    assert items.get_item('nothing') is None
+
+
+def test_sorted():
+    items = make_items()
+    assert [x.name for x in items] == ['a_temp', 'b_temp', 'plug', 'relay']
+    assert [x['name'] for x in items.as_list()] == ['a_temp', 'b_temp', 'plug', 'relay']
+    assert [x['name'] for x in items.as_list('temperature')] == ['a_temp', 'b_temp']
+    assert items.as_list('nothing') == []
+
+
+def test_inputs():
+    items = make_items()
+    assert [x.name for x in items.get_by_input('mqtt', 'sensors/a')] == ['a_temp']
+    assert [x.name for x in items.get_by_input('modbus', (3, 1, 5))] == ['relay']
+    assert [x.name for x in items.get_by_input('kankun:plug')] == ['plug']
+    assert list(items.get_by_input('mqtt', 'sensors/c')) == []
+
+
+def test_value_is():
+    items = make_items()
+    items.set_item_value('relay', 'on')
+    assert items.value_is('relay', 'On')
+    assert not items.value_is('relay', 'Off')
+    assert not items.value_is('nothing', 'On')
+
+
+def test_history():
+    item = read_item({'name': 'temp', 'type': 'number', 'history': {'size': 4}})
+    for i in range(6):
+        item.set_value(i)
+
+    assert len(item.history) == 4
+    times, values = item.history.window()
+    assert list(values) == [2.0, 3.0, 4.0, 5.0]
+    assert list(times) == sorted(times)
+
+    st = item.history.stats(percentiles=[50])
+    assert st['count'] == 4
+    assert st['min'] == 2.0
+    assert st['max'] == 5.0
+    assert st['avg'] == 3.5
+    assert st['percentiles']['50'] == 3.5
+    assert item.history.stats(window=-1)['count'] == 0
+
+
+def test_history_switch():
+    item = read_item({'name': 'sw', 'type': 'switch', 'history': 10})
+    item.set_value('on')
+    item.set_value('off')
+    assert list(item.history.window()[1]) == [1.0, 0.0]
+
+
+def test_serialization_cache():
+    item = read_item({'name': 'temp', 'type': 'number', 'format': '{:.1f} C', 'tags': ['t']})
+    item.set_value(20)
+    v = item.version
+    d = item.to_dict()
+    assert d['formatted'] == '20.0 C'
+    assert set(json.loads(item.to_json())) == set(d)
+    assert json.loads(item.to_json())['formatted'] == '20.0 C'
+
+    item.set_value(20)
+    assert item.version == v
+    assert item.to_dict()['checked'] >= d['checked']
+
+    item.set_value(21)
+    assert item.version > v
+    assert item.to_dict()['formatted'] == '21.0 C'
+
+    item.configure({'name': 'temp', 'type': 'number', 'format': 'time_minutes'})
+    assert item.to_dict()['formatted'] == '0м'
+
+    items = Items()
+    items.add_item(item)
+    assert [x['name'] for x in json.loads(items.as_json())] == ['temp']
+
+
+def test_configure_config():
+    defs = [{'name': 'temp', 'type': 'number', 'ttl': 60, 'ui': True, 'tags': ['t'], 'decimals': 1,
+             'input': {'channel': 'mqtt', 'topic': 'sensors/t'}, 'format': '{:.1f} C', 'history': {'size': 10}},
+            {'name': 'mode', 'type': 'select', 'choices': ['home', 'away'], 'output': {'channel': 'mqtt'},
+             'fast_change': True, 'h_name': 'Mode'},
+            {'name': 'lamp', 'type': 'switch'}]
+
+    for d in defs:
+        item = read_item(d)
+        # subclass fields are slots too, items have no __dict__
+        assert not hasattr(item, '__dict__')
+
+        config = item.config
+        expected = {'ttl': 0, 'ui': False, 'tags': []}
+        expected.update((k, v) for k, v in d.items() if k != 'type')
+        assert config == expected
+
+        copy = read_item(dict(config, type=d['type']))
+        assert copy.config == config
+
+    item = read_item(defs[0])
+    item.set_value('1.26')
+    # decimals truncate
+    assert item.value == 1.2
+    assert item.decimals == 1
+
+    item = read_item(defs[1])
+    item.set_value('AWAY')
+    assert item.value == 'away'
+    assert item.choices == ['home', 'away']
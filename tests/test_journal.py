@@ -0,0 +1,60 @@
+# coding: utf-8
+
+import json
+import os
+import tempfile
+
+from core.items import read_item
+from core.journal import Journal, replay
+from core.snapshot import SnapshotWriter, item_state, read_snapshot
+
+
+def test_journal():
+    d = tempfile.mkdtemp()
+    journal_fn = os.path.join(d, 'journal')
+    snapshot_fn = os.path.join(d, 'snapshot')
+    a = read_item({'name': 'a', 'type': 'number'})
+    b = read_item({'name': 'b', 'type': 'switch'})
+
+    j = Journal(journal_fn, snapshot_fn, fsync_interval=0.01)
+    j.start()
+    a.set_value(1)
+    j.record(a)
+    b.set_value('on')
+    j.record(b)
+    j.compact([item_state(a), item_state(b)])
+    a.set_value(2)
+    j.record(a)
+    j.stop()
+
+    with open(journal_fn, 'a') as f:
+        f.write('["b", "O')
+
+    state = replay(journal_fn, snapshot_fn)
+    assert state['a'][2] == 2
+    assert state['b'][1] == 'switch'
+    assert state['b'][2] == 'On'
+    assert state['b'][3] == b.checked
+
+
+def test_snapshot():
+    fn = os.path.join(tempfile.mkdtemp(), 'snapshot')
+    items = [read_item({'name': 'num', 'type': 'number', 'default': 1.5}),
+             read_item({'name': 'date', 'type': 'date', 'default': 1500000000}),
+             read_item({'name': 'text', 'type': 'text', 'default': 'привет'}),
+             read_item({'name': 'empty', 'type': 'text'})]
+
+    w = SnapshotWriter(fn)
+    w.save([item_state(x) for x in items])
+    assert read_snapshot(fn) == [item_state(x) for x in sorted(items, key=lambda x: x.name)]
+
+    items[0].set_value(2)
+    w.save([item_state(items[0])], names=['num', 'text'])
+    assert [(x[0], x[2]) for x in read_snapshot(fn)] == [('num', 2.0), ('text', 'привет')]
+
+
+def test_json_snapshot():
+    fn = os.path.join(tempfile.mkdtemp(), 'snapshot')
+    with open(fn, 'w') as f:
+        json.dump({'version': 1, 'items': [['a', 1, 2, 3]]}, f)
+    assert read_snapshot(fn) == [('a', '', 1, 2, 3)]
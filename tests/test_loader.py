@@ -0,0 +1,178 @@
+# coding: utf-8
+
+import os
+
+from core.context import Context
+from core.loader import Loader
+
+ITEMS = '''
+- name: lamp
+  type: switch
+  tags: [light]
+- name: temp
+  type: number
+'''
+
+RULES = '''
+- name: r1
+  trigger:
+    items: [temp]
+  condition:
+    condition_type: state
+    item_id: lamp
+    state: 'On'
+  action:
+  - service: log
+    data: {message: 'x'}
+- name: r2
+  trigger:
+    items: [lamp]
+'''
+
+
+def write(path, name, text):
+    fn = os.path.join(path, name)
+    with open(fn, 'w') as f:
+        f.write(text)
+    # mtime resolution can be too coarse for fast test
+    st = os.stat(fn)
+    os.utime(fn, (st.st_atime, st.st_mtime + 1 + len(text) * 1e-3))
+
+
+def test_reload(tmpdir):
+    path = str(tmpdir)
+    write(path, 'items_a.yml', ITEMS)
+    write(path, 'rules_a.yml', RULES)
+
+    context = Context()
+    loader = Loader(context, path)
+    loader.reload()
+    context.build_graph()
+
+    assert context.items.num == 2
+    assert [r.name for r in context.rules] == ['r1', 'r2']
+    assert loader.reload() == (0, 0)
+
+    context.set_item_value('lamp', 'On')
+    r1, r2 = context.rules
+    r1.last_run = 100
+    assert r1.check_conditions()
+
+    # same type: value is kept, rule is unchanged
+    write(path, 'items_a.yml', ITEMS.replace('[light]', '[light, room]'))
+    assert loader.reload() == (1, 0)
+    assert context.get_item_value('lamp') == 'On'
+    assert [x.name for x in context.items.get_by_tag('room')] == ['lamp']
+    assert context.rules == [r1, r2]
+
+    # type change: item is replaced and rule condition recompiled
+    write(path, 'items_a.yml', ITEMS.replace('type: switch', 'type: text'))
+    loader.reload()
+    assert context.get_item_value('lamp') is None
+    assert not r1.check_conditions()
+    context.set_item_value('lamp', 'On')
+    assert r1.check_conditions()
+
+    # changed rule keeps last_run, unchanged one is the same object
+    write(path, 'rules_a.yml', RULES.replace("message: 'x'", "message: 'y'"))
+    assert loader.reload() == (0, 1)
+    assert context.rules[0] is r2
+    assert context.rules[1].last_run == 100
+    assert [r.name for r in context.rules_for_change('temp', 1, 2)] == ['r1']
+
+    os.remove(os.path.join(path, 'rules_a.yml'))
+    loader.reload()
+    assert context.rules == []
+    assert context.rules_for_change('temp', 1, 2) == []
+
+
+def test_invalid_definitions(tmpdir):
+    path = str(tmpdir)
+    write(path, 'items_a.yml', ITEMS)
+    write(path, 'rules_a.yml', RULES)
+
+    context = Context()
+    loader = Loader(context, path)
+    loader.reload()
+    rules_file = loader.files[os.path.join(path, 'rules_a.yml')]
+    digest = rules_file.digest
+
+    # item without type and thermostat without sensor are skipped, valid changes of the same files are applied
+    write(path, 'items_a.yml', ITEMS + '- name: broken\n')
+    write(path, 'rules_a.yml', RULES.replace("'x'", "'y'") + '- name: t\n  thermostat: {switch_item: lamp}\n')
+    loader.reload()
+    assert context.items.num == 2
+    assert sorted(r.name for r in context.rules) == ['r1', 'r2']
+    r1 = loader.rules['r1']
+    assert r1.data['action'][0]['data']['message'] == 'y'
+
+    # failed file is not marked as loaded and is applied again
+    assert rules_file.digest == digest
+    assert loader.reload() == (0, 0)
+
+    # rule failing to compile keeps the old one
+    write(path, 'rules_a.yml', RULES.replace("state: 'On'", "check: in\n    state: 'On'"))
+    loader.reload()
+    assert loader.rules['r1'] is r1
+    assert r1 in context.rules
+
+    write(path, 'items_a.yml', ITEMS.replace('[light]', '[room]'))
+    write(path, 'rules_a.yml', RULES.replace("'x'", "'z'"))
+    loader.reload()
+    assert rules_file.digest != digest
+    assert loader.rules['r1'].data['action'][0]['data']['message'] == 'z'
+
+
+def test_reload_ttl_history(tmpdir):
+    from core import clock
+
+    path = str(tmpdir)
+    items = ITEMS.replace('type: number', 'type: number\n  ttl: 10\n  history: 5')
+    write(path, 'items_a.yml', items)
+
+    vc = clock.VirtualClock(1000)
+    clock.set_clock(vc)
+    try:
+        context = Context()
+        context.loop = object()
+        loader = Loader(context, path)
+        loader.reload()
+        context.set_item_value('temp', 20)
+        context.schedule_expiry(context.items.get_item('temp'))
+        history = context.items.get_item('temp').history
+        assert history.count == 1
+
+        # ttl is removed: old deadline does not expire value, history is kept
+        write(path, 'items_a.yml', items.replace('  ttl: 10\n', '').replace('[light]', '[room]'))
+        loader.reload()
+        assert context.items.get_item('temp').history is history
+        vc.set(1020)
+        context.check_expired()
+        assert context.get_item_value('temp') == 20
+
+        # new item with default and ttl is scheduled
+        t2 = '- name: t2\n  type: number\n  default: 1\n  ttl: 5\n'
+        write(path, 'items_a.yml', items.replace('[light]', '[room]') + t2)
+        loader.reload()
+        assert context.get_item_value('t2') == 1
+        vc.set(1030)
+        context.check_expired()
+        assert context.get_item_value('t2') is None
+    finally:
+        clock.set_clock(clock.RealClock())
+
+
+def test_rule_compiled_once(tmpdir, monkeypatch):
+    from core.rules import Rule
+
+    path = str(tmpdir)
+    write(path, 'items_a.yml', ITEMS)
+    write(path, 'rules_a.yml', RULES)
+
+    compiled = []
+    compile_rule = Rule.compile
+    monkeypatch.setattr(Rule, 'compile', lambda self, context: (compiled.append(self.name),
+                                                                compile_rule(self, context)))
+
+    Loader(Context(), path).reload()
+    assert sorted(compiled) == ['r1', 'r2']
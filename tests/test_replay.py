@@ -0,0 +1,79 @@
+# coding: utf-8
+
+import os
+from datetime import datetime
+
+from core import clock
+from replay import Replay
+
+ITEMS = '''
+- name: pir
+  type: switch
+- name: light
+  type: switch
+  output: {channel: mqtt, topic: light/set}
+'''
+
+RULES = '''
+- name: light_on
+  trigger:
+    items:
+    - item_id: pir
+      to: 'On'
+  action:
+  - service: command
+    item_id: light
+    value: 'On'
+- name: light_off
+  trigger:
+    items:
+    - item_id: pir
+      to: 'Off'
+      for: {minutes: 5}
+  action:
+  - service: command
+    item_id: light
+    value: 'Off'
+- name: button
+  trigger:
+    mqtt:
+    - topic: button/+
+      payload: press
+  action:
+  - service: command
+    item_id: light
+    value: 'Off'
+- name: night
+  trigger:
+    time: '0 23 * * *'
+  action:
+  - service: command
+    item_id: light
+    value: 'Off'
+'''
+
+
+def test_replay(tmpdir):
+    for name, text in (('items_a.yml', ITEMS), ('rules_a.yml', RULES)):
+        with open(os.path.join(str(tmpdir), name), 'w') as f:
+            f.write(text)
+
+    t0 = datetime(2020, 1, 1, 22, 0).timestamp()
+    events = [
+        {'t': t0, 'item': 'pir', 'value': 'On'},
+        {'t': t0 + 10, 'item': 'pir', 'value': 'Off'},
+        {'t': t0 + 60, 'item': 'pir', 'value': 'On'},
+        {'t': t0 + 70, 'item': 'pir', 'value': 'Off'},
+        {'t': t0 + 600, 'topic': 'button/1', 'payload': 'press'},
+        {'t': t0 + 610, 'topic': 'button/1', 'payload': 'release'},
+        {'t': t0 + 7200, 'item': 'pir', 'value': 'On'},
+    ]
+
+    r = Replay(str(tmpdir))
+    r.run(events)
+
+    items = [(c['t'] - t0, c['value']) for c in r.context.commands if 'item' in c]
+    assert items == [(0, 'On'), (60, 'On'), (370, 'Off'), (600, 'Off'), (3600, 'Off'), (7200, 'On')]
+    assert {d['rule']: d['runs'] for d in r.rules_timing()} == {'light_on': 3, 'light_off': 1, 'button': 1,
+                                                                'night': 1}
+    assert isinstance(clock.get_clock(), clock.RealClock)
@@ -76,40 +76,84 @@ def test_trigger_time_based():
 
 
 def test_item_for():
-    i1 = TestItem('item1', 5)
-    i2 = TestItem('item2', 5)
-    context = TestContext()
-    context.items.add_item(i1)
-    context.items.add_item(i2)
-
-    t = yaml.load(rule)[2]
-    r = Rule(t)
-    assert r.name == 'rule3'
-    r.context = context
-
-    i2.value = 'on'
-    i2.age = 5
-    assert r.check_time() is None, r.triggered
-
-    i2.value = 'off'
-    i2.age = 10
-    assert r.check_time() is None
-
-    i2.value = 'on'
-    i2.age = 10
-    assert r.check_time() is not None
-
-    i2.value = 'on'
-    i2.age = 10
-    assert r.check_time() is None
-
-    i2.value = 'off'
-    i2.age = 10
-    assert r.check_time() is None
-
-    i2.value = 'on'
-    i2.age = 10
-    assert r.check_time() is not None
+    import asyncio
+    import time
+
+    from core.context import Context
+    from core.items import read_item
+
+    context = Context()
+    context.loop = asyncio.new_event_loop()
+    context.items.add_item(read_item({'name': 'item2', 'type': 'text'}))
+
+    r = Rule({'name': 'rule3', 'trigger': {'items': [{'item_id': 'item2', 'to': 'on', 'for': {'seconds': 0.05}}]}})
+    fired = []
+    r.process_item_for = lambda name, val, duration: fired.append((name, val))
+    context.add_rule(r)
+
+    def wait(t):
+        context.loop.run_until_complete(asyncio.sleep(t))
+
+    context.set_item_value('item2', 'on')
+    wait(0.02)
+    assert fired == []
+
+    # leaving the state cancels timer
+    context.set_item_value('item2', 'off')
+    wait(0.05)
+    assert fired == []
+
+    context.set_item_value('item2', 'on')
+    wait(0.07)
+    assert len(fired) == 1
+    assert r.active
+
+    # same value does not rearm
+    context.set_item_value('item2', 'on')
+    wait(0.07)
+    assert len(fired) == 1
+
+    # restored state: armed for remaining time only
+    context.set_item_value('item2', 'off')
+    context.items.get_item('item2').restore('on', time.time(), time.time() - 0.03)
+    context.init_for_triggers()
+    wait(0.04)
+    assert len(fired) == 2
+
+    context.items.get_item('item2').restore('on', time.time(), time.time() - 1)
+    context.init_for_triggers()
+    wait(0.02)
+    assert len(fired) == 2
+
+    context.clear_rules()
+    assert context._for_timers == {}
+    context.loop.close()
+
+
+def test_item_for_priority():
+    import asyncio
+
+    from core.commands import PRIO_RULE
+    from core.context import Context
+    from core.items import read_item
+
+    class CommandContext(Context):
+        def item_command(self, name, cmd, priority=PRIO_RULE, depth=0):
+            commands.append((name, cmd, priority))
+
+    commands = []
+    context = CommandContext()
+    context.loop = asyncio.new_event_loop()
+    context.items.add_item(read_item({'name': 'door', 'type': 'text'}))
+    r = Rule({'name': 'r', 'trigger': {'items': [{'item_id': 'door', 'to': 'open', 'for': {'seconds': 0.02}}]},
+              'action': [{'service': 'command', 'item_id': 'light', 'value': 'On'}]})
+    context.add_rule(r)
+
+    context.set_item_value('door', 'open')
+    context.loop.run_until_complete(asyncio.sleep(0.05))
+    assert commands == [('light', 'On', PRIO_RULE)]
+    assert r.stats.to_dict()['fired'] == {'item_for': 1}
+    context.loop.close()
 
 
 def test_item():
@@ -179,3 +223,252 @@ conditions:
 
     i.value = 26
     assert Rule.check_condition(cond, c) is True
+
+
+def test_trigger_index():
+    from core.context import Context
+
+    context = Context()
+    for r in yaml.safe_load(rule2):
+        context.add_rule(Rule(r))
+
+    assert [r.name for r in context.rules_for_change('item1', 1, 2)] == ['rule1', 'rule2']
+    assert [r.name for r in context.rules_for_change('item2', 1, 2)] == ['rule1']
+    assert [r.name for r in context.rules_for_change('item2', 2, 1)] == ['rule2']
+    assert context.rules_for_change('item3', 1, 2) == []
+
+    context.clear_rules()
+    assert context.rules_for_change('item1', 1, 2) == []
+
+
+def test_condition_time():
+    from datetime import datetime
+
+    cond = {'condition_type': 'time', 'after': '08:00', 'before': '20:30'}
+    assert Rule.check_condition_time(cond, datetime(2020, 1, 1, 12, 0)) is True
+    assert Rule.check_condition_time(cond, datetime(2020, 1, 1, 7, 59)) is False
+    assert Rule.check_condition_time(cond, datetime(2020, 1, 1, 20, 31)) is False
+
+    cond = {'condition_type': 'time', 'between': ['22:00', '06:00']}
+    assert Rule.check_condition_time(cond, datetime(2020, 1, 1, 23, 0)) is True
+    assert Rule.check_condition_time(cond, datetime(2020, 1, 1, 5, 0)) is True
+    assert Rule.check_condition_time(cond, datetime(2020, 1, 1, 12, 0)) is False
+
+
+def test_condition_compile_errors():
+    from core.conditions import ConditionError, compile_condition
+
+    c = TestContext()
+    for cond in ({'item_id': 'item1'},
+                 {'condition_type': 'unknown'},
+                 {'condition_type': 'state', 'item_id': 'item1'},
+                 {'condition_type': 'numeric_state', 'item_id': 'item1', 'equal': 5},
+                 {'condition_type': 'time', 'after': '25:00'},
+                 {'condition_type': 'and', 'conditions': [{'condition_type': 'time', 'before': 'x'}]}):
+        try:
+            compile_condition(cond, c.items)
+        except ConditionError:
+            pass
+        else:
+            assert False, cond
+
+
+def test_condition_compiled_state():
+    from core.conditions import compile_condition
+
+    c = TestContext()
+    i = TestItem('item1', 'On')
+    c.items.add_item(i)
+
+    fn = compile_condition({'condition_type': 'state', 'item_id': 'item1', 'check': 'in', 'state': ['On', 'Off']},
+                           c.items)
+    assert fn() is True
+    i.value = None
+    assert fn() is False
+
+    fn = compile_condition({'condition_type': 'state', 'item_id': 'item2', 'state': 'On'}, c.items)
+    assert fn() is False
+
+
+def test_condition_cache():
+    from core import clock
+    from core.conditions import ConditionCache, compile_condition
+    from core.context import Context
+    from core.items import read_item
+
+    c = Context()
+    c.items.add_item(read_item({'name': 'mode', 'type': 'text'}))
+    c.items.add_item(read_item({'name': 'temp', 'type': 'number'}))
+    c.set_item_value('mode', 'home')
+    c.set_item_value('temp', 20)
+
+    shared = {'condition_type': 'or', 'conditions': [{'condition_type': 'state', 'item_id': 'mode', 'state': 'home'},
+                                                     {'condition_type': 'numeric_state', 'item_id': 'temp',
+                                                      'above': 25}]}
+    cache = ConditionCache()
+    not_x = {'condition_type': 'state', 'item_id': 'mode', 'check': 'not', 'state': 'x'}
+    fn1 = compile_condition({'condition_type': 'and', 'conditions': [shared, not_x]}, c.items, cache)
+    fn2 = compile_condition({'condition_type': 'and', 'conditions': [{'condition_type': 'time', 'after': '00:00'},
+                                                                     dict(shared)]}, c.items, cache)
+    node = cache.get(shared, c.items, None)
+    assert len(cache) == 3
+
+    assert fn1() is True and fn2() is True
+    assert node.misses == 1 and node.hits == 1
+    assert fn1() is True and fn1.hits == 1
+
+    c.set_item_value('mode', 'away')
+    assert fn1() is False and fn2() is False
+    assert node.misses == 2 and fn1.misses == 2
+
+    c.set_item_value('temp', 30)
+    assert fn2() is True
+
+    vc = clock.VirtualClock(60 * 1000)
+    clock.set_clock(vc)
+    try:
+        assert fn2() is True
+        assert fn2() is True and fn2.last_hit
+        vc.set(vc.t + 60)
+        assert fn2() is True and not fn2.last_hit
+    finally:
+        clock.set_clock(clock.RealClock())
+
+    # replaced item is not taken from cache
+    c.items.remove_item('mode')
+    c.items.add_item(read_item({'name': 'mode', 'type': 'text'}))
+    assert cache.get(shared, c.items, lambda: None) is not node
+
+
+def test_condition_cache_stats():
+    import asyncio
+
+    from core.context import Context
+    from core.items import read_item
+
+    c = Context()
+    c.loop = asyncio.new_event_loop()
+    c.items.add_item(read_item({'name': 'a', 'type': 'number'}))
+    cond = {'condition_type': 'and', 'conditions': [{'condition_type': 'numeric_state', 'item_id': 'a', 'above': 5}]}
+    r1 = Rule({'name': 'r1', 'trigger': {'items': ['a']}, 'condition': cond, 'action': []})
+    r2 = Rule({'name': 'r2', 'trigger': {'items': ['a']}, 'condition': dict(cond), 'action': []})
+    c.add_rule(r1)
+    c.add_rule(r2)
+    assert r1._condition is r2._condition
+
+    c.set_item_value('a', 10)
+    assert r1.check_conditions() and r2.check_conditions()
+    assert r1.stats.to_dict()['condition_cache'] == dict(hits=0, misses=1, hit_rate=0.0)
+    assert r2.stats.to_dict()['condition_cache'] == dict(hits=1, misses=0, hit_rate=1.0)
+    assert c.conditions.to_dict()['nodes'] == 1
+
+
+def test_modes():
+    import asyncio
+
+    class SlowRule(Rule):
+        async def _run(self, d):
+            await asyncio.sleep(0.02)
+            self.done.append(d['value'])
+
+    def run(mode, n=4, **kw):
+        r = SlowRule(dict({'name': 'r', 'trigger': {'items': ['a']}, 'mode': mode}, **kw))
+        r.done = []
+
+        async def fire():
+            await asyncio.gather(*[r.process_item_change('a', i, None, 0) for i in range(n)])
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(fire())
+        loop.close()
+        return r
+
+    r = run('single')
+    assert r.done == [0] and r.dropped == 3
+
+    r = run('queued', max=2)
+    assert r.done == [0, 1, 2] and r.queued == 2 and r.dropped == 1
+
+    r = run('coalesce')
+    assert r.done == [0, 3] and r.queued == 3 and r.dropped == 2
+
+    r = run('restart')
+    assert r.done == [3] and r.cancelled == 3
+
+    r = run('parallel', max=3)
+    assert sorted(r.done) == [0, 1, 2] and r.dropped == 1
+    assert not r.busy
+
+    try:
+        Rule({'name': 'r', 'trigger': {}, 'mode': 'unknown'})
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def test_trigger_gate():
+    import asyncio
+
+    from core.triggers import read_gate, read_item_trigger, read_mqtt_trigger
+
+    loop = asyncio.new_event_loop()
+    fired = []
+
+    def burst(gate, values, pause=0.005):
+        for v in values:
+            gate.submit(loop, v, fired.append, v)
+            loop.run_until_complete(asyncio.sleep(pause))
+
+    gate = read_gate({'debounce': 20})
+    burst(gate, [1, 2, 3])
+    assert fired == []
+    loop.run_until_complete(asyncio.sleep(0.03))
+    assert fired == [3]
+
+    fired.clear()
+    gate = read_gate({'throttle': 50})
+    burst(gate, [1, 2, 3, 4])
+    assert fired == [1]
+    loop.run_until_complete(asyncio.sleep(0.06))
+    assert fired == [1, 4]
+    assert gate.dropped == 2
+
+    fired.clear()
+    gate = read_gate({'distinct': True})
+    burst(gate, [1, 1, 2, 2, 1], pause=0)
+    assert fired == [1, 2, 1]
+
+    assert read_gate({}) is None
+    assert read_item_trigger({'item_id': 'a', 'debounce': 100}).gate.debounce == 0.1
+    assert read_mqtt_trigger({'topic': 'a/+', 'payload': 'on'}).matches_payload('off') is False
+    assert read_mqtt_trigger({'topic': 'a/+'}).matches_payload('off') is True
+    assert read_mqtt_trigger({'topic': 'a/+', 'payload': None}).matches_payload('off') is False
+    for d in ({'debounce': 10, 'throttle': 10}, {'throttle': -1}):
+        try:
+            read_gate(d)
+        except ValueError:
+            pass
+        else:
+            assert False, d
+    loop.close()
+
+
+def test_gated_triggers_fire_once_per_batch():
+    import asyncio
+
+    from core.context import Change, Context
+
+    context = Context()
+    context.loop = asyncio.new_event_loop()
+    fired = []
+    context.do_async = lambda fn, *args: fired.append((fn.__self__.name, args[0]))
+
+    for r in ({'name': 'mixed', 'trigger': {'items': [{'item_id': 'a', 'distinct': True}, 'b']}},
+              {'name': 'gated', 'trigger': {'items': [{'item_id': 'a', 'distinct': True},
+                                                      {'item_id': 'b', 'distinct': True}]}}):
+        context.add_rule(Rule(r))
+
+    context.fire_rules([Change('a', 1, None, 0, 0), Change('b', 1, None, 0, 0)])
+    assert fired == [('mixed', 'a'), ('gated', 'a')]
+    context.loop.close()
@@ -0,0 +1,48 @@
+# coding: utf-8
+
+import asyncio
+
+from core.context import Context
+from core.items import read_item
+from core.rules import Rule
+from core.stats import Histogram
+
+
+def test_histogram():
+    h = Histogram()
+    for ms in (0.5, 3, 3, 7, 150):
+        h.add(ms / 1000.)
+
+    assert h.count == 5
+    assert h.percentile(50) == 5
+    assert h.percentile(100) == 200
+    assert abs(h.max - 150) < 1e-6
+    assert h.to_dict()['buckets']['5'] == 2
+
+
+def test_rule_stats():
+    context = Context()
+    context.loop = asyncio.new_event_loop()
+    context.items.add_item(read_item({'name': 'a', 'type': 'number'}))
+    rule = Rule({'name': 'r', 'trigger': {'items': ['a']},
+                 'condition': {'condition_type': 'numeric_state', 'item_id': 'a', 'above': 5},
+                 'action': [{'service': 'set_state', 'item_id': 'a', 'value': 1},
+                            {'condition_type': 'state', 'item_id': 'a', 'state': 2},
+                            {'service': 'log', 'data': {'message': 'x'}}]})
+    context.add_rule(rule)
+
+    context.set_item_value('a', 10)
+    context.loop.run_until_complete(rule.process_item_change('a', 10, None, 0))
+    context.loop.run_until_complete(rule.process_item_change('a', 1, None, 0))
+    context.loop.run_until_complete(rule.process_cron('cron * * * * *'))
+
+    d = rule.stats.to_dict()
+    assert d['fired'] == {'item_change': 2, 'cron': 1}
+    assert d['condition_passed'] == 1 and d['condition_failed'] == 2
+    assert d['action']['count'] == 1
+    assert d['service']['count'] == 1
+    assert sorted(d['actions']) == ['0', '1']
+
+    rule.stats.reset()
+    assert rule.stats.to_dict()['fired_total'] == 0
+    context.loop.close()
@@ -0,0 +1,43 @@
+# coding: utf-8
+
+from core.context import Context
+from core.rules import Rule
+from core.templates import Templates
+
+
+def test_cache():
+    templates = Templates({'double': lambda x: x * 2})
+
+    assert templates.render('{{ double(value) }}', {'value': 2}) == '4'
+    assert templates.render('{{ double(value) }}', {'value': 3}) == '6'
+    assert templates.misses == 1
+    assert templates.hits == 1
+
+
+def test_bytecode_cache(tmpdir):
+    templates = Templates(cache_dir=str(tmpdir))
+    assert templates.render('{{ 1 + 1 }}', {}) == '2'
+    assert len(tmpdir.listdir()) == 1
+
+    templates = Templates(cache_dir=str(tmpdir))
+    assert templates.render('{{ 1 + 1 }}', {}) == '2'
+
+
+def test_rule_compile():
+    context = Context()
+    rule = Rule({'name': 'r', 'trigger': {'items': ['a']},
+                 'action': [{'service': 'set_state', 'item_id': 'a', 'value_template': '{{ value }}'},
+                            {'service': 'log', 'data': {'message': 'value {{ value }}'}}]})
+    context.add_rule(rule)
+    assert context.templates.misses == 2
+    assert rule.get_value(rule.data['action'][0], {'value': 5}) == '5'
+    assert context.templates.hits == 1
+
+    rule = Rule({'name': 'r', 'trigger': {'items': ['a']},
+                 'action': [{'service': 'set_state', 'item_id': 'a', 'value_template': '{{ value '}]})
+    try:
+        context.add_rule(rule)
+    except ValueError:
+        pass
+    else:
+        assert False
@@ -0,0 +1,79 @@
+# coding: utf-8
+
+import itertools
+
+from core.context import Context
+from core.items import read_item
+from core.rules import Rule
+from core.topics import TopicTrie, check_topic_mask, match_topic
+
+
+def test_match_topic():
+    assert match_topic('a/+/c', 'a/b/c')
+    assert not match_topic('a/+/c', 'a/b/d')
+    assert match_topic('a/#', 'a/b/c')
+    assert match_topic('a/#', 'a')
+    assert match_topic('#', 'a/b')
+    assert not match_topic('a/b', 'a/b/c')
+    assert not match_topic('a/b/c', 'a/b')
+
+
+def test_trie():
+    masks = ['a/b/c', 'a/+/c', 'a/#', '#', '+/b/+', 'a/b', '+', 'x/+/#', 'a/+']
+    topics = ['/'.join(x) for n in (1, 2, 3, 4) for x in itertools.product('abcx', repeat=n)]
+
+    trie = TopicTrie()
+    for m in masks:
+        trie.add(m, m)
+
+    for topic in topics:
+        assert sorted(trie.match(topic)) == sorted(m for m in masks if match_topic(m, topic)), topic
+
+    for m in masks:
+        trie.remove(m, lambda x: x == m)
+    assert len(trie) == 0
+    assert not trie.root.children
+
+
+def test_check_mask():
+    check_topic_mask('a/+/b/#')
+    for mask in ('a/#/b', 'a/b+', 'a#'):
+        try:
+            check_topic_mask(mask)
+        except ValueError:
+            pass
+        else:
+            assert False, mask
+
+
+def test_routing():
+    context = Context()
+    calls = []
+    context.do_async = lambda fn, *args: calls.append((fn.__self__.name, args))
+    context.items.add_item(read_item({'name': 't1', 'type': 'number',
+                                      'input': {'channel': 'mqtt', 'topic': 'home/room1/temp'}}))
+    context.items.add_item(read_item({'name': 'any', 'type': 'number',
+                                      'input': {'channel': 'mqtt', 'topic': 'home/+/temp'}}))
+
+    r1 = Rule({'name': 'r1', 'trigger': {'mqtt': [{'topic': 'home/+/pir', 'payload': '1'}, 'home/#']},
+               'action': []})
+    r2 = Rule({'name': 'r2', 'trigger': {'mqtt': ['home/hall/pir']}, 'action': []})
+    context.add_rule(r1)
+    context.add_rule(r2)
+
+    context.mqtt_message('mqtt', 'home/room1/temp', 21)
+    assert context.get_item_value('t1') == 21 and context.get_item_value('any') == 21
+    assert calls == [('r1', ('home/room1/temp', 21))]
+
+    calls[:] = []
+    context.mqtt_message('mqtt', 'home/hall/pir', '1')
+    assert calls == [('r1', ('home/hall/pir', '1')), ('r2', ('home/hall/pir', '1'))]
+
+    context.remove_rule(r1)
+    calls[:] = []
+    context.mqtt_message('mqtt', 'home/hall/pir', '0')
+    assert calls == [('r2', ('home/hall/pir', '0'))]
+
+    context.items.remove_item('any')
+    context.mqtt_message('mqtt', 'home/room2/temp', 5)
+    assert context.get_item_value('t1') == 21